@@ -2,6 +2,10 @@ from django.contrib import admin
 
 # Register your models here.
 
-from core.models import SlackCredential, OpenAISettings
+from core.models import SlackCredential, OpenAISettings, CatalogEntry, CatalogSyncState, ThreadSnapshot, QuestionCacheEntry
 admin.site.register(SlackCredential)
-admin.site.register(OpenAISettings)
\ No newline at end of file
+admin.site.register(OpenAISettings)
+admin.site.register(CatalogEntry)
+admin.site.register(CatalogSyncState)
+admin.site.register(ThreadSnapshot)
+admin.site.register(QuestionCacheEntry)
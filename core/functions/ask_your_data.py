@@ -1,6 +1,6 @@
 # imports - Python/general
 import traceback
-import re, json, copy
+import copy
 import xml.etree.ElementTree as ET
 from pydantic import BaseModel
 
@@ -11,23 +11,210 @@ User = get_user_model()
 
 # imports - TNQ
 # Models and Classes
-from core.models import SlackCredential
+# N/A
 # Functions
 from tableau_next_question.functions import log_and_display_message
 import core.functions.openai as openai
 import core.functions.slack as slack
+import core.functions.slack_status as slack_status
+import core.functions.slack_streaming as slack_streaming
+import core.functions.slack_dispatch as slack_dispatch
 # import core.functions.entity_search as entity_search
 # import core.functions.tableau.vizql_data_service as vizql_data_service
 from core.functions.helpers import FormattedMessage
-from core.functions.helpers_other import remove_fields_from_dictionary, to_bool
+import core.functions.catalog_embeddings as catalog_embeddings
+import core.functions.catalog_encoding as catalog_encoding
+import core.functions.catalog_search as catalog_search
+import core.functions.concurrency as concurrency
+import core.functions.http_transport as http_transport
+from core.functions.helpers_other import to_bool
 import core.functions.prompts as ai_prompts
+import core.functions.question_cache as question_cache
+import core.functions.thread_snapshots as thread_snapshots
+import core.functions.vision_images as vision_images
 import core.functions.tableau.next_api as tableau_next_api
+import core.functions.tableau.next_catalog as tableau_next_catalog
+import core.functions.tableau.next_catalog_join as tableau_next_catalog_join
 import core.functions.tableau.next_functions as tableau_next_functions
 import core.functions.templates.tableau_next as tableau_next_templates
 import core.functions.tableau.metadata_api as tableau_metadata_api
+import core.functions.tableau.core_catalog as tableau_core_catalog
 import core.functions.tableau.rest_api as tableau_rest_api
 import core.functions.tableau.documents as tableau_documents
 
+def discover_tableau_next_candidates(force_catalog_refresh:bool=False) -> dict:
+    """
+    Connect to Tableau Next, and find the Dashboards that could answer a question. Returns a dict with:
+
+    - `connection_dict`: the Tableau Next connection, which we need again to get the image of the selected Dashboard.
+    - `dashboards`: the Dashboards (AnalyticsDashboard), each with their "visualizations".
+    - `visualizations_for_review`: the Dashboards in the format we pass to OpenAI for review.
+
+    Raises an exception if we can't connect.
+    """
+
+    connection_dict = tableau_next_api.connect()
+    if not connection_dict:
+        raise Exception("Could not authenticate to Tableau Next.")
+
+    # Our search will consist of finding the right Dashboard. To identify the right Dashboard, we need to consider the Visualizations on there, and in turn, the fields in the Visualizations.
+    # The relations go as follows: AnalyticsDashboard (needs SOQL) -> AnalyticsDashboardWidget (needs SOQL) -> AnalyticsVizWidgetDef (needs SOQL) -> AnalyticsVisualization (REST API, includes fields).
+
+    # Find AnalyticsDashboard, AnalyticsDashboardWidget, AnalyticsVizWidgetDef (SOQL) and Visualizations (REST API). These come from our stored catalog, which is only refreshed with what changed since the last sync (if it is outdated at all).
+    log_and_display_message(f"Finding Visualizations on Tableau Next")
+    tableau_next_catalog_contents = tableau_next_catalog.get_catalog(connection_dict, force_refresh=force_catalog_refresh)
+
+    return { "connection_dict": connection_dict, **build_tableau_next_candidates(tableau_next_catalog_contents) }
+
+def build_tableau_next_candidates(tableau_next_catalog_contents:dict) -> dict:
+    """
+    Join the Tableau Next catalog (as returned by tableau_next_catalog.get_catalog) into Dashboards with their Visualizations. Returns a dict with `dashboards` and `visualizations_for_review`, as described for discover_tableau_next_candidates.
+    """
+
+    dashboards_on_tn = tableau_next_catalog_contents["AnalyticsDashboard"]
+    log_and_display_message(f"Found { len(dashboards_on_tn) } Dashboards on Tableau Next.")
+    dashboard_widgets_on_tn = tableau_next_catalog_contents["AnalyticsDashboardWidget"]
+    log_and_display_message(f"Found { len(dashboard_widgets_on_tn) } Dashboard Widgets on Tableau Next.")
+    viz_widget_defs_on_tn = tableau_next_catalog_contents["AnalyticsVizWidgetDef"]
+    log_and_display_message(f"Found { len(viz_widget_defs_on_tn) } Visualization Widget Definitions on Tableau Next.")
+    all_visualizations_collection = tableau_next_catalog_contents["AnalyticsVisualization"]
+    log_and_display_message(f"Found { len(all_visualizations_collection) } Visualizations on Tableau Next.")
+
+    # Reconcile the data from Dashboard all the way down to viz and field. At the end of the day, we're just going to add a list of vizzes (labels), and a list of fields (fieldNames), to each dashboard.
+    tableau_next_catalog_join.build_dashboard_tree(dashboards=dashboards_on_tn, dashboard_widgets=dashboard_widgets_on_tn, viz_widget_defs=viz_widget_defs_on_tn, visualizations=all_visualizations_collection)
+
+    # Keep a copy of this data with just the info we want to pass to OpenAI for review: IDs and names (labels) of the dashboards and visualizations, and their fields' names.
+    visualizations_for_review = []
+    for dashboard in dashboards_on_tn:
+        dashboard_info = {
+            "id": dashboard.get("Id"),
+            "label": dashboard.get("MasterLabel"),
+            "source": "tableau_next",
+            "visualizations": [viz.get("label") for viz in dashboard.get("visualizations", [])],
+            "fields": [viz.get("fields", ["Nope"])[field].get("fieldName") for viz in dashboard.get("visualizations", []) for field in viz.get("fields", [])]
+        }
+        visualizations_for_review.append(dashboard_info)
+
+    log_and_display_message(f"Found visualizations for review from Tableau Next: { len(visualizations_for_review) }")
+
+    return {
+        "dashboards": dashboards_on_tn,
+        "visualizations_for_review": visualizations_for_review
+    }
+
+def discover_tableau_core_candidates(force_catalog_refresh:bool=False) -> dict:
+    """
+    Connect to Tableau (Server/Cloud, "Core"), and find the dashboards that could answer a question. Returns a dict with the same keys as discover_tableau_next_candidates: `connection_dict`, `dashboards` (as returned by the Metadata API) and `visualizations_for_review`.
+
+    Raises an exception if we can't connect.
+    """
+
+    log_and_display_message("Getting Metadata API information from Tableau (\"Core\")")
+    tableau_core_connection_dict = tableau_rest_api.connect()
+
+    # The dashboards, sheets and fields come from our snapshot of the Metadata API, which is only refreshed for the workbooks that changed since the last sync (if it is outdated at all).
+    dashboards_sheets_and_fields = tableau_core_catalog.get_dashboards(rest_api_connection=tableau_core_connection_dict, force_refresh=force_catalog_refresh)
+
+    return {
+        "connection_dict": tableau_core_connection_dict,
+        "dashboards": dashboards_sheets_and_fields,
+        "visualizations_for_review": build_tableau_core_candidates(dashboards_sheets_and_fields)
+    }
+
+def build_tableau_core_candidates(dashboards_sheets_and_fields:list) -> list:
+    """
+    Turn the Tableau Core dashboards (as returned by tableau_core_catalog.get_dashboards) into the format we pass to OpenAI for review.
+    """
+
+    visualizations_for_review = []
+    for dashboard in dashboards_sheets_and_fields:
+        dashboard_info = {
+            "id": dashboard.get("luid"),
+            "label": dashboard.get("name"),
+            "source": "tableau_core",
+            "visualizations": [sheet.get("name") for sheet in dashboard.get("sheets", [])],
+            "fields": [field.get("name") for sheet in dashboard.get("sheets", []) for field in sheet.get("sheetFieldInstances", [])]
+        }
+        visualizations_for_review.append(dashboard_info)
+
+    log_and_display_message(f"Found visualizations for review from Tableau Core: { len(dashboards_sheets_and_fields) }")
+
+    return visualizations_for_review
+
+def load_cached_selection(question_cache_entry) -> dict:
+    """
+    Get what we need to answer with a selection we reuse (see core.functions.question_cache), from the catalog of the platform it is on, as discover_tableau_next_candidates and discover_tableau_core_candidates get it: the stored one, refreshed first if it is older than TNQ_CATALOG_MAX_AGE_SECONDS. Returns a dict with `connection_dict` and `dashboards` (as those functions do), and `selected_viz` (the candidate). Returns None if the candidate changed since it was selected, or is gone, in which case the selection is forgotten.
+
+    Raises an exception if we can't connect.
+    """
+
+    if question_cache_entry.platform == "tableau_next":
+        candidates = discover_tableau_next_candidates()
+    else:
+        candidates = discover_tableau_core_candidates()
+
+    selected_viz = next((candidate for candidate in candidates["visualizations_for_review"] if candidate.get("id") == question_cache_entry.entity_id), None)
+    if not question_cache.is_unchanged(question_cache_entry, selected_viz):
+        question_cache.forget_selection(question_cache_entry, reason="it changed in the catalog, or is gone")
+        return None
+
+    question_cache.record_hit(question_cache_entry)
+
+    return {
+        "connection_dict": candidates["connection_dict"],
+        "dashboards": candidates["dashboards"],
+        "selected_viz": selected_viz
+    }
+
+def prewarm_catalogs() -> dict:
+    """
+    Refresh everything we would otherwise need to (re-)fetch when a question comes in after a while: the Tableau Next and Tableau Core catalogs, the list of semantic models on Tableau Next, and the embeddings of all candidates. Connecting also makes sure the credentials for both platforms still work.
+
+    Meant to run as a scheduled task (see core.tasks.register_prewarm_schedule), every TNQ_PREWARM_INTERVAL_MINUTES. The catalogs are refreshed regardless of their age (incrementally, where possible), so they stay fresh between runs.
+
+    Returns a dict with, per platform, None if all went well, or the error message.
+    """
+
+    prewarm_calls = {}
+    if not to_bool(settings.TNQ_DISABLE_TABLEAU_NEXT):
+        prewarm_calls["tableau_next"] = (prewarm_tableau_next, {})
+    if not to_bool(settings.TNQ_DISABLE_TABLEAU_CORE):
+        prewarm_calls["tableau_core"] = (prewarm_tableau_core, {})
+
+    prewarm_outcomes = concurrency.run_concurrently(prewarm_calls, max_workers=max(1, len(prewarm_calls)), description="pre-warm calls")
+
+    # The embeddings of new or changed candidates, so the semantic search for the next question doesn't have to wait for them. Only when we have all candidates, as the index drops the ones we don't pass.
+    if len(prewarm_outcomes) > 0 and all(prewarm_outcome["error"] is None for prewarm_outcome in prewarm_outcomes.values()):
+        visualizations_for_review = [candidate for prewarm_outcome in prewarm_outcomes.values() for candidate in prewarm_outcome["result"]]
+        try:
+            catalog_embeddings.update_index(visualizations_for_review)
+        except Exception as e:
+            log_and_display_message(f"Failed to update the catalog index while pre-warming:\n\t{e}\n\t{traceback.format_exc()}", level="warning")
+
+    http_transport.log_host_statistics()
+    slack_dispatch.log_dispatch_statistics()
+
+    return { platform: None if prewarm_outcome["error"] is None else str(prewarm_outcome["error"]) for platform, prewarm_outcome in prewarm_outcomes.items() }
+
+def prewarm_tableau_next() -> list:
+    """
+    Refresh the Tableau Next catalog and semantic models. Returns the candidates (visualizations_for_review) in the refreshed catalog.
+    """
+    connection_dict = tableau_next_api.connect()
+    if not connection_dict:
+        raise Exception("Could not authenticate to Tableau Next.")
+    tableau_next_catalog.refresh_catalog(connection_dict)
+    tableau_next_catalog.refresh_semantic_models(connection_dict)
+    return build_tableau_next_candidates(tableau_next_catalog.load_catalog())["visualizations_for_review"]
+
+def prewarm_tableau_core() -> list:
+    """
+    Refresh the Tableau Core catalog. Returns the candidates (visualizations_for_review) in the refreshed catalog.
+    """
+    tableau_core_connection_dict = tableau_rest_api.connect()
+    tableau_core_catalog.refresh_catalog(tableau_core_connection_dict)
+    return build_tableau_core_candidates(tableau_core_catalog.load_dashboards())
+
 def respond_to_data_question(source:str, question:str, kwargs:dict) -> None:
 
     """
@@ -39,7 +226,7 @@ def respond_to_data_question(source:str, question:str, kwargs:dict) -> None:
     """
     
     if source == "slack":
-        slack_credential = SlackCredential.objects.first()
+        slack_credential = slack.get_slack_credential(create=True)
         # Get the attributes we need to respond, from the "kwargs"
         slack_channel = kwargs.get("slack_channel", None)
         first_name = kwargs.get("first_name", "")
@@ -48,6 +235,11 @@ def respond_to_data_question(source:str, question:str, kwargs:dict) -> None:
         if slack_user_id is None or slack_channel is None or thread_ts is None:
             raise Exception("Slack user ID, channel, and thread timestamp are required to respond to a data question in Slack.")
 
+        # The events endpoint leaves letting the user know we got their question to us, so it can respond to Slack right away.
+        acknowledgement = kwargs.get("acknowledgement", None)
+        if acknowledgement is not None:
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=acknowledgement, thread_ts=thread_ts)
+
         # Get the user's email address from their Slack profile, so we can find their account.
         slack_user_info = slack.get_user_info(slack_user_id=slack_user_id, slack_credential=slack_credential)
         if slack_user_info is None:
@@ -58,240 +250,248 @@ def respond_to_data_question(source:str, question:str, kwargs:dict) -> None:
         # if user is None:
         #     raise Exception(f"Could not find user with email address { slack_user_email }.")
         
-        status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, text="Interpreting question...", thread_ts=thread_ts)
-
-        question_search_terms = question.split(" ")
-        question_search_terms = [term for term in question_search_terms if len(term) > 3]
-        # Lowercase, remove special characters, and remove duplicates
-        question_search_terms = list(set(question_search_terms))
-        question_search_terms = [re.sub(r"[^a-zA-Z0-9]", "", term).lower() for term in question_search_terms]
-
-        # FLOW: FIND VIZ ON TABLEAU NEXT/CORE #
-        # ----------------------------------- #
+        # The status message is sent in the background, and removed when we're done (also when something fails).
+        status_reporter = slack_status.StatusReporter(slack_channel=slack_channel, slack_credential=slack_credential, thread_ts=thread_ts)
+        status_reporter.update("Interpreting question...")
+        try:
 
-        # Find Views (Tableau Cloud) or Visualizations (Tableau Next) that may answer the question. Start with Tableau Next. But first, yeah, determine whether both apply.
-        use_tableau_core = True
-        use_tableau_next = True
+            # FLOW: FIND VIZ ON TABLEAU NEXT/CORE #
+            # ----------------------------------- #
+
+            # Find Views (Tableau Cloud) or Visualizations (Tableau Next) that may answer the question. Start with Tableau Next. But first, yeah, determine whether both apply.
+            use_tableau_core = True
+            use_tableau_next = True
+
+            if not to_bool(settings.TNQ_DISABLE_TABLEAU_CORE):
+                keywords_no_tableau_core = ["no tableau cloud", "only tableau next", "only on tableau next", "only with tableau next", "not on tableau cloud", "not with tableau cloud", "tableau next only"]
+                for keyword in keywords_no_tableau_core:
+                    if keyword in question.lower():
+                        use_tableau_core = False
+                        log_and_display_message(f"Tableau Core is not applicable: \"{keyword}\" was specified.")
+                        break
+            else:
+                log_and_display_message(f"Tableau Core is disabled at the application level with TNQ_DISABLE_TABLEAU_CORE.")
+                use_tableau_core = False
 
-        if not to_bool(settings.TNQ_DISABLE_TABLEAU_CORE):
-            keywords_no_tableau_core = ["no tableau cloud", "only tableau next", "only on tableau next", "only with tableau next", "not on tableau cloud", "not with tableau cloud", "tableau next only"]
-            for keyword in keywords_no_tableau_core:
-                if keyword in question.lower():
-                    use_tableau_core = False
-                    log_and_display_message(f"Tableau Core is not applicable: \"{keyword}\" was specified.")
-                    break
-        else:
-            log_and_display_message(f"Tableau Core is disabled at the application level with TNQ_DISABLE_TABLEAU_CORE.")
-            use_tableau_core = False
+            if not to_bool(settings.TNQ_DISABLE_TABLEAU_NEXT):
+                keywords_no_tableau_next = ["no tableau next", "only tableau cloud", "only on tableau cloud", "only with tableau cloud", "not on tableau next", "not with tableau next", "tableau cloud only"]
+                for keyword in keywords_no_tableau_next:
+                    if keyword in question.lower():
+                        use_tableau_next = False
+                        log_and_display_message(f"Tableau Next is not applicable: \"{keyword}\" was specified.")
+                        break
+            else:
+                log_and_display_message(f"Tableau Next is disabled at the application level with TNQ_DISABLE_TABLEAU_NEXT.")
+                use_tableau_next = False
 
-        if not to_bool(settings.TNQ_DISABLE_TABLEAU_NEXT):
-            keywords_no_tableau_next = ["no tableau next", "only tableau cloud", "only on tableau cloud", "only with tableau cloud", "not on tableau next", "not with tableau next", "tableau cloud only"]
-            for keyword in keywords_no_tableau_next:
+            # Our catalogs of Tableau Next and Tableau Core content are stored, and refreshed when outdated. The user can ask for a full refresh explicitly, though (e.g. when they just published something).
+            force_catalog_refresh = to_bool(kwargs.get("force_catalog_refresh", False))
+            keywords_force_catalog_refresh = ["refresh the catalog", "refresh catalog", "refresh your catalog"]
+            for keyword in keywords_force_catalog_refresh:
                 if keyword in question.lower():
-                    use_tableau_next = False
-                    log_and_display_message(f"Tableau Next is not applicable: \"{keyword}\" was specified.")
+                    force_catalog_refresh = True
+                    log_and_display_message(f"Forcing a full refresh of the catalog: \"{keyword}\" was specified.")
                     break
-        else:
-            log_and_display_message(f"Tableau Next is disabled at the application level with TNQ_DISABLE_TABLEAU_NEXT.")
-            use_tableau_next = False
-
-        # We will collect stuff in this list
-        visualizations_for_review = []
 
-        # Connect, Tableau Next
-        if use_tableau_next:
-            status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None), text="Connecting to Tableau Next...")
+            # Questions are often paraphrases of earlier ones. If we selected a visualization for a similar enough question before, and it didn't change since, we reuse that selection, and skip finding and selecting visualizations (see core.functions.question_cache).
+            selected_viz = None
+            embedder = None
+            question_vector = None
             try:
-                connection_dict = tableau_next_api.connect()
+                embedder = catalog_embeddings.get_embedder()
+                question_vector = question_cache.embed_question(question, embedder)
+                if not force_catalog_refresh:
+                    question_cache_entry = question_cache.find_selection(question_vector, embedder.name, platforms=[platform for platform, use_platform in [("tableau_next", use_tableau_next), ("tableau_core", use_tableau_core)] if use_platform])
+                    if question_cache_entry is not None:
+                        cached_selection = load_cached_selection(question_cache_entry)
+                        if cached_selection is not None:
+                            selected_viz = cached_selection["selected_viz"]
+                            if selected_viz["source"] == "tableau_next":
+                                connection_dict = cached_selection["connection_dict"]
+                                dashboards_on_tn = cached_selection["dashboards"]
+                            else:
+                                tableau_core_connection_dict = cached_selection["connection_dict"]
+                                dashboards_sheets_and_fields = cached_selection["dashboards"]
+                            log_and_display_message(f"Reusing the selection of visualization ID { selected_viz['id'] } on { selected_viz['source'] } for a similar question.")
             except Exception as e:
-                log_and_display_message(f"Error connecting to Tableau Next: {e}")
-                slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: There was a problem connecting to Tableau Next: {e}", thread_ts=thread_ts, icon_emoji=":cry:")
-                use_tableau_next = False
-
-        if use_tableau_next: # _Still_ using Tableau Next i.e. no issue connecting?
-            # Our search will consist of finding the right Dashboard. To identify the right Dashboard, we need to consider the Visualizations on there, and in turn, the fields in the Visualizations.
-            # The relations go as follows: AnalyticsDashboard (needs SOQL) -> AnalyticsDashboardWidget (needs SOQL) -> AnalyticsVizWidgetDef (needs SOQL) -> AnalyticsVisualization (REST API, includes fields).
-
-            # Find AnalyticsDashboard, AnalyticsDashboardWidget, AnalyticsVizWidgetDef with SOQL
-            dashboards_on_tn = tableau_next_api.get_entities_through_soql(connection=connection_dict, entity_type="AnalyticsDashboard")
-            log_and_display_message(f"Found { len(dashboards_on_tn) } Dashboards on Tableau Next.")
-            dashboard_widgets_on_tn = tableau_next_api.get_entities_through_soql(connection=connection_dict, entity_type="AnalyticsDashboardWidget")
-            log_and_display_message(f"Found { len(dashboard_widgets_on_tn) } Dashboard Widgets on Tableau Next.")
-            viz_widget_defs_on_tn = tableau_next_api.get_entities_through_soql(connection=connection_dict, entity_type="AnalyticsVizWidgetDef")
-            log_and_display_message(f"Found { len(viz_widget_defs_on_tn) } Visualization Widget Definitions on Tableau Next.")
-
-            # Find Visualizations
-            log_and_display_message(f"Finding Visualizations on Tableau Next")
-            status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None), text="Finding Visualizations on Tableau Next...")
-            all_visualizations_collection = tableau_next_api.get_visualization_collection(connection_dict)
-            log_and_display_message(f"Found { len(all_visualizations_collection) } Visualizations on Tableau Next.")
-
-            # Reconcile the data from Dashboard all the way down to viz and field. At the end of the day, we're just going to add a list of vizzes (labels), and a list of fields (fieldNames), to each dashboard.
-            for dashboard in dashboards_on_tn:
-                dashboard_widgets = [widget for widget in dashboard_widgets_on_tn if widget.get("AnalyticsDashboardId") == dashboard.get("Id") and widget.get("Type") == "visualization"]
-                for widget in dashboard_widgets:
-                    viz_widget_defs = [defn for defn in viz_widget_defs_on_tn if defn.get("AnalyticsDashboardWidgetId") == widget.get("Id")]
-                    for defn in viz_widget_defs:
-                        dashboard_vizzes = [viz for viz in all_visualizations_collection if viz.get("id") == defn.get("AnalyticsVisualizationId")] # Here id is lowercase because it comes from  the REST API
-                        # This is info we add. Fields is also in here already.
-                        dashboard["visualizations"] = dashboard_vizzes
-
-            # Keep a copy of this data with just the info we want to pass to OpenAI for review: IDs and names (labels) of the dashboards and visualizations, and their fields' names.
-            # Add Tableau next dashboards' core info (dashboard, visualization, fields) to visualizations_for_review
-            for dashboard in dashboards_on_tn:
-                dashboard_info = {
-                    "id": dashboard.get("Id"),
-                    "label": dashboard.get("MasterLabel"),
-                    "source": "tableau_next",
-                    "visualizations": [viz.get("label") for viz in dashboard.get("visualizations", [])],
-                    "fields": [viz.get("fields", ["Nope"])[field].get("fieldName") for viz in dashboard.get("visualizations", []) for field in viz.get("fields", [])]
-                }
-                visualizations_for_review.append(dashboard_info)
-
-            log_and_display_message(f"Found visualizations for review from Tableau Next: { len(visualizations_for_review) }")
-
-        if use_tableau_core:
-            log_and_display_message("Getting Metadata API information from Tableau (\"Core\")")
-            status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None), text="Connecting to Tableau...")
-            try:
-                tableau_core_connection_dict = tableau_rest_api.connect()
-            except Exception as e:
-                log_and_display_message(f"Error connecting to Tableau: {e}")
-                slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: There was a problem connecting to Tableau: {e}", thread_ts=thread_ts, icon_emoji=":cry:")
-                use_tableau_core = False
-
-        if use_tableau_core: # _Still_ using Tableau Core i.e. no issue connecting?
-
-            metadata_api_query = next((maq for maq in tableau_metadata_api.metadata_api_queries if maq.get("query_name", "?") == "dashboardsSheetsAndFields"), None)
-            status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None), text="Finding visualizations on Tableau...")
-            dashboards_sheets_and_fields = tableau_metadata_api.query_metadata_api_paginated(rest_api_connection=tableau_core_connection_dict, raw_query=metadata_api_query["query_contents"])
-
-            for dashboard in dashboards_sheets_and_fields:
-                dashboard_info = {
-                    "id": dashboard.get("luid"),
-                    "label": dashboard.get("name"),
-                    "source": "tableau_core",
-                    "visualizations": [sheet.get("name") for sheet in dashboard.get("sheets", [])],
-                    "fields": [field.get("name") for sheet in dashboard.get("sheets", []) for field in sheet.get("sheetFieldInstances", [])]
-                }
-                visualizations_for_review.append(dashboard_info)
-
-            log_and_display_message(f"Found visualizations for review from Tableau Core: { len(dashboards_sheets_and_fields) }")
-
-        # FLOW: SELECT VIZ WITH OPENAI API #
-        # -------------------------------- #
-
-        # Check these with OpenAI, providing the question we are looking to answer for context.
-        user_prompt = f"""
-            Question: { question }\n\n
-            Visualizations:\n\n
-            ```json\n
-            { json.dumps(visualizations_for_review, indent=4) }
-            ```\n
-        """
-
-        class VizEvaluationResponse(BaseModel):
-            id: str
-
-        try:
-            log_and_display_message(f"Sending vizzes to OpenAI to select the most adequate one.")
-            status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None), text="Reviewing Visualizations to find the most suitable candidate...")
-            openai_response = openai.openai_api_chat_completion(user_prompt=user_prompt, system_prompt=ai_prompts.tableau_next_question.system_prompt, user=None, response_format=VizEvaluationResponse)
-        except Exception as e:
-            error_message = f"There was a problem sending the prompt to OpenAI: {e}\n{traceback.format_exc()}"
-            log_and_display_message(error_message, level="error")
-            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
-            status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None)) # Delete status message
-            return
-
-        if not hasattr(openai_response, "id") or openai_response.id is None or openai_response.id == "" or openai_response.id == "null":
-            error_message = f"OpenAI response is missing 'id': {openai_response}"
-            log_and_display_message(error_message, level="error")
-            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
-            status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None)) # Delete status message
-            return
-
-        selected_viz_id = openai_response.id
-        selected_viz = next((viz for viz in visualizations_for_review if viz.get("id") == selected_viz_id), None)
-        target_platform = selected_viz.get("source", "unknown platform") if selected_viz is not None else "unknown platform"
-        log_and_display_message(f"OpenAI selected visualization ID { openai_response.id } on { target_platform }.")
-
-        # FLOW: GET VIZ IMAGE FROM TABLEAU NEXT or CORE #
-        # --------------------------------------------- #
-
-        if target_platform == "tableau_next":
-            # Re-get the viz (dashboard) on Next
-            # selected_viz_tableau_next = tableau_next_api.get_visualization(connection_dict, asset_id_or_name=selected_viz.get("id"))
-            # Except we don't need to use the API, we have this data already in dashboards_on_tn
-            selected_viz_tableau_next = next((viz for viz in dashboards_on_tn if viz.get("Id") == selected_viz.get("id")), {})
-
-            status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None), text=f"Found the one we need! Getting details for \"{ selected_viz_tableau_next.get('MasterLabel', '?') }\" on Tableau Next\"...")
-
-            viz_image_download_response = tableau_next_api.post_image_download(connection_dict, asset=selected_viz_tableau_next, metadata_only=False)
-            viz_image_bytes = viz_image_download_response.get("image_bytes")
-
-        elif target_platform == "tableau_core":
-            selected_viz_tableau_core = next((viz for viz in dashboards_sheets_and_fields if viz.get("luid") == selected_viz.get("id")), {})
-            viz_image_download_response = tableau_rest_api.download_view_image(rest_api_connection=tableau_core_connection_dict, view_luid=selected_viz_tableau_core.get("luid"))
-            viz_image_bytes = viz_image_download_response.content
+                log_and_display_message(f"Could not check for a similar earlier question, finding visualizations as usual:\n\t{e}\n\t{traceback.format_exc()}", level="warning")
+                selected_viz = None
+
+            if selected_viz is None:
+                # We will collect stuff in this list
+                visualizations_for_review = []
+
+                # Tableau Next and Tableau Core have nothing in common until we merge their candidates, so we connect to and search both at the same time. If one of them fails or takes too long, we continue with what the other one found.
+                discovery_calls = {}
+                if use_tableau_next:
+                    discovery_calls["tableau_next"] = (discover_tableau_next_candidates, { "force_catalog_refresh": force_catalog_refresh })
+                if use_tableau_core:
+                    discovery_calls["tableau_core"] = (discover_tableau_core_candidates, { "force_catalog_refresh": force_catalog_refresh })
+
+                platform_labels = { "tableau_next": "Tableau Next", "tableau_core": "Tableau" }
+                discovery_outcomes = {}
+                if len(discovery_calls) > 0:
+                    status_reporter.update(f"Finding visualizations on { ' and '.join([platform_labels[platform] for platform in discovery_calls]) }...")
+                    discovery_outcomes = concurrency.run_concurrently(discovery_calls, max_workers=len(discovery_calls), timeout=settings.TNQ_DISCOVERY_TIMEOUT_SECONDS, description="discovery branches")
+
+                for platform, discovery_outcome in discovery_outcomes.items():
+                    if discovery_outcome["error"] is not None:
+                        log_and_display_message(f"Error finding visualizations on { platform_labels[platform] }: { discovery_outcome['error'] }", level="error")
+                        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: There was a problem connecting to { platform_labels[platform] }: { discovery_outcome['error'] }", thread_ts=thread_ts, icon_emoji=":cry:")
+                        continue
+                    visualizations_for_review += discovery_outcome["result"]["visualizations_for_review"]
+
+                use_tableau_next = "tableau_next" in discovery_outcomes and discovery_outcomes["tableau_next"]["error"] is None
+                if use_tableau_next:
+                    connection_dict = discovery_outcomes["tableau_next"]["result"]["connection_dict"]
+                    dashboards_on_tn = discovery_outcomes["tableau_next"]["result"]["dashboards"]
+
+                use_tableau_core = "tableau_core" in discovery_outcomes and discovery_outcomes["tableau_core"]["error"] is None
+                if use_tableau_core:
+                    tableau_core_connection_dict = discovery_outcomes["tableau_core"]["result"]["connection_dict"]
+                    dashboards_sheets_and_fields = discovery_outcomes["tableau_core"]["result"]["dashboards"]
+
+                # FLOW: SELECT VIZ WITH OPENAI API #
+                # -------------------------------- #
+
+                # On larger sites, sending every candidate to OpenAI makes for a long (slow and expensive) prompt. So we first rank them locally by how well their labels, visualizations and fields match the question, and only send the best ones. Matching words (lexical) and meaning (semantic, with embeddings) each find candidates the other misses, so we combine both rankings.
+                question_search_terms = catalog_search.tokenize(question)
+                lexical_ranking = catalog_search.rank_candidates(question, visualizations_for_review, matching_only=True)
+                try:
+                    semantic_ranking = catalog_embeddings.semantic_search(question, visualizations_for_review, top_k=settings.TNQ_SEMANTIC_MAX_CANDIDATES, embedder=embedder, query_vector=question_vector)
+                except Exception as e:
+                    # Without embeddings, we can still shortlist on the search terms alone.
+                    log_and_display_message(f"Semantic search failed, shortlisting on search terms only:\n\t{e}\n\t{traceback.format_exc()}", level="warning")
+                    semantic_ranking = []
+                visualizations_shortlist = catalog_search.fuse_rankings(visualizations_for_review, [lexical_ranking, semantic_ranking], top_n=settings.TNQ_SELECTION_MAX_CANDIDATES)
+                log_and_display_message(f"Shortlisted { len(visualizations_shortlist) } of { len(visualizations_for_review) } visualizations for review: { len(lexical_ranking) } matched search terms { question_search_terms }, { len(semantic_ranking) } were semantically closest.")
+
+                # Check these with OpenAI, providing the question we are looking to answer for context. The candidates are sent as a compact table (see the system prompt), within a token budget; if they don't all fit, the lowest-ranked ones are left out.
+                encoded_shortlist = catalog_encoding.encode_candidates(visualizations_shortlist, token_budget=settings.TNQ_SELECTION_TOKEN_BUDGET)
+                if encoded_shortlist["truncated"] > 0:
+                    log_and_display_message(f"Left out the { encoded_shortlist['truncated'] } lowest-ranked visualizations to stay within { settings.TNQ_SELECTION_TOKEN_BUDGET } tokens.", level="warning")
+                user_prompt = f"""Question: { question }\n\nVisualizations:\n\n{ encoded_shortlist["text"] }\n"""
+
+                class VizEvaluationResponse(BaseModel):
+                    id: str
+
+                try:
+                    log_and_display_message(f"Sending vizzes to OpenAI to select the most adequate one.")
+                    status_reporter.update("Reviewing Visualizations to find the most suitable candidate...")
+                    openai_response = openai.openai_api_chat_completion(user_prompt=user_prompt, system_prompt=ai_prompts.tableau_next_question.system_prompt, user=None, response_format=VizEvaluationResponse, tokens_saved=encoded_shortlist["tokens_saved"])
+                except Exception as e:
+                    error_message = f"There was a problem sending the prompt to OpenAI: {e}\n{traceback.format_exc()}"
+                    log_and_display_message(error_message, level="error")
+                    slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
+                    status_reporter.clear()
+                    return
+
+                if not hasattr(openai_response, "id") or openai_response.id is None or openai_response.id == "" or openai_response.id == "null":
+                    error_message = f"OpenAI response is missing 'id': {openai_response}"
+                    log_and_display_message(error_message, level="error")
+                    slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
+                    status_reporter.clear()
+                    return
+
+                selected_viz_id = openai_response.id
+                selected_viz = next((viz for viz in visualizations_for_review if viz.get("id") == selected_viz_id), None)
+                log_and_display_message(f"OpenAI selected visualization ID { openai_response.id } on { selected_viz.get('source', 'unknown platform') if selected_viz is not None else 'unknown platform' }.")
+
+                # Remember the selection, for questions like this one.
+                if selected_viz is not None and question_vector is not None:
+                    try:
+                        question_cache.save_selection(question, question_vector, embedder.name, selected_viz)
+                    except Exception as e:
+                        log_and_display_message(f"Failed to remember the selection for this question:\n\t{e}\n\t{traceback.format_exc()}", level="warning")
+
+            target_platform = selected_viz.get("source", "unknown platform") if selected_viz is not None else "unknown platform"
+
+            # FLOW: GET VIZ IMAGE FROM TABLEAU NEXT or CORE #
+            # --------------------------------------------- #
+
+            if target_platform == "tableau_next":
+                # Re-get the viz (dashboard) on Next
+                # selected_viz_tableau_next = tableau_next_api.get_visualization(connection_dict, asset_id_or_name=selected_viz.get("id"))
+                # Except we don't need to use the API, we have this data already in dashboards_on_tn
+                selected_viz_tableau_next = next((viz for viz in dashboards_on_tn if viz.get("Id") == selected_viz.get("id")), {})
+
+                status_reporter.update(f"Found the one we need! Getting details for \"{ selected_viz_tableau_next.get('MasterLabel', '?') }\" on Tableau Next\"...")
+
+                viz_image_download_response = tableau_next_api.post_image_download(connection_dict, asset=selected_viz_tableau_next, metadata_only=False)
+                viz_image_bytes = viz_image_download_response.get("image_bytes")
+
+            elif target_platform == "tableau_core":
+                selected_viz_tableau_core = next((viz for viz in dashboards_sheets_and_fields if viz.get("luid") == selected_viz.get("id")), {})
+                # Rendered at a size that suits OpenAI's tile grid (dashboards with an automatic or range size, that is), rather than whatever Tableau defaults to.
+                viz_image_download_response = tableau_rest_api.download_view_image(rest_api_connection=tableau_core_connection_dict, view_luid=selected_viz_tableau_core.get("luid"), viz_width=settings.TNQ_VIEW_IMAGE_WIDTH, viz_height=settings.TNQ_VIEW_IMAGE_HEIGHT, resolution=settings.TNQ_VIEW_IMAGE_RESOLUTION)
+                viz_image_bytes = viz_image_download_response.content
         
-        status_message = slack.post_status_message(slack_channel=slack_channel, 
-        slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None)) # Delete status message
+            status_reporter.clear()
 
-        message = f":chart_with_upwards_trend: This chart should help us answer the question!"
-        slack.upload_file(slack_channel=slack_channel, slack_credential=slack_credential, file=viz_image_bytes, file_format="png", file_title="viz_image", initial_comment=message, thread_ts=thread_ts)
+            message = f":chart_with_upwards_trend: This chart should help us answer the question!"
+            slack.upload_file(slack_channel=slack_channel, slack_credential=slack_credential, file=viz_image_bytes, file_format="png", file_title="viz_image", initial_comment=message, thread_ts=thread_ts)
 
-        status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, text="Formulating an answer to the question...", thread_ts=thread_ts)
+            status_reporter.update("Formulating an answer to the question...")
 
-        # FLOW: GIVE IMAGE TO OPENAI TO ANSWER THE Q #
-        # ------------------------------------------ #
+            # FLOW: GIVE IMAGE TO OPENAI TO ANSWER THE Q #
+            # ------------------------------------------ #
 
-        # Send image to OpenAI with question, ask for an explanation.
-        openai_viz_comments = openai.comment_on_dashboard_file(file_bytes=viz_image_bytes, file_format="png", custom_prompt=f"Answer the following data question with the attached dashboard:\n\n{ question }")
-        log_and_display_message(f"OpenAI Dashboard Comments: { openai_viz_comments }", level="info")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=openai_viz_comments, thread_ts=thread_ts)
-        status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None)) # Delete status message
+            # Send image to OpenAI with question, ask for an explanation. The answer is shown while it is being written. OpenAI gets the image scaled to its tile grid, with the detail level the dashboard needs (see core.functions.vision_images); Slack got the original. The answer stays Markdown, as it is streamed (see core.functions.slack_streaming).
+            vision_image = vision_images.prepare_image(viz_image_bytes, visualization_count=len(selected_viz.get("visualizations", [])) if selected_viz is not None else None)
+            streaming_answer = slack_streaming.StreamingMessage(slack_channel=slack_channel, slack_credential=slack_credential, thread_ts=thread_ts)
+            openai_viz_comments = openai.comment_on_dashboard_file(file_bytes=vision_image["image_bytes"], file_format="png", custom_prompt=f"Answer the following data question with the attached dashboard:\n\n{ question }", convert_to_slack_markdown=False, on_partial_response=streaming_answer.update, image_detail=vision_image["detail"])
+            log_and_display_message(f"OpenAI Dashboard Comments: { openai_viz_comments }", level="info")
+            streaming_answer.finish(openai_viz_comments)
+            status_reporter.clear()
 
-        # FLOW: REBUILD VIZ IN TABLEAU NEXT #
-        # --------------------------------- #
+            # FLOW: REBUILD VIZ IN TABLEAU NEXT #
+            # --------------------------------- #
 
-        # If we answered with Tableau Core, and we know we have the same Semantic Model on Tableau Next... why not try and rebuild the same viz over there? We will suggest to the user that this is possible, and it is up to them to trigger the action if desired.
+            # If we answered with Tableau Core, and we know we have the same Semantic Model on Tableau Next... why not try and rebuild the same viz over there? We will suggest to the user that this is possible, and it is up to them to trigger the action if desired.
 
-        if target_platform == "tableau_core":
+            if target_platform == "tableau_core":
 
-            selected_core_viz_luid = selected_viz_tableau_core.get("luid", None)
+                selected_core_viz_luid = selected_viz_tableau_core.get("luid", None)
 
-            message_blocks_for_rebuild = [
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": "One more thing... We just answered this question with a viz on Tableau Cloud. Would you like to automatically rebuild it on Tableau Next? If the right data is available in Data Cloud, I can do that automatically for you!"
-                    }
-                },
-                {
-                    "type": "actions",
-                    "block_id": "action_block_for_rebuild",
-                    "elements": [
-                        {
-                            "type": "button",
-                            "text": {
-                                "type": "plain_text",
-                                "text": "Let's try that!"
-                            },
-                            "style": "primary",
-                            "value": f"{ selected_core_viz_luid }", # We only need to pass the selected viz LUID, no other context is needed here.
-                            "action_id": "rebuild_core_viz_in_next"
+                # Keep what we know about the selected dashboard (its sheets, fields, upstream data sources and workbook), so the rebuild doesn't need to ask the Metadata API again.
+                try:
+                    thread_snapshots.save_snapshot(slack_channel=slack_channel, thread_ts=thread_ts, data={ "question": question, "selected_viz": selected_viz_tableau_core })
+                except Exception as e:
+                    log_and_display_message(f"Failed to store the snapshot for this thread; a rebuild will look everything up again:\n\t{e}\n\t{traceback.format_exc()}", level="warning")
+
+                message_blocks_for_rebuild = [
+                    {
+                        "type": "section",
+                        "text": {
+                            "type": "mrkdwn",
+                            "text": "One more thing... We just answered this question with a viz on Tableau Cloud. Would you like to automatically rebuild it on Tableau Next? If the right data is available in Data Cloud, I can do that automatically for you!"
                         }
-                    ]
-                }
-            ]
+                    },
+                    {
+                        "type": "actions",
+                        "block_id": "action_block_for_rebuild",
+                        "elements": [
+                            {
+                                "type": "button",
+                                "text": {
+                                    "type": "plain_text",
+                                    "text": "Let's try that!"
+                                },
+                                "style": "primary",
+                                "value": f"{ selected_core_viz_luid }", # We only need to pass the selected viz LUID, no other context is needed here.
+                                "action_id": "rebuild_core_viz_in_next"
+                            }
+                        ]
+                    }
+                ]
 
-            message_for_response = FormattedMessage("Would you like to rebuild this viz on Tableau Next?").for_slack()
+                message_for_response = FormattedMessage("Would you like to rebuild this viz on Tableau Next?").for_slack()
 
-            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild, text=message_for_response, thread_ts=thread_ts)
+                slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild, text=message_for_response, thread_ts=thread_ts)
 
-        return
+            return
+        finally:
+            status_reporter.close()
 
     else:
         raise Exception(f"Source { source } is not supported yet. Only Slack is supported for now.")
@@ -302,7 +502,7 @@ def rebuild_core_viz_in_next(core_viz_luid:str, kwargs:dict) -> None:
     """
 
     # Kwargs for where we need to respond, and the user ID
-    slack_credential = SlackCredential.objects.first()
+    slack_credential = slack.get_slack_credential()
     slack_channel = kwargs.get("slack_channel", None)
     thread_ts = kwargs.get("thread_ts", None)
     action_message_ts = kwargs.get("action_message_ts", None)
@@ -333,160 +533,178 @@ def rebuild_core_viz_in_next(core_viz_luid:str, kwargs:dict) -> None:
     # Replace the original message in Slack first, to keep things tidy.
     slack.update_message(slack_channel=slack_channel, slack_credential=slack_credential, text=":zap: Okay! Working on rebuilding the viz on Tableau Next...", thread_ts=action_message_ts)
     # Update status
-    status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, text="Let's do it! Looking up which data source is used by this viz on Tableau.", thread_ts=thread_ts)
-
+    status_reporter = slack_status.StatusReporter(slack_channel=slack_channel, slack_credential=slack_credential, thread_ts=thread_ts)
+    status_reporter.update("Let's do it! Looking up which data source is used by this viz on Tableau.")
     try:
-        tableau_core_connection_dict = tableau_rest_api.connect()
-    except Exception as e:
-        error_message = f"Error connecting to Tableau: {e}"
-        log_and_display_message(error_message, level="error")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild_try_again, text="Try again?", thread_ts=thread_ts)
-        return
+
+        try:
+            tableau_core_connection_dict = tableau_rest_api.connect()
+        except Exception as e:
+            error_message = f"Error connecting to Tableau: {e}"
+            log_and_display_message(error_message, level="error")
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild_try_again, text="Try again?", thread_ts=thread_ts)
+            return
     
-    try:
-        viz_datasources_query = next((maq for maq in tableau_metadata_api.metadata_api_queries if maq.get("query_name", "?") == "dashboardsAndDataSources"), None)
-        viz_datasources_response = tableau_metadata_api.query_metadata_api_paginated(rest_api_connection=tableau_core_connection_dict, raw_query=viz_datasources_query["query_contents"], mda_filter={"luid": core_viz_luid})
-    except Exception as e:
-        error_message = f"Error query the Tableau Metadata API to find the data source for the original viz: {e}"
-        log_and_display_message(error_message, level="error")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild_try_again, text="Try again?", thread_ts=thread_ts)
-        return
+        # When we answered the question, we stored the dashboard we used (with its data sources, workbook, sheets and fields) for this thread. Only if that snapshot is gone or expired (or about another viz), we ask the Metadata API again.
+        thread_snapshot = thread_snapshots.load_snapshot(slack_channel=slack_channel, thread_ts=thread_ts)
+        if thread_snapshot is not None and thread_snapshot.get("selected_viz", {}).get("luid") == core_viz_luid:
+            log_and_display_message(f"Using the snapshot of thread { thread_ts } for viz { core_viz_luid }.")
+            snapshot_viz = thread_snapshot["selected_viz"]
+        else:
+            snapshot_viz = None
+
+        try:
+            if snapshot_viz is not None:
+                viz_datasources_response = [snapshot_viz]
+            else:
+                viz_datasources_query = next((maq for maq in tableau_metadata_api.metadata_api_queries if maq.get("query_name", "?") == "dashboardsAndDataSources"), None)
+                viz_datasources_response = tableau_metadata_api.query_metadata_api_paginated(rest_api_connection=tableau_core_connection_dict, raw_query=viz_datasources_query["query_contents"], mda_filter={"luid": core_viz_luid})
+        except Exception as e:
+            error_message = f"Error query the Tableau Metadata API to find the data source for the original viz: {e}"
+            log_and_display_message(error_message, level="error")
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild_try_again, text="Try again?", thread_ts=thread_ts)
+            return
     
-    if len(viz_datasources_response) == 0:
-        error_message = f"No data sources found for the original viz."
-        log_and_display_message(error_message, level="error")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
-        return
+        if len(viz_datasources_response) == 0:
+            error_message = f"No data sources found for the original viz."
+            log_and_display_message(error_message, level="error")
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: { error_message }", thread_ts=thread_ts, icon_emoji=":cry:")
+            return
 
-    # REBUILD Step 2: Check if the same Semantic Model exists on Tableau Next #
-    status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None), text=f"Checking to see if there is a semantic model on Tableau Next matching the data source from the original Tableau viz...")
+        # REBUILD Step 2: Check if the same Semantic Model exists on Tableau Next #
+        status_reporter.update(f"Checking to see if there is a semantic model on Tableau Next matching the data source from the original Tableau viz...")
     
-    connection_dict = tableau_next_api.connect()
+        connection_dict = tableau_next_api.connect()
     
-    all_semantic_models = tableau_next_api.get_all_semantic_models(connection_dict).get("items", [])
-
-    tableau_next_matching_semantic_model = None
-    if len(viz_datasources_response) > 0:
-        tableau_core_viz_metadata = viz_datasources_response[0] # It is probably the first and only viz
-        if len(tableau_core_viz_metadata.get("upstreamDatasources", [])) > 0:
-            tableau_core_datasource_metadata = tableau_core_viz_metadata["upstreamDatasources"][0] # We take the first data source for now, further matching can take place later if we need to.
-            tableau_next_matching_semantic_model = next((model for model in all_semantic_models if model.get("label", "!") == tableau_core_datasource_metadata.get("name", "?")), None)
-            tableau_core_source_workbook = tableau_core_viz_metadata.get("workbook", {})
-
-    if tableau_next_matching_semantic_model is None:
-        error_message = f"Never mind, did not find the data we were looking for. Sorry!"
-        log_and_display_message(error_message, level="error")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: {error_message}", thread_ts=thread_ts)
-        status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None)) # Delete status message
-        return
+        all_semantic_models = tableau_next_catalog.get_semantic_models(connection_dict)
+
+        tableau_next_matching_semantic_model = None
+        if len(viz_datasources_response) > 0:
+            tableau_core_viz_metadata = viz_datasources_response[0] # It is probably the first and only viz
+            if len(tableau_core_viz_metadata.get("upstreamDatasources", [])) > 0:
+                tableau_core_datasource_metadata = tableau_core_viz_metadata["upstreamDatasources"][0] # We take the first data source for now, further matching can take place later if we need to.
+                tableau_next_matching_semantic_model = next((model for model in all_semantic_models if model.get("label", "!") == tableau_core_datasource_metadata.get("name", "?")), None)
+                tableau_core_source_workbook = tableau_core_viz_metadata.get("workbook", {})
+
+        if tableau_next_matching_semantic_model is None:
+            error_message = f"Never mind, did not find the data we were looking for. Sorry!"
+            log_and_display_message(error_message, level="error")
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: {error_message}", thread_ts=thread_ts)
+            status_reporter.clear()
+            return
 
-    # We found a matching Semantic Model. We'll get the metadata right away so we can compare that to the workbook and fill that in our Next Visualization template.
-    semantic_model_metadata = tableau_next_api.get_semantic_model_metadata(connection_dict=connection_dict, semantic_data_model=tableau_next_matching_semantic_model)
-    semantic_model_data_objects = semantic_model_metadata.get("semanticDataObjects", [])
-    semantic_model_data_object = semantic_model_data_objects[0] # If this fails, we can drop out anyway
-    # For convenience, we'll created a combined list of dimensions and measures
-    semantic_model_data_object_fields = semantic_model_data_object.get("semanticDimensions", []) + semantic_model_data_object.get("semanticMeasurements", [])
+        # We found a matching Semantic Model. We'll get the metadata right away so we can compare that to the workbook and fill that in our Next Visualization template.
+        semantic_model_metadata = tableau_next_api.get_semantic_model_metadata(connection_dict=connection_dict, semantic_data_model=tableau_next_matching_semantic_model)
+        semantic_model_data_objects = semantic_model_metadata.get("semanticDataObjects", [])
+        semantic_model_data_object = semantic_model_data_objects[0] # If this fails, we can drop out anyway
+        # For convenience, we'll created a combined list of dimensions and measures
+        semantic_model_data_object_fields = semantic_model_data_object.get("semanticDimensions", []) + semantic_model_data_object.get("semanticMeasurements", [])
 
-    # REBUILD Step 3: Get the existing workbook from Tableau Core #
-    status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None), text=f"Getting the viz from Tableau Core, so we can dissect it...")
+        # REBUILD Step 3: Get the existing workbook from Tableau Core #
+        status_reporter.update(f"Getting the viz from Tableau Core, so we can dissect it...")
 
-    # Before that, we'll also need to re-retrieve the Metadata API context we used to answer the question, specifically the sheet and fields available (which is used to determine what exactly we'll rebuild from the workbook)
-    try:
-        metadata_api_query = next((maq for maq in tableau_metadata_api.metadata_api_queries if maq.get("query_name", "?") == "dashboardsSheetsAndFields"), None)
-        dashboards_sheets_and_fields_filtered = tableau_metadata_api.query_metadata_api_paginated(rest_api_connection=tableau_core_connection_dict, raw_query=metadata_api_query["query_contents"], mda_filter={"luid": core_viz_luid})
-        selected_viz_tableau_core = dashboards_sheets_and_fields_filtered[0] # This _should_ be it, otherwise we didn't manage to retrieve the same match.
-    except Exception as e:
-        error_message = f"Failed to retrieve the original dashboard's sheets and fields: {e}"
-        log_and_display_message(error_message, level="error")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: {error_message}", thread_ts=thread_ts)
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild_try_again, text="Try again?", thread_ts=thread_ts)
-        status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None)) # Delete status message
-        return
+        # Before that, we'll also need the Metadata API context we used to answer the question, specifically the sheet and fields available (which is used to determine what exactly we'll rebuild from the workbook). That's in the snapshot, or we re-retrieve it.
+        try:
+            if snapshot_viz is not None:
+                selected_viz_tableau_core = snapshot_viz
+            else:
+                metadata_api_query = next((maq for maq in tableau_metadata_api.metadata_api_queries if maq.get("query_name", "?") == "dashboardsSheetsAndFields"), None)
+                dashboards_sheets_and_fields_filtered = tableau_metadata_api.query_metadata_api_paginated(rest_api_connection=tableau_core_connection_dict, raw_query=metadata_api_query["query_contents"], mda_filter={"luid": core_viz_luid})
+                selected_viz_tableau_core = dashboards_sheets_and_fields_filtered[0] # This _should_ be it, otherwise we didn't manage to retrieve the same match.
+        except Exception as e:
+            error_message = f"Failed to retrieve the original dashboard's sheets and fields: {e}"
+            log_and_display_message(error_message, level="error")
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: {error_message}", thread_ts=thread_ts)
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild_try_again, text="Try again?", thread_ts=thread_ts)
+            status_reporter.clear()
+            return
 
-    # Download the Tableau Core twb, find the dashboard we selected earlier, and determine basics such as rows, columns, color. Assume a single sheet for now.
-    tableau_core_workbook = tableau_rest_api.download_file(rest_api_connection=tableau_core_connection_dict, asset_type="workbooks", luid=tableau_core_source_workbook.get("luid", ""), format="no_extract")
-    tableau_core_workbook_content = tableau_core_workbook.content
-    tableau_core_workbook_filename = tableau_core_workbook.headers.get("Content-Disposition", "attachment; filename=unknown.twb").split("filename=")[1].strip('"')
+        # Download the Tableau Core twb, find the dashboard we selected earlier, and determine basics such as rows, columns, color. Assume a single sheet for now.
+        tableau_core_workbook = tableau_rest_api.download_file(rest_api_connection=tableau_core_connection_dict, asset_type="workbooks", luid=tableau_core_source_workbook.get("luid", ""), format="no_extract")
+        tableau_core_workbook_content = tableau_core_workbook.content
+        tableau_core_workbook_filename = tableau_core_workbook.headers.get("Content-Disposition", "attachment; filename=unknown.twb").split("filename=")[1].strip('"')
     
-    if tableau_core_workbook_filename.endswith(".twbx"):
-        tableau_core_workbook_twb_name, tableau_core_workbook_content = tableau_documents.get_txx_from_txxx(txxx_file=tableau_core_workbook_content, txxx_file_name=tableau_core_workbook_filename)
-    else:
-        print(1) # TODO
+        if tableau_core_workbook_filename.endswith(".twbx"):
+            tableau_core_workbook_twb_name, tableau_core_workbook_content = tableau_documents.get_txx_from_txxx(txxx_file=tableau_core_workbook_content, txxx_file_name=tableau_core_workbook_filename)
+        else:
+            # A .twb is the workbook's XML as it is.
+            log_and_display_message(f"Downloaded the workbook as { tableau_core_workbook_filename }; reading it as it is.", level="debug")
 
-    tableau_core_workbook_tree = ET.ElementTree(ET.fromstring(tableau_core_workbook_content))
+        tableau_core_workbook_tree = ET.ElementTree(ET.fromstring(tableau_core_workbook_content))
 
-    # Find the worksheet that was used to answer the question, in the XML. We know that selected_viz_tableau_core contains the dashboard used to answer the question, so we'll first find the dashboard.
-    try:
-        # Let's just pick the first sheet on the dashboard used to answer the question, assuming that this is the one we want. Can be improved when we're no longer in "demo mode".
-        # There's also a try-catch for now, that will simply pull us out if we're not finding what we need.
-        tableau_core_dashboard_worksheets = tableau_core_workbook_tree.findall(".//worksheet")
-        selected_worksheet_elem = [w for w in tableau_core_dashboard_worksheets if w.attrib.get("name", "!").lower() == selected_viz_tableau_core["sheets"][0].get("name", "?").lower()][0]
+        # Find the worksheet that was used to answer the question, in the XML. We know that selected_viz_tableau_core contains the dashboard used to answer the question, so we'll first find the dashboard.
+        try:
+            # Let's just pick the first sheet on the dashboard used to answer the question, assuming that this is the one we want. Can be improved when we're no longer in "demo mode".
+            # There's also a try-catch for now, that will simply pull us out if we're not finding what we need.
+            tableau_core_dashboard_worksheets = tableau_core_workbook_tree.findall(".//worksheet")
+            selected_worksheet_elem = [w for w in tableau_core_dashboard_worksheets if w.attrib.get("name", "!").lower() == selected_viz_tableau_core["sheets"][0].get("name", "?").lower()][0]
 
-        # Now, dissect our worksheet. We are not going to look at the data source, and assume it's the one we need it to be. We are going to look for rows, columns, marks, etc. and find out what fields are being used on those.
-        # At the end, we need a) the full list of fields (these will become the "fields" in Next) and b) how they are used (this will go into viewSpecification and visualSpecification).
-        # And the best thing is, we're going to fill those things in in the template (sheet_definition) _as we go_.
+            # Now, dissect our worksheet. We are not going to look at the data source, and assume it's the one we need it to be. We are going to look for rows, columns, marks, etc. and find out what fields are being used on those.
+            # At the end, we need a) the full list of fields (these will become the "fields" in Next) and b) how they are used (this will go into viewSpecification and visualSpecification).
+            # And the best thing is, we're going to fill those things in in the template (sheet_definition) _as we go_.
 
-        sheet_definition = copy.deepcopy(tableau_next_templates.visualization_template)
-        # sheet_definition = copy.deepcopy(visualization_template)
-        # Wire up the data source
-        sheet_definition["dataSource"]["id"] = semantic_model_data_object.get("id", "")
-        sheet_definition["dataSource"]["name"] = semantic_model_data_object.get("apiName", "")
-        sheet_definition["dataSource"]["type"] = "SemanticModel"
+            sheet_definition = copy.deepcopy(tableau_next_templates.visualization_template)
+            # sheet_definition = copy.deepcopy(visualization_template)
+            # Wire up the data source
+            sheet_definition["dataSource"]["id"] = semantic_model_data_object.get("id", "")
+            sheet_definition["dataSource"]["name"] = semantic_model_data_object.get("apiName", "")
+            sheet_definition["dataSource"]["type"] = "SemanticModel"
 
-        fields_counter = 0 # Used because we need dict keys F1, F2, etc.
+            fields_counter = 0 # Used because we need dict keys F1, F2, etc.
 
-        # Rows
-        sheet_definition, fields_counter = tableau_next_functions.process_rows_or_cols_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, "rows", semantic_model_data_object)
+            # Rows
+            sheet_definition, fields_counter = tableau_next_functions.process_rows_or_cols_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, "rows", semantic_model_data_object)
 
-        # Columns
-        sheet_definition, fields_counter = tableau_next_functions.process_rows_or_cols_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, "cols", semantic_model_data_object)
+            # Columns
+            sheet_definition, fields_counter = tableau_next_functions.process_rows_or_cols_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, "cols", semantic_model_data_object)
 
-        # Marks
-        # Very basic for now; we have not yet processed any logic in case fields are used on marks; just the viz type and the single color (without field)
-        sheet_definition, fields_counter = tableau_next_functions.process_marks_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, semantic_model_data_object)
+            # Marks
+            # Very basic for now; we have not yet processed any logic in case fields are used on marks; just the viz type and the single color (without field)
+            sheet_definition, fields_counter = tableau_next_functions.process_marks_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, semantic_model_data_object)
 
-        # Filters
-        sheet_definition, fields_counter = tableau_next_functions.process_filters_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, semantic_model_data_object)
+            # Filters
+            sheet_definition, fields_counter = tableau_next_functions.process_filters_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, semantic_model_data_object)
 
-        # Other properties
-        # There are a bunch of other properties we can transfer, some of which are in the window definition of the worksheet, so we pass the full xml to this function.
-        sheet_definition, fields_counter = tableau_next_functions.process_other_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, tableau_core_workbook_tree, semantic_model_data_object)
+            # Other properties
+            # There are a bunch of other properties we can transfer, some of which are in the window definition of the worksheet, so we pass the full xml to this function.
+            sheet_definition, fields_counter = tableau_next_functions.process_other_into_definition(sheet_definition, fields_counter, selected_worksheet_elem, tableau_core_workbook_tree, semantic_model_data_object)
 
-        # REBUILD Step 4b: add workspace
-        workspaces = tableau_next_api.list_workspaces(connection_dict)
-        log_and_display_message(f"Found { len(workspaces) } workspaces on Tableau Next.")
+            # REBUILD Step 4b: add workspace
+            workspaces = tableau_next_api.list_workspaces(connection_dict)
+            log_and_display_message(f"Found { len(workspaces) } workspaces on Tableau Next.")
 
-        workspace_name_for_demo = settings.TNQ_TEMP_WORKSPACE_NAME
-        workspace_for_demo = next((ws for ws in workspaces if ws.get("name", "").lower() == workspace_name_for_demo.lower()), None)
+            workspace_name_for_demo = settings.TNQ_TEMP_WORKSPACE_NAME
+            workspace_for_demo = next((ws for ws in workspaces if ws.get("name", "").lower() == workspace_name_for_demo.lower()), None)
 
-        sheet_definition["workspace"] = {
-            "name": workspace_for_demo.get("name", None)
-        }
+            sheet_definition["workspace"] = {
+                "name": workspace_for_demo.get("name", None)
+            }
 
-        new_viz_name = f"{ selected_viz_tableau_core.get('name', 'Unknown Name') } [From Tableau Core]"
+            new_viz_name = f"{ selected_viz_tableau_core.get('name', 'Unknown Name') } [From Tableau Core]"
 
-        sheet_definition["label"] = new_viz_name
-        sheet_definition["view"]["label"] = sheet_definition["label"]
-        sheet_definition["name"] = new_viz_name.replace(" ", "_").replace("[", "").replace("]", "").lower() # Can be improved later
+            sheet_definition["label"] = new_viz_name
+            sheet_definition["view"]["label"] = sheet_definition["label"]
+            sheet_definition["name"] = new_viz_name.replace(" ", "_").replace("[", "").replace("]", "").lower() # Can be improved later
 
-        # REBUILD Step 5: post
-        tableau_next_new_viz = tableau_next_api.post_visualization(connection_dict=connection_dict, visualization_definition=sheet_definition)
+            # REBUILD Step 5: post
+            tableau_next_new_viz = tableau_next_api.post_visualization(connection_dict=connection_dict, visualization_definition=sheet_definition)
 
-        new_viz_message = f"Ready! Check out :tableaunext: <{ connection_dict['instance_url'] }/tableau/visualization/{ tableau_next_new_viz.get('name') }/edit|**{ tableau_next_new_viz.get('label', '?') }**>"
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=new_viz_message, thread_ts=thread_ts)
-        status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None)) # Delete status message
+            new_viz_message = f"Ready! Check out :tableaunext: <{ connection_dict['instance_url'] }/tableau/visualization/{ tableau_next_new_viz.get('name') }/edit|**{ tableau_next_new_viz.get('label', '?') }**>"
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=new_viz_message, thread_ts=thread_ts)
+            status_reporter.clear()
         
-        return
-
-    except Exception as e:
-        error_message = f"We did not manage to rebuild the viz in Tableau Next, for \"technical reasons\":\n{e}\n{traceback.format_exc()}"
-        log_and_display_message(error_message, level="error")
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: {error_message}", thread_ts=thread_ts)
-        slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild_try_again, text="Try again?", thread_ts=thread_ts)
-        status_message = slack.post_status_message(slack_channel=slack_channel, slack_credential=slack_credential, previous_status_message_ts=status_message.get("ts", None)) # Delete status message
-        return
+            return
 
-    return
+        except Exception as e:
+            error_message = f"We did not manage to rebuild the viz in Tableau Next, for \"technical reasons\":\n{e}\n{traceback.format_exc()}"
+            log_and_display_message(error_message, level="error")
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, text=f":x: {error_message}", thread_ts=thread_ts)
+            slack.post_message(slack_channel=slack_channel, slack_credential=slack_credential, blocks=message_blocks_for_rebuild_try_again, text="Try again?", thread_ts=thread_ts)
+            status_reporter.clear()
+            return
 
+        return
+    finally:
+        status_reporter.close()
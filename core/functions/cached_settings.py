@@ -0,0 +1,43 @@
+# imports - Python/general
+import time, threading
+
+# imports - Django
+from django.conf import settings
+
+# imports - our app
+# Functions
+from tableau_next_question.functions import log_and_display_message
+
+# In-process cache of the "singleton" settings models (SlackCredential, OpenAISettings): we only ever use the first one, and reading it means a query and decrypting its EncryptedCharFields, several times per question. Instead, each process reads it once, and keeps it until it is saved or deleted (see core.signals) or for TNQ_SETTINGS_CACHE_SECONDS at most. The latter is for changes made by another process (e.g. in the admin, while the django_q workers keep running), whose signals we don't get.
+#
+# The cached instances are shared between threads; treat them as read-only.
+
+# Model label -> (instance, when it expires (time.monotonic()))
+cached_instances = {}
+cached_instances_lock = threading.Lock()
+
+def get_first(model_class, create:bool=False):
+    """
+    The first instance of a model, from the cache if possible. With `create`, one is created if there is none (as get_or_create() would); otherwise returns None if there is none. A missing instance is not cached.
+    """
+    key = model_class._meta.label
+    with cached_instances_lock:
+        cached_instance = cached_instances.get(key)
+        if cached_instance is not None and cached_instance[1] > time.monotonic():
+            return cached_instance[0]
+
+    instance = model_class.objects.first()
+    if instance is None and create:
+        instance, instance_created = model_class.objects.get_or_create()
+    if instance is not None:
+        with cached_instances_lock:
+            cached_instances[key] = (instance, time.monotonic() + settings.TNQ_SETTINGS_CACHE_SECONDS)
+    return instance
+
+def invalidate(model_class):
+    """
+    Drop the cached instance of a model, so that the next get_first() reads it again.
+    """
+    with cached_instances_lock:
+        if cached_instances.pop(model_class._meta.label, None) is not None:
+            log_and_display_message(f"{ model_class.__name__ } changed; it will be read again.", level="debug")
@@ -0,0 +1,246 @@
+# imports - Python/general
+import os, json, hashlib, tempfile, threading, time
+import numpy as np
+
+# imports - Django
+from django.conf import settings
+from django.core.cache import cache
+
+# imports - our app
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.catalog_search as catalog_search
+
+# Semantic search through the candidates (dashboards) we found on Tableau Next and Tableau Core. Lexical search (see core.functions.catalog_search) does not know that "how far did people run" is about a field named "distance_km"; embeddings do.
+#
+# Every candidate is embedded once (label + visualizations + fields), and the vectors are kept on disk as a NumPy matrix in TNQ_CATALOG_INDEX_DIR, together with a hash of the text they were computed from. When the catalog changes, only the candidates whose text changed are embedded again.
+#
+# Questions only add to the index: they may come with the candidates of one platform only (e.g. when the other one is disabled, or failed), and those of the other platform should still be there for the next question. Candidates that are gone are dropped when pre-warming, which passes the complete catalog.
+
+index_matrix_file_name = "embeddings.npy"
+index_entries_file_name = "entries.json"
+
+# Several threads, and workers, may update the index at the same time. Writes take turns: threads within a process through index_lock, workers through a lock in Django's cache (in the database, shared by all of them). Each write reads the index again first, so it adds to what others wrote rather than overwriting it.
+index_lock = threading.Lock()
+index_lock_cache_key = "tnq:catalog_index:lock"
+index_lock_timeout_seconds = 30
+index_lock_poll_seconds = 0.1
+
+class HashingEmbedder:
+    """
+    Deterministic embedder that doesn't need any API: terms (see catalog_search.tokenize) and their character trigrams are hashed into a fixed number of dimensions. Only as semantic as overlapping word parts go, but good enough for offline tests and development.
+    """
+
+    def __init__(self, dimensions:int=512):
+        self.dimensions = dimensions
+        self.name = f"hashing-{ dimensions }"
+
+    def embed(self, texts:list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for text_index, text in enumerate(texts):
+            for term in catalog_search.tokenize(text):
+                features = [term] + [f"#{ term }#"[position:position + 3] for position in range(len(term))]
+                for feature in features:
+                    # Python's own hash() differs between processes, so we can't use that for something we store on disk.
+                    feature_hash = int.from_bytes(hashlib.md5(feature.encode("utf-8")).digest()[:8], "little")
+                    sign = 1 if (feature_hash >> 63) & 1 == 0 else -1
+                    vectors[text_index, feature_hash % self.dimensions] += sign
+        return vectors
+
+class OpenAIEmbedder:
+    """
+    Embedder using the OpenAI embeddings API, with the embedding model from the OpenAI settings (unless specified).
+    """
+
+    def __init__(self, model:str=None):
+        import core.functions.openai as openai
+        self.openai = openai
+        self.model = model if model is not None else openai.get_openai_api_settings().embedding_model
+        self.name = f"openai-{ self.model }"
+
+    def embed(self, texts:list) -> np.ndarray:
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.array(self.openai.openai_api_embeddings(texts, model=self.model), dtype=np.float32)
+
+embedders = {
+    "openai": OpenAIEmbedder,
+    "hashing": HashingEmbedder
+}
+
+def get_embedder(embedder_name:str=None):
+    """
+    Get the embedder configured in TNQ_CATALOG_EMBEDDER ("openai" or "hashing"), or the one specified.
+    """
+    embedder_name = embedder_name if embedder_name is not None else settings.TNQ_CATALOG_EMBEDDER
+    if embedder_name not in embedders:
+        raise ValueError(f"Unknown embedder \"{ embedder_name }\"; use one of: { ', '.join(embedders) }.")
+    return embedders[embedder_name]()
+
+def candidate_key(candidate:dict) -> str:
+    """
+    The key we identify candidates by in the index: their platform and id.
+    """
+    return f"{ candidate.get('source') }:{ candidate.get('id') }"
+
+def candidate_text(candidate:dict) -> str:
+    """
+    The text we embed for one candidate in visualizations_for_review. Field names are often snake_case, which embeds better as separate words.
+    """
+    fields = list(dict.fromkeys(field for field in candidate.get("fields", []) if field is not None)) # Deduplicated, in order
+    return "\n".join([
+        f"Dashboard: { candidate.get('label') }",
+        f"Visualizations: { ', '.join(str(visualization) for visualization in candidate.get('visualizations', [])) }",
+        f"Fields: { ', '.join(str(field).replace('_', ' ') for field in fields) }"
+    ])
+
+def normalize_rows(matrix:np.ndarray) -> np.ndarray:
+    """
+    Scale each row to unit length, so that a dot product is a cosine similarity. All-zero rows stay zero.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def empty_index(embedder_name:str=None) -> dict:
+    """
+    An index without any entries.
+    """
+    return { "embedder": embedder_name, "keys": [], "content_hashes": [], "matrix": np.zeros((0, 0), dtype=np.float32) }
+
+def load_index(index_dir:str=None) -> dict:
+    """
+    Load the index from disk. Returns a dict with "embedder" (its name), "keys", "content_hashes" and "matrix", or an empty index if there is none (yet), or it can't be read.
+    """
+    index_dir = index_dir if index_dir is not None else settings.TNQ_CATALOG_INDEX_DIR
+    try:
+        with open(os.path.join(index_dir, index_entries_file_name), "r") as entries_file:
+            entries = json.load(entries_file)
+        matrix = np.load(os.path.join(index_dir, index_matrix_file_name))
+        if matrix.shape[0] != len(entries["keys"]):
+            raise ValueError(f"The index has { matrix.shape[0] } vectors but { len(entries['keys']) } keys.")
+        return { **entries, "matrix": matrix }
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log_and_display_message(f"Could not read the catalog index in { index_dir }, it will be rebuilt: {e}", level="warning")
+    return empty_index()
+
+def save_index(index:dict, index_dir:str=None):
+    """
+    Write the index to disk. Each file is written to a temporary file first and then moved into place, so a reader never sees a half-written file.
+    """
+    index_dir = index_dir if index_dir is not None else settings.TNQ_CATALOG_INDEX_DIR
+    os.makedirs(index_dir, exist_ok=True)
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=index_dir, suffix=".npy")
+    with os.fdopen(file_descriptor, "wb") as matrix_file:
+        np.save(matrix_file, index["matrix"])
+    os.replace(temporary_path, os.path.join(index_dir, index_matrix_file_name))
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=index_dir, suffix=".json")
+    with os.fdopen(file_descriptor, "w") as entries_file:
+        json.dump({ "embedder": index["embedder"], "keys": index["keys"], "content_hashes": index["content_hashes"] }, entries_file)
+    os.replace(temporary_path, os.path.join(index_dir, index_entries_file_name))
+
+def load_index_for(embedder, index_dir:str=None) -> dict:
+    """
+    Load the index from disk, if it was built by this embedder. Vectors of different embedders can't be compared, so otherwise we start over with an empty one.
+    """
+    stored_index = load_index(index_dir)
+    if stored_index["embedder"] != embedder.name:
+        return empty_index(embedder.name)
+    return stored_index
+
+def update_index(candidates:list, embedder=None, index_dir:str=None, prune:bool=True) -> dict:
+    """
+    Bring the index up to date with the candidates: vectors of unchanged candidates are reused, and new or changed candidates are embedded. With `prune`, the candidates are the complete catalog, and the ones that are gone are dropped from the index; without, the other entries in the index are kept. The index is only written back to disk if anything changed.
+
+    Returns an index (as load_index does) with only the candidates, with its rows in the same order as the candidates.
+    """
+
+    embedder = embedder if embedder is not None else get_embedder()
+
+    stored_index = load_index_for(embedder, index_dir)
+    stored_rows = { (key, content_hash): row_index for row_index, (key, content_hash) in enumerate(zip(stored_index["keys"], stored_index["content_hashes"])) }
+
+    keys = [candidate_key(candidate) for candidate in candidates]
+    texts = [candidate_text(candidate) for candidate in candidates]
+    content_hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+
+    rows_to_embed = [candidate_index for candidate_index in range(len(candidates)) if (keys[candidate_index], content_hashes[candidate_index]) not in stored_rows]
+    new_vectors = normalize_rows(embedder.embed([texts[candidate_index] for candidate_index in rows_to_embed])) if len(rows_to_embed) > 0 else None
+
+    dimensions = new_vectors.shape[1] if new_vectors is not None else stored_index["matrix"].shape[1]
+    matrix = np.zeros((len(candidates), dimensions), dtype=np.float32)
+    for candidate_index in range(len(candidates)):
+        stored_row = stored_rows.get((keys[candidate_index], content_hashes[candidate_index]))
+        if stored_row is not None:
+            matrix[candidate_index] = stored_index["matrix"][stored_row]
+    if new_vectors is not None:
+        matrix[rows_to_embed] = new_vectors
+
+    index = { "embedder": embedder.name, "keys": keys, "content_hashes": content_hashes, "matrix": matrix }
+    dropped_count = len(set(stored_index["keys"]) - set(keys)) if prune else 0
+    if len(rows_to_embed) > 0 or (prune and keys != stored_index["keys"]):
+        if save_to_index(index, embedder, prune, index_dir):
+            log_and_display_message(f"Updated the catalog index: embedded { len(rows_to_embed) } new or changed of { len(candidates) } candidates with { embedder.name }, dropped { dropped_count } that are gone.")
+
+    return index
+
+def save_to_index(index:dict, embedder, prune:bool, index_dir:str=None) -> bool:
+    """
+    Write (part of) the index to disk: with `prune`, the index replaces what is stored; without, its entries replace the stored ones with the same keys, and the others are kept. Returns whether it was written; if another worker holds the lock for too long, we don't write (and the vectors are embedded again next time).
+    """
+
+    with index_lock:
+        lock_acquired = cache.add(index_lock_cache_key, True, timeout=index_lock_timeout_seconds)
+        waited_until = time.monotonic() + index_lock_timeout_seconds
+        while not lock_acquired and time.monotonic() < waited_until:
+            time.sleep(index_lock_poll_seconds)
+            lock_acquired = cache.add(index_lock_cache_key, True, timeout=index_lock_timeout_seconds)
+        if not lock_acquired:
+            log_and_display_message("Timed out waiting for another worker to update the catalog index; not saving the new vectors.", level="warning")
+            return False
+
+        try:
+            if not prune:
+                # Another worker may have written the index since we read it, so we add to what is there now.
+                stored_index = load_index_for(embedder, index_dir)
+                index_keys = set(index["keys"])
+                rows_to_keep = [row_index for row_index, key in enumerate(stored_index["keys"]) if key not in index_keys]
+                if len(rows_to_keep) > 0 and stored_index["matrix"].shape[1] == index["matrix"].shape[1]:
+                    index = {
+                        "embedder": index["embedder"],
+                        "keys": [stored_index["keys"][row_index] for row_index in rows_to_keep] + index["keys"],
+                        "content_hashes": [stored_index["content_hashes"][row_index] for row_index in rows_to_keep] + index["content_hashes"],
+                        "matrix": np.vstack([stored_index["matrix"][rows_to_keep], index["matrix"]])
+                    }
+            save_index(index, index_dir)
+            return True
+        finally:
+            cache.delete(index_lock_cache_key)
+
+def search(index:dict, query_vector:np.ndarray, top_k:int) -> list:
+    """
+    Top-k cosine search. Returns a list of (row index, similarity) tuples, most similar first.
+    """
+    if index["matrix"].shape[0] == 0 or top_k <= 0:
+        return []
+    query_vector = normalize_rows(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))[0]
+    similarities = index["matrix"] @ query_vector
+    top_k = min(top_k, len(similarities))
+    top_rows = np.argpartition(-similarities, top_k - 1)[:top_k]
+    top_rows = top_rows[np.argsort(-similarities[top_rows], kind="stable")]
+    return [(int(row_index), float(similarities[row_index])) for row_index in top_rows]
+
+def semantic_search(question:str, candidates:list, top_k:int, embedder=None, query_vector:np.ndarray=None) -> list:
+    """
+    Return the (at most) top_k candidates semantically closest to the question, most similar first. Candidates that are not in the index yet (or changed) are embedded and added to it first; nothing is removed from it.
+
+    Pass the question's embedding (by the same embedder) as query_vector if you have it already.
+    """
+    embedder = embedder if embedder is not None else get_embedder()
+    index = update_index(candidates, embedder=embedder, prune=False)
+    query_vector = query_vector if query_vector is not None else embedder.embed([question])[0]
+    return [candidates[row_index] for row_index, similarity in search(index, query_vector, top_k)]
@@ -0,0 +1,75 @@
+# imports - Python/general
+import json, math, re
+
+# Compact serialization of the candidates (dashboards) we send to OpenAI to select from. Pretty-printed JSON repeats every key for every candidate, spends a lot on indentation, and lists a field again for every visualization using it. Instead, we send one line per candidate, with the columns separated by "|" and the items within a column by ";":
+#
+#   id|label|visualizations|fields
+#   0FKxx0000000001|Running stats|Distance by week;Pace|distance_km;runner_name;pace
+#
+# The prompt also has a hard token budget: candidates are expected best match first, and the ones at the end are left out if they don't fit.
+
+column_separator = "|"
+item_separator = ";"
+header = column_separator.join(["id", "label", "visualizations", "fields"])
+
+# Rough, but good enough to budget with: OpenAI's tokenizers average about 4 characters per token for English text.
+characters_per_token = 4
+
+def estimate_tokens(text:str) -> int:
+    """
+    Estimate the number of tokens in a text, without calling a tokenizer.
+    """
+    return math.ceil(len(text) / characters_per_token)
+
+def clean_value(value) -> str:
+    """
+    Make a value safe to put in a column: no separators or line breaks, and no surrounding or repeated whitespace.
+    """
+    return re.sub(r"\s+", " ", re.sub(r"[|;\r\n]", " ", str(value))).strip()
+
+def deduplicate(values:list) -> list:
+    """
+    Remove empty and duplicate values, keeping the first occurrence of each.
+    """
+    return list(dict.fromkeys(clean_value(value) for value in values if value is not None and clean_value(value) != ""))
+
+def encode_candidate(candidate:dict) -> str:
+    """
+    Encode one candidate of visualizations_for_review as a single line.
+    """
+    return column_separator.join([
+        clean_value(candidate.get("id")),
+        clean_value(candidate.get("label")),
+        item_separator.join(deduplicate(candidate.get("visualizations", []))),
+        item_separator.join(deduplicate(candidate.get("fields", [])))
+    ])
+
+def encode_candidates(candidates:list, token_budget:int) -> dict:
+    """
+    Encode a list of candidates (best match first) as a table, leaving out the lowest-ranked candidates that don't fit within token_budget (estimated). Returns a dict with:
+
+    - `text`: the encoded table, including its header.
+    - `candidates`: the candidates that were included.
+    - `tokens`: the estimated number of tokens of the text.
+    - `tokens_saved`: the estimated number of tokens saved compared to pretty-printed JSON of the included candidates. The ones left out would not have fit in the JSON either, so they don't count.
+    - `truncated`: how many candidates were left out.
+    """
+    lines = [header]
+    tokens = estimate_tokens(header)
+    included_candidates = []
+    for candidate in candidates:
+        line = encode_candidate(candidate)
+        line_tokens = estimate_tokens("\n" + line)
+        if tokens + line_tokens > token_budget:
+            break
+        lines.append(line)
+        tokens += line_tokens
+        included_candidates.append(candidate)
+
+    return {
+        "text": "\n".join(lines),
+        "candidates": included_candidates,
+        "tokens": tokens,
+        "tokens_saved": estimate_tokens(json.dumps(included_candidates, indent=4)) - tokens,
+        "truncated": len(candidates) - len(included_candidates)
+    }
@@ -0,0 +1,113 @@
+# imports - Python/general
+import re, math
+
+# Local, lexical search through the candidates (dashboards) we found on Tableau Next and Tableau Core, so we only need to send the most promising ones to OpenAI. We use BM25 (https://en.wikipedia.org/wiki/Okapi_BM25) over the dashboard's label, the names of its visualizations/sheets, and its field names.
+
+# Words that say nothing about which dashboard we need.
+stopwords = {
+    "a", "about", "all", "an", "and", "any", "are", "as", "at", "be", "by", "can", "could", "did", "do", "does", "for", "from", "give", "has", "have", "how", "i", "in", "is", "it", "its", "me", "much", "my", "of", "on", "or", "our", "please", "show", "tell", "than", "that", "the", "their", "there", "this", "to", "us", "was", "we", "were", "what", "when", "where", "which", "who", "why", "with", "would", "you", "your",
+    "tableau", "next", "cloud", "core", "dashboard", "dashboards", "viz", "vizzes", "visualization", "visualizations", "chart"
+}
+
+# BM25 parameters: the usual defaults.
+bm25_k1 = 1.2
+bm25_b = 0.75
+
+# Reciprocal rank fusion constant: the usual default. Higher values make the top ranks count relatively less.
+rrf_k = 60
+
+# Labels say more about a dashboard than any one of its fields, so their terms count more than once.
+label_weight = 3
+
+def tokenize(text:str) -> list:
+    """
+    Split text into lowercase terms, also splitting snake_case and camelCase names (field names such as "distance_km" or "totalDistance"). Stopwords are removed, and simple plurals are reduced to their singular form so that "runs" matches "run".
+    """
+    if text is None:
+        return []
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text)) # camelCase -> camel Case
+    terms = []
+    for term in re.split(r"[^a-zA-Z0-9]+", text.lower()):
+        if len(term) < 2 or term in stopwords:
+            continue
+        if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
+def candidate_terms(candidate:dict) -> list:
+    """
+    The terms of one candidate in visualizations_for_review: its label (weighted), visualizations and fields.
+    """
+    terms = tokenize(candidate.get("label")) * label_weight
+    for visualization in candidate.get("visualizations", []):
+        terms += tokenize(visualization)
+    for field in candidate.get("fields", []):
+        terms += tokenize(field)
+    return terms
+
+def build_inverted_index(candidates:list) -> dict:
+    """
+    Build an inverted index over a list of candidates (as in visualizations_for_review). Returns a dict with:
+
+    - `postings`: for each term, a dict of candidate index -> term frequency.
+    - `document_lengths`: the number of terms per candidate.
+    - `average_document_length`
+    - `candidates`: the candidates themselves, in their original order.
+    """
+    postings = {}
+    document_lengths = []
+    for candidate_index, candidate in enumerate(candidates):
+        terms = candidate_terms(candidate)
+        document_lengths.append(len(terms))
+        for term in terms:
+            term_postings = postings.setdefault(term, {})
+            term_postings[candidate_index] = term_postings.get(candidate_index, 0) + 1
+
+    return {
+        "postings": postings,
+        "document_lengths": document_lengths,
+        "average_document_length": (sum(document_lengths) / len(document_lengths)) if len(document_lengths) > 0 else 0,
+        "candidates": candidates
+    }
+
+def score_candidates(inverted_index:dict, query_terms:list) -> dict:
+    """
+    Compute the BM25 score of every candidate matching at least one of the query terms. Returns a dict of candidate index -> score.
+    """
+    number_of_candidates = len(inverted_index["candidates"])
+    scores = {}
+    for term in set(query_terms):
+        term_postings = inverted_index["postings"].get(term, {})
+        if len(term_postings) == 0:
+            continue
+        inverse_document_frequency = math.log(1 + (number_of_candidates - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+        for candidate_index, term_frequency in term_postings.items():
+            length_normalization = 1 - bm25_b + bm25_b * inverted_index["document_lengths"][candidate_index] / inverted_index["average_document_length"]
+            scores[candidate_index] = scores.get(candidate_index, 0) + inverse_document_frequency * term_frequency * (bm25_k1 + 1) / (term_frequency + bm25_k1 * length_normalization)
+    return scores
+
+def rank_candidates(question:str, candidates:list, matching_only:bool=False) -> list:
+    """
+    Rank all candidates for a question, best match first. Candidates without any matching term keep their original order, after the ones that do match, unless `matching_only` is set (in which case they are left out).
+    """
+    inverted_index = build_inverted_index(candidates)
+    scores = score_candidates(inverted_index, tokenize(question))
+    candidate_indexes = scores.keys() if matching_only else range(len(candidates))
+    ranked_indexes = sorted(candidate_indexes, key=lambda candidate_index: (-scores.get(candidate_index, 0), candidate_index))
+    return [candidates[candidate_index] for candidate_index in ranked_indexes]
+
+def fuse_rankings(candidates:list, rankings:list, top_n:int) -> list:
+    """
+    Combine several rankings of the same candidates (e.g. lexical and semantic) with reciprocal rank fusion (https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf): each candidate scores 1 / (rrf_k + rank) in every ranking it appears in. Rankings don't need to include every candidate. If the rankings don't add up to top_n candidates, the remaining ones follow in their original order.
+
+    Candidates are identified by their source and id. Returns (at most) top_n candidates.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, candidate in enumerate(ranking, start=1):
+            candidate_key = (candidate.get("source"), candidate.get("id"))
+            scores[candidate_key] = scores.get(candidate_key, 0) + 1 / (rrf_k + rank)
+
+    candidate_indexes = sorted(range(len(candidates)), key=lambda candidate_index: (-scores.get((candidates[candidate_index].get("source"), candidates[candidate_index].get("id")), 0), candidate_index))
+    return [candidates[candidate_index] for candidate_index in candidate_indexes[:top_n]]
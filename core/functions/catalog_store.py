@@ -0,0 +1,134 @@
+# imports - Python/general
+import datetime, threading
+
+# imports - Django
+from django.db import transaction
+from django.utils import timezone
+
+# imports - our app
+# Models
+from core.models import CatalogEntry, CatalogSyncState
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.concurrency as concurrency
+
+# Storage for the catalogs we crawl on Tableau Next and Tableau Core. The platform-specific modules (e.g. core.functions.tableau.next_catalog) decide _what_ to fetch and when; this module only takes care of persisting and reading the entries.
+#
+# The catalogs of both platforms are refreshed at the same time (see core.functions.concurrency), but SQLite allows only one writer at a time, and answers others with "database is locked". So the writes in this process go one at a time, behind store_lock. A refresh that has timed out stops before writing (see concurrency.check_not_timed_out), so it can't overwrite a later one.
+
+store_lock = threading.Lock()
+
+def get_sync_state(platform:str, entity_type:str) -> CatalogSyncState:
+    """
+    Get (or create) the sync state for a platform and entity type. A sync state without last_synced_at has never been synced.
+    """
+    sync_state, sync_state_created = CatalogSyncState.objects.get_or_create(platform=platform, entity_type=entity_type)
+    return sync_state
+
+def is_fresh(platform:str, entity_types:list, max_age_seconds:int) -> bool:
+    """
+    Check whether all entity types of a platform were synced less than max_age_seconds ago.
+    """
+    oldest_allowed = timezone.now() - datetime.timedelta(seconds=max_age_seconds)
+    sync_states = CatalogSyncState.objects.filter(platform=platform, entity_type__in=entity_types, last_synced_at__gte=oldest_allowed)
+    return sync_states.count() == len(entity_types)
+
+def needs_full_sync(sync_state:CatalogSyncState, full_sync_interval_seconds:int) -> bool:
+    """
+    Incremental refreshes only work from a starting point, and cannot always detect everything (e.g. hard deletes). So every now and then, we start over.
+    """
+    if sync_state.last_full_sync_at is None or sync_state.high_water_mark is None:
+        return True
+    return sync_state.last_full_sync_at < timezone.now() - datetime.timedelta(seconds=full_sync_interval_seconds)
+
+def load_entries(platform:str, entity_type:str) -> list:
+    """
+    Return the stored entries for a platform and entity type as a list of dicts, in the same shape they had when we received them from the API.
+    """
+    return list(CatalogEntry.objects.filter(platform=platform, entity_type=entity_type).order_by("id").values_list("data", flat=True))
+
+def store_entries(platform:str, entity_type:str, records:list, id_key:str, modified_key:str=None, full_sync:bool=False, deleted_ids:list=None, deleted_records:list=None) -> dict:
+    """
+    Persist records for a platform and entity type, and update the sync state accordingly.
+
+    - `records`: the records as returned by the API. Each one is stored as-is in CatalogEntry.data.
+    - `id_key`: the key in each record containing its unique ID.
+    - `modified_key`: the key in each record containing its modification timestamp, if any. The most recent one becomes the high water mark for the next incremental refresh.
+    - `full_sync`: when True, `records` is the complete set, and any stored entry not in it is removed.
+    - `deleted_ids`: IDs of entries to remove, e.g. because they are no longer in the API's list of current entities.
+    - `deleted_records`: records the API reported as deleted (e.g. with IsDeleted, from queryAll). They are removed like `deleted_ids`, and their modification timestamps count towards the high water mark as well; otherwise every incremental refresh would get them again.
+
+    Returns a small dict with statistics about what changed.
+    """
+
+    with store_lock:
+        concurrency.check_not_timed_out()
+
+        now = timezone.now()
+        sync_state = get_sync_state(platform, entity_type)
+        high_water_mark = None if full_sync else sync_state.high_water_mark
+
+        catalog_entries = []
+        for record in records:
+            modified_at = parse_modified_at(record.get(modified_key)) if modified_key else None
+            if modified_at is not None and (high_water_mark is None or modified_at > high_water_mark):
+                high_water_mark = modified_at
+            catalog_entries.append(CatalogEntry(platform=platform, entity_type=entity_type, entity_id=record.get(id_key), data=record, modified_at=modified_at, synced_at=now))
+
+        deleted_ids = list(deleted_ids or [])
+        for record in deleted_records or []:
+            modified_at = parse_modified_at(record.get(modified_key)) if modified_key else None
+            if modified_at is not None and (high_water_mark is None or modified_at > high_water_mark):
+                high_water_mark = modified_at
+            deleted_ids.append(record.get(id_key))
+
+        with transaction.atomic():
+            if len(catalog_entries) > 0:
+                CatalogEntry.objects.bulk_create(catalog_entries, batch_size=500, update_conflicts=True, unique_fields=["platform", "entity_type", "entity_id"], update_fields=["data", "modified_at", "synced_at"])
+            if full_sync:
+                deleted_count, deleted_per_model = CatalogEntry.objects.filter(platform=platform, entity_type=entity_type).exclude(synced_at=now).delete()
+            elif deleted_ids:
+                deleted_count, deleted_per_model = CatalogEntry.objects.filter(platform=platform, entity_type=entity_type, entity_id__in=deleted_ids).delete()
+            else:
+                deleted_count = 0
+
+            sync_state.last_synced_at = now
+            if full_sync:
+                sync_state.last_full_sync_at = now
+            # Without modification dates (e.g. REST collections), the time of the sync is the best reference we have.
+            sync_state.high_water_mark = high_water_mark if high_water_mark is not None else now
+            sync_state.save()
+
+        log_and_display_message(f"Stored { len(catalog_entries) } { entity_type } entries for { platform } ({ 'full' if full_sync else 'incremental' } sync), removed { deleted_count }.")
+
+        return {
+            "stored": len(catalog_entries),
+            "deleted": deleted_count,
+            "full_sync": full_sync
+        }
+
+def touch_sync_state(platform:str, entity_type:str) -> None:
+    """
+    Mark an entity type as synced without changing any entries, e.g. when an incremental refresh found nothing new.
+    """
+    with store_lock:
+        concurrency.check_not_timed_out()
+        CatalogSyncState.objects.filter(platform=platform, entity_type=entity_type).update(last_synced_at=timezone.now())
+
+def parse_modified_at(value) -> datetime.datetime | None:
+    """
+    Parse the different timestamp formats we get from Salesforce ("2025-08-13T14:12:00.000+0000") and the Tableau Metadata API ("2025-08-13T14:12:00Z").
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        # Salesforce's +0000 is not understood by fromisoformat in all Python versions, so normalize it first.
+        value = str(value).replace("Z", "+00:00")
+        if len(value) > 5 and value[-5] in ["+", "-"] and value[-3] != ":":
+            value = f"{ value[:-2] }:{ value[-2:] }"
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        log_and_display_message(f"Could not parse modification timestamp \"{ value }\".", level="warning")
+        return None
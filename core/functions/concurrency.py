@@ -0,0 +1,93 @@
+# imports - Python/general
+import threading, time, traceback
+import concurrent.futures
+
+# imports - Django
+from django.db import connection as django_db_connection
+
+# imports - our app
+# Functions
+from tableau_next_question.functions import log_and_display_message
+
+# Helpers to run independent (mostly I/O-bound) calls at the same time, e.g. the different API calls we need to discover content on Tableau Next and Tableau Core.
+#
+# Calls that time out are not waited for, but Python cannot stop a thread. So each call gets an event that is set when it times out, and code that should not run any more after that (e.g. writing to the database; see core.functions.catalog_store) calls check_not_timed_out() first.
+
+# The timed-out event of the call running on the current thread, if any.
+current_call = threading.local()
+
+def check_not_timed_out():
+    """
+    Raise a TimeoutError if the call running on the current thread (through run_concurrently) has timed out, so it stops rather than e.g. writing results nobody waits for anymore.
+    """
+    timed_out_event = getattr(current_call, "timed_out_event", None)
+    if timed_out_event is not None and timed_out_event.is_set():
+        raise TimeoutError("The call timed out; stopping it.")
+
+def run_timed(function, kwargs:dict, timed_out_event:threading.Event=None) -> dict:
+    """
+    Run a function with its kwargs and time it. Errors are caught and returned rather than raised, so one failing call does not affect the others. `timed_out_event` is what check_not_timed_out() checks while the function runs.
+    """
+    start = time.perf_counter()
+    current_call.timed_out_event = timed_out_event
+    try:
+        result = function(**kwargs)
+        error = None
+    except Exception as e:
+        result = None
+        error = e
+        log_and_display_message(f"Error in concurrent call to { function.__name__ }:\n\t{e}\n\t{traceback.format_exc()}", level="error")
+    finally:
+        current_call.timed_out_event = None
+        # Django opens a database connection per thread, which would otherwise stay open after the thread is done.
+        django_db_connection.close()
+    return {
+        "result": result,
+        "error": error,
+        "seconds": time.perf_counter() - start,
+        "timed_out": False
+    }
+
+def run_concurrently(calls:dict, max_workers:int=4, timeout:float=None, description:str="concurrent calls") -> dict:
+    """
+    Run a number of independent calls concurrently in a thread pool, and wait for all of them (or until `timeout` seconds have passed).
+
+    `calls` is a dict with a name for each call, and a tuple with the function and its kwargs:
+
+    ```
+    {
+        "dashboards": (tableau_next_api.get_entities_through_soql, { "connection": connection_dict, "entity_type": "AnalyticsDashboard" }),
+        ...
+    }
+    ```
+
+    Returns a dict with the same names, and for each of them a dict with "result", "error" (None if successful), "seconds" and "timed_out". Calls that are still running when the timeout passes are reported as timed out with a TimeoutError, and are not waited for (but can no longer write to the catalog store).
+    """
+
+    call_outcomes = {}
+    start = time.perf_counter()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(calls))), thread_name_prefix="tnq")
+    timed_out_events = { name: threading.Event() for name in calls }
+    futures = { executor.submit(run_timed, function, kwargs, timed_out_events[name]): name for name, (function, kwargs) in calls.items() }
+    done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+
+    for future in done:
+        call_outcomes[futures[future]] = future.result()
+    for future in not_done:
+        future.cancel()
+        timed_out_events[futures[future]].set()
+        call_outcomes[futures[future]] = {
+            "result": None,
+            "error": TimeoutError(f"{ futures[future] } did not complete within { timeout } seconds."),
+            "seconds": time.perf_counter() - start,
+            "timed_out": True
+        }
+    # Don't wait for calls that timed out; they finish (or fail) in the background, and stop at the next check_not_timed_out().
+    executor.shutdown(wait=len(not_done) == 0, cancel_futures=True)
+
+    wall_clock_seconds = time.perf_counter() - start
+    timings = ", ".join([f"{ name }: { outcome['seconds']:.2f}s{ ' (timed out)' if outcome['timed_out'] else ' (failed)' if outcome['error'] is not None else '' }" for name, outcome in call_outcomes.items()])
+    log_and_display_message(f"Ran { len(calls) } { description } in { wall_clock_seconds:.2f}s (sum of calls: { sum(outcome['seconds'] for outcome in call_outcomes.values()):.2f}s). { timings }")
+
+    return { name: call_outcomes[name] for name in calls } # Same order as the calls
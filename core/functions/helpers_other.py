@@ -1,4 +1,5 @@
-import re, unicodedata
+import re, unicodedata, time, threading
+import collections
 
 def slugify(value, allow_unicode=False):
     """
@@ -94,3 +95,60 @@ def to_bool(value):
             return False
 
     return False
+
+class TTLLRUCache:
+    """
+    A cache in this process's memory, holding at most max_entries values for at most ttl_seconds each. When it is full, the least recently used value makes way. Safe to use from several threads.
+
+    With max_entries or ttl_seconds at 0, nothing is kept.
+    """
+
+    def __init__(self, max_entries:int, ttl_seconds:float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict() # key -> (stored_at, value), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        The value for the key, or default if there is none (or it expired).
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Store the value for the key, removing the least recently used values if the cache is full.
+        """
+        if self.max_entries <= 0 or self.ttl_seconds <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_statistics(self) -> dict:
+        """
+        The number of values in the cache, and of hits and misses since the process started.
+        """
+        with self.lock:
+            return { "entries": len(self.entries), "hits": self.hits, "misses": self.misses }
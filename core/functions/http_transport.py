@@ -0,0 +1,187 @@
+# imports - Python/general
+import time, threading, asyncio
+import urllib.parse, email.utils
+import requests, httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# imports - Django
+from django.conf import settings
+
+# imports - our app
+# Functions
+from tableau_next_question.functions import log_and_display_message
+
+# The HTTP transport shared by our API modules (Tableau Next, the Tableau REST API and the Metadata API): sessions with a pool of kept-alive connections per host, default connect/read timeouts, and retries with exponential backoff when an API tells us to slow down (429) or is temporarily unavailable (503), honoring its Retry-After header. We also keep count of requests, retries and latency per host.
+#
+# The async variants of the API modules (e.g. core.functions.tableau.next_api_async) use an httpx.AsyncClient with the same timeouts, pool sizes and retry policy; see create_async_client.
+
+retry_status_codes = (429, 503)
+
+# Per host: { "requests": ..., "errors": ..., "retries": ..., "total_seconds": ..., "max_seconds": ... }
+host_statistics = {}
+host_statistics_lock = threading.Lock()
+
+def record_host_statistic(host:str, **increments):
+    """
+    Add to the counters of a host. "max_seconds" is kept as a maximum rather than a sum.
+    """
+    with host_statistics_lock:
+        statistics = host_statistics.setdefault(host, { "requests": 0, "errors": 0, "retries": 0, "total_seconds": 0.0, "max_seconds": 0.0 })
+        for key, value in increments.items():
+            if key == "max_seconds":
+                statistics[key] = max(statistics[key], value)
+            else:
+                statistics[key] += value
+
+class CountingRetry(Retry):
+    """
+    urllib3's Retry, counting the retries per host.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if _pool is not None:
+            record_host_statistic(_pool.host, retries=1)
+            log_and_display_message(f"Retrying { method } request to { _pool.host }{ url } ({ f'status { response.status }' if response is not None else error }).", level="warning")
+        return super().increment(method=method, url=url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+class TransportAdapter(HTTPAdapter):
+    """
+    HTTPAdapter with a default timeout for requests that don't specify one, which also records the latency of every request per host.
+    """
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (settings.TNQ_HTTP_CONNECT_TIMEOUT_SECONDS, settings.TNQ_HTTP_READ_TIMEOUT_SECONDS)
+        host = urllib.parse.urlsplit(request.url).hostname
+        start = time.perf_counter()
+        try:
+            response = super().send(request, timeout=timeout, **kwargs)
+        except Exception:
+            record_host_statistic(host, requests=1, errors=1)
+            raise
+        seconds = time.perf_counter() - start
+        record_host_statistic(host, requests=1, errors=0 if response.ok else 1, total_seconds=seconds, max_seconds=seconds)
+        return response
+
+def build_retry() -> Retry:
+    """
+    The retry policy: retry on connection errors and on 429/503, with exponential backoff (unless Retry-After says otherwise). These apply to POST requests too: 429 and 503 mean the request was not processed, and a connection that could not be made never sent it. Read errors are not retried, as we can't know whether a (non-idempotent) request was processed.
+    """
+    return CountingRetry(
+        total=settings.TNQ_HTTP_MAX_RETRIES,
+        connect=settings.TNQ_HTTP_MAX_RETRIES,
+        read=0,
+        status=settings.TNQ_HTTP_MAX_RETRIES,
+        status_forcelist=retry_status_codes,
+        allowed_methods=None, # Any method
+        backoff_factor=settings.TNQ_HTTP_BACKOFF_FACTOR,
+        respect_retry_after_header=True,
+        raise_on_status=False # Return the last response, so the callers' own error handling applies
+    )
+
+def create_session() -> requests.Session:
+    """
+    Create a requests.Session using our transport. Use one per set of credentials (e.g. per connection dict), and reuse it.
+    """
+    adapter = TransportAdapter(pool_connections=settings.TNQ_HTTP_POOL_CONNECTIONS, pool_maxsize=settings.TNQ_HTTP_POOL_MAXSIZE, max_retries=build_retry())
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# For requests that don't belong to a connection (e.g. getting a token). Don't set credentials on its headers; pass them per request.
+shared_session = create_session()
+
+def get_host_statistics() -> dict:
+    """
+    A copy of the counters per host, including the average latency.
+    """
+    with host_statistics_lock:
+        return { host: { **statistics, "average_seconds": statistics["total_seconds"] / statistics["requests"] if statistics["requests"] > 0 else 0 } for host, statistics in host_statistics.items() }
+
+def log_host_statistics():
+    """
+    Log the counters per host (since the process started).
+    """
+    for host, statistics in get_host_statistics().items():
+        log_and_display_message(f"HTTP { host }: { statistics['requests'] } requests, { statistics['retries'] } retries, { statistics['errors'] } errors, { statistics['average_seconds']:.2f}s average, { statistics['max_seconds']:.2f}s max.")
+
+# Async transport #
+# --------------- #
+
+def get_retry_after_seconds(response:httpx.Response, attempt:int) -> float:
+    """
+    How long to wait before retrying: what the Retry-After header says (in seconds, or as an HTTP date), or exponential backoff as urllib3 does it.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return 0.0 if attempt == 0 else settings.TNQ_HTTP_BACKOFF_FACTOR * (2 ** attempt)
+
+class RetryingAsyncTransport(httpx.AsyncHTTPTransport):
+    """
+    httpx's AsyncHTTPTransport, retrying on 429/503 like build_retry() does for requests, and recording the latency of every request per host. Connection errors are retried by httpx itself (see `retries` in create_async_client).
+    """
+
+    async def handle_async_request(self, request:httpx.Request) -> httpx.Response:
+        host = request.url.host
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = await super().handle_async_request(request)
+            except Exception:
+                record_host_statistic(host, requests=1, errors=1)
+                raise
+            seconds = time.perf_counter() - start
+            record_host_statistic(host, requests=1, errors=0 if response.status_code < 400 else 1, total_seconds=seconds, max_seconds=seconds)
+            if response.status_code not in retry_status_codes or attempt >= settings.TNQ_HTTP_MAX_RETRIES:
+                return response
+            # Return the last response, so the callers' own error handling applies. The ones before it, we don't need.
+            await response.aclose()
+            record_host_statistic(host, retries=1)
+            log_and_display_message(f"Retrying { request.method } request to { host }{ request.url.path } (status { response.status_code }).", level="warning")
+            await asyncio.sleep(get_retry_after_seconds(response, attempt))
+            attempt += 1
+
+class ReauthenticatingAuth(httpx.Auth):
+    """
+    Retry a request once when the API rejects its credentials (401), with the credentials `refresh` gets us. `refresh` is an async function taking the rejected header value and returning a new one (or None if there is none).
+    """
+
+    def __init__(self, header_name:str, refresh):
+        self.header_name = header_name
+        self.refresh = refresh
+
+    async def async_auth_flow(self, request:httpx.Request):
+        response = yield request
+        if response.status_code != 401:
+            return
+        new_header_value = await self.refresh(request.headers.get(self.header_name))
+        if not new_header_value:
+            return
+        request.headers[self.header_name] = new_header_value
+        yield request
+
+def create_async_client(headers:dict=None, auth:httpx.Auth=None) -> httpx.AsyncClient:
+    """
+    Create an httpx.AsyncClient using our transport. As with create_session, use one per set of credentials and reuse it; close it (with `await client.aclose()`) when done.
+    """
+    transport = RetryingAsyncTransport(
+        limits=httpx.Limits(max_connections=settings.TNQ_HTTP_POOL_CONNECTIONS * settings.TNQ_HTTP_POOL_MAXSIZE, max_keepalive_connections=settings.TNQ_HTTP_POOL_MAXSIZE),
+        retries=settings.TNQ_HTTP_MAX_RETRIES # Connection errors only
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(settings.TNQ_HTTP_READ_TIMEOUT_SECONDS, connect=settings.TNQ_HTTP_CONNECT_TIMEOUT_SECONDS),
+        headers=headers,
+        auth=auth,
+        follow_redirects=True # As requests does
+    )
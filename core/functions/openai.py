@@ -1,5 +1,5 @@
 # imports - Python/general
-import json, markdown, base64, typing
+import json, markdown, base64, typing, threading, hashlib, copy
 import traceback
 import openai as openai_client
 import pandas as pd
@@ -7,6 +7,8 @@ import pandas as pd
 from openai.types.beta.assistant import Assistant
 
 # imports - Django
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.base_user import AbstractBaseUser
 
 # imports - our app
@@ -15,6 +17,7 @@ from core.models import OpenAISettings
 # Functions
 from tableau_next_question.functions import log_and_display_message
 import core.functions.helpers_other as helpers_other
+import core.functions.cached_settings as cached_settings
 
 # Module containing functions for interacting with OpenAI. Mostly related to the Portal, and how _it_ interacts with the VizQL Data Service, for now.
 
@@ -24,9 +27,24 @@ def generate_vizql_ds_query(question:str, data_model:list, user:AbstractBaseUser
 
 def get_openai_api_settings() -> OpenAISettings:
     """
-    Get the OpenAI API settings for the organization of the user, or the first organization if no user is provided.
+    Get the OpenAI API settings for the organization of the user, or the first organization if no user is provided. Cached in this process; see core.functions.cached_settings.
     """
-    return OpenAISettings.objects.first()
+    return cached_settings.get_first(OpenAISettings)
+
+# One client per API key, reused for every call in this process (and with it, its connections to the API).
+openai_clients = {}
+openai_clients_lock = threading.Lock()
+
+def get_openai_client(openai_settings:OpenAISettings) -> openai_client.OpenAI:
+    """
+    Get the (shared) OpenAI client for the API key in the settings.
+    """
+    with openai_clients_lock:
+        client = openai_clients.get(openai_settings.api_key)
+        if client is None:
+            client = openai_client.OpenAI(api_key=openai_settings.api_key)
+            openai_clients[openai_settings.api_key] = client
+        return client
 
 def assistant_has_tool(assistant:Assistant, tool_type:str) -> bool:
     """
@@ -54,13 +72,13 @@ def find_openai_assistant(assistant_name:str, assistant_tool_types:list=[], assi
     """
 
     openai_settings = get_openai_api_settings()
-    openai_client.api_key = openai_settings.api_key
+    client = get_openai_client(openai_settings)
 
     cursor = None
     while True:
 
         try:
-            assistants = openai_client.beta.assistants.list(after=cursor)
+            assistants = client.beta.assistants.list(after=cursor)
             for assistant in assistants.data:
                 # Check if the assistant matches the name, tools, and model
                 if assistant.name == assistant_name:
@@ -82,7 +100,21 @@ def find_openai_assistant(assistant_name:str, assistant_tool_types:list=[], assi
 
     return None
 
-def openai_api_chat_completion(user_prompt:str, system_prompt:str, user:AbstractBaseUser=None, response_format:typing.Any="text", max_tokens:int=0) -> str:
+# Responses of openai_api_chat_completion, by a hash of everything that determines them (see get_chat_completion_cache_key). The same popular questions about the same catalog make for the same requests, and asking again would cost the same tokens for (nearly) the same answer.
+chat_completion_cache = helpers_other.TTLLRUCache(max_entries=settings.TNQ_OPENAI_RESPONSE_CACHE_SIZE, ttl_seconds=settings.TNQ_OPENAI_RESPONSE_CACHE_SECONDS)
+
+def get_chat_completion_cache_key(model:str, system_prompt:str, user_prompt:str, response_format:typing.Any, max_tokens:int) -> str:
+    """
+    A hash of the model, prompts, and response format (for a pydantic BaseModel: its name and JSON schema) of a chat completion request.
+    """
+    if response_format == "text":
+        response_format_key = { "format": "text", "max_tokens": max_tokens }
+    else:
+        response_format_key = { "format": f"{ response_format.__module__ }.{ response_format.__qualname__ }", "schema": response_format.model_json_schema() }
+    request_key = json.dumps({ "model": model, "system_prompt": system_prompt, "user_prompt": user_prompt, "response_format": response_format_key }, sort_keys=True, default=str)
+    return hashlib.sha256(request_key.encode("utf-8")).hexdigest()
+
+def openai_api_chat_completion(user_prompt:str, system_prompt:str, user:AbstractBaseUser=None, response_format:typing.Any="text", max_tokens:int=0, tokens_saved:int=0, use_cache:bool=True) -> str:
     """
     Send a prompt to the OpenAI API and return the response.
 
@@ -96,6 +128,10 @@ def openai_api_chat_completion(user_prompt:str, system_prompt:str, user:Abstract
     response_format: The format of the response. Can be "text" or a pydantic BaseModel. See: https://platform.openai.com/docs/guides/structured-outputs?api-mode=chat&lang=python
 
     max_tokens: The maximum number of tokens to generate in the response. Defaults to the organization's setting, but can be overridden by passing a value here.
+
+    tokens_saved: The (estimated) number of prompt tokens the caller saved by compacting the prompt, only used to report in the log.
+
+    use_cache: Whether to return the response to an identical earlier request, if we have it (for TNQ_OPENAI_RESPONSE_CACHE_SECONDS). Set to False when a fresh response is needed.
     """
 
     try:
@@ -106,14 +142,22 @@ def openai_api_chat_completion(user_prompt:str, system_prompt:str, user:Abstract
         if max_tokens <= 0:
             max_tokens = openai_settings.max_completion_tokens
 
-        openai_client.api_key = openai_settings.api_key
+        cache_key = get_chat_completion_cache_key(openai_settings.preferred_model, system_prompt, user_prompt, response_format, max_tokens)
+        if use_cache:
+            cached_response = chat_completion_cache.get(cache_key)
+            if cached_response is not None:
+                log_and_display_message(f"[openai_api_chat_completion] Cache hit with model { openai_settings.preferred_model }: no tokens used; the original response used { cached_response['total_tokens'] } total{ f'; about { tokens_saved } prompt tokens saved by compacting the prompt' if tokens_saved > 0 else '' }", level="info")
+                # A copy, so callers changing a parsed response don't change the cached one.
+                return copy.deepcopy(cached_response["content"])
+
+        client = get_openai_client(openai_settings)
 
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ]
         if response_format == "text":
-            response = openai_client.chat.completions.create(
+            response = client.chat.completions.create(
                 model=openai_settings.preferred_model,
                 messages=messages,
                 max_completion_tokens=max_tokens,
@@ -121,14 +165,17 @@ def openai_api_chat_completion(user_prompt:str, system_prompt:str, user:Abstract
             response_content = response.choices[0].message.content
         else:
             # Leaving out max_tokens as structured output may be significantly larger than the max_tokens setting.
-            response = openai_client.beta.chat.completions.parse(
+            response = client.beta.chat.completions.parse(
                 model=openai_settings.preferred_model,
                 messages=messages,
                 response_format=response_format,
             )
             response_content = response.choices[0].message.parsed
 
-        log_and_display_message(f"[openai_api_chat_completion] Tokens used with model { openai_settings.preferred_model }: { response.usage.prompt_tokens } for prompt, { response.usage.completion_tokens } for completion; { response.usage.total_tokens } total", level="info")
+        log_and_display_message(f"[openai_api_chat_completion] Tokens used with model { openai_settings.preferred_model }: { response.usage.prompt_tokens } for prompt, { response.usage.completion_tokens } for completion; { response.usage.total_tokens } total{ f'; about { tokens_saved } prompt tokens saved by compacting the prompt' if tokens_saved > 0 else '' }", level="info")
+
+        if response_content is not None:
+            chat_completion_cache.set(cache_key, { "content": copy.deepcopy(response_content), "total_tokens": response.usage.total_tokens })
 
         return response_content
 
@@ -138,6 +185,40 @@ def openai_api_chat_completion(user_prompt:str, system_prompt:str, user:Abstract
         log_and_display_message(message=message, level="error")
         raise Exception(message)
 
+def openai_api_embeddings(texts:list, model:str=None, batch_size:int=500) -> list:
+    """
+    Get embeddings for a list of texts from the OpenAI API. Returns a list of embeddings (lists of floats), in the same order as the texts.
+
+    model: The embedding model to use. Defaults to the organization's setting.
+
+    batch_size: How many texts we send per request. The API accepts up to 2048 inputs per request, but that also makes for large requests.
+    """
+
+    try:
+
+        openai_settings = get_openai_api_settings()
+
+        if model is None:
+            model = openai_settings.embedding_model
+
+        client = get_openai_client(openai_settings)
+
+        embeddings = []
+        total_tokens = 0
+        for batch_start in range(0, len(texts), batch_size):
+            response = client.embeddings.create(model=model, input=texts[batch_start:batch_start + batch_size])
+            embeddings += [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            total_tokens += response.usage.total_tokens
+
+        log_and_display_message(f"[openai_api_embeddings] Tokens used with model { model }: { total_tokens } for { len(texts) } texts", level="info")
+
+        return embeddings
+
+    except Exception as e:
+        message = f"Something went wrong handling this request to the OpenAI API:\n\t{e}\n\t{traceback.format_exc()}"
+        log_and_display_message(message=message, level="error")
+        raise Exception(message)
+
 def analyze_dataset(data:dict, question:str, user:AbstractBaseUser, output_format:str="") -> str:
     """
     Pass a dict/JSON data set to the OpenAI API, using chatcompletion to comment on a data set.
@@ -186,7 +267,17 @@ def analyze_dataset(data:dict, question:str, user:AbstractBaseUser, output_forma
         log_and_display_message(message=message, level="error")
         raise Exception(message)
 
-def comment_on_dashboard_file(file_bytes:bytes, file_format:str, custom_prompt:str="", max_response_words:int=None, convert_to_html:bool=False, convert_to_slack_markdown:bool=True) -> str:
+# Answers of comment_on_dashboard_file, by the image (SHA-256 of its bytes), the (normalized) prompt and the model; see get_dashboard_comment_cache_key. While a dashboard's image doesn't change, the same question about it gets the same answer. They are kept in Django's cache (in the database, see CACHES in settings), so the web process and all workers share them. The answers expire TNQ_VISION_CACHE_SECONDS after we first got them for the image, rather than after they were last used: an image Tableau keeps serving unchanged for long may well be a stale render, and we'd rather ask again about a fresh one.
+dashboard_comment_cache_key_prefix = "tnq:vision_answer:"
+
+def get_dashboard_comment_cache_key(file_hash:str, file_format:str, prompt:str, model:str, max_response_words:int, image_detail:str) -> str:
+    """
+    A key for the image (its hash, format and detail level), the prompt (ignoring case and whitespace), the model, and the maximum response length.
+    """
+    normalized_prompt = " ".join(prompt.lower().split())
+    return dashboard_comment_cache_key_prefix + hashlib.sha256(json.dumps([file_hash, file_format, image_detail, normalized_prompt, model, max_response_words]).encode("utf-8")).hexdigest()
+
+def comment_on_dashboard_file(file_bytes:bytes, file_format:str, custom_prompt:str="", max_response_words:int=None, convert_to_html:bool=False, convert_to_slack_markdown:bool=True, on_partial_response:typing.Callable[[str], None]=None, use_cache:bool=True, image_detail:str="high") -> str:
     """
     Upload a dashboard image or PDF to OpenAI and ask for comments. file_format can be "png", "jpg", or "pdf".
     
@@ -195,6 +286,12 @@ def comment_on_dashboard_file(file_bytes:bytes, file_format:str, custom_prompt:s
     "Can you comment on the data in this dashboard? No need for a general description of the dashboard, but focus on the insights, commentary, and suggestions related to the data."
 
     The max response length can also be set, but defaults to the organization's setting if not provided.
+
+    With on_partial_response, the response is streamed: the function is called with the (unformatted) response so far every time a part of it comes in, e.g. to show it while it is being written. The formatted response is still returned at the end.
+
+    The answer to the same prompt about the same file is reused (see get_dashboard_comment_cache_key), unless use_cache is False. A reused answer is returned right away, without calling on_partial_response.
+
+    image_detail is the detail level ("low" or "high") OpenAI looks at an image with; see core.functions.vision_images.
     """
 
     openai_settings = get_openai_api_settings()
@@ -204,10 +301,7 @@ def comment_on_dashboard_file(file_bytes:bytes, file_format:str, custom_prompt:s
 
     try:
 
-        openai_client.api_key = openai_settings.api_key
-
         file_image_formats = ["png", "jpg", "jpeg"]
-        file_base64 = base64.b64encode(file_bytes).decode("utf-8")
         file_content_type = f"image/{file_format}" if file_format in file_image_formats else f"application/{file_format}"
         file_reference = f"dashboard.{file_format}"
 
@@ -216,41 +310,15 @@ def comment_on_dashboard_file(file_bytes:bytes, file_format:str, custom_prompt:s
 
         custom_prompt += f"\n\nThe file is in { file_format } format, the file name is { file_reference }."
 
-        content_message_file = {}
-        if file_format in file_image_formats:
-            content_message_file = { 
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/png;base64, { file_base64 }",
-                    "detail": "high"
-                }
-            }
+        file_hash = hashlib.sha256(file_bytes).hexdigest()
+        cache_key = get_dashboard_comment_cache_key(file_hash, file_format, custom_prompt, openai_settings.preferred_model, max_response_words, image_detail)
+        cached_response = cache.get(cache_key) if use_cache and settings.TNQ_VISION_CACHE_SECONDS > 0 else None
+        if cached_response is not None:
+            log_and_display_message(f"[comment_on_dashboard_file] Cache hit with model { openai_settings.preferred_model } for file { file_hash[:12] }: no tokens used; the original response used { cached_response['total_tokens'] if cached_response['total_tokens'] is not None else 'an unknown number of' } total", level="info")
+            response_content = cached_response["content"]
         else:
-            content_message_file = { 
-                "type": "file",
-                "file": {
-                    "filename": file_reference,
-                    "file_data": f"data:{ file_content_type };base64, { file_base64 }"
-                }
-            }
-        
-        # Call the OpenAI API to analyze the dataset
-        response = openai_client.chat.completions.create(
-            model=openai_settings.preferred_model,
-            messages=[
-                { 
-                    "role": "user",
-                    "content": [
-                        content_message_file,
-                        { "type": "text", "text": custom_prompt }
-                    ]
-                }
-            ],
-            max_tokens=max_response_words,
-            temperature=0.5
-        )
+            response_content = request_dashboard_comment(openai_settings, file_bytes, file_format, file_content_type, file_reference, custom_prompt, max_response_words, on_partial_response, cache_key, image_detail=image_detail)
 
-        response_content = response.choices[0].message.content
         if convert_to_html:
             try:
                 response_content_formated = markdown.markdown(text=response_content, output_format="html")
@@ -261,8 +329,6 @@ def comment_on_dashboard_file(file_bytes:bytes, file_format:str, custom_prompt:s
         else:
             response_content_formated = response_content
 
-        log_and_display_message(f"[comment_on_dashboard_file] Tokens used with model { openai_settings.preferred_model }: { response.usage.prompt_tokens } for prompt, { response.usage.completion_tokens } for completion; { response.usage.total_tokens } total", level="info")
-        
         return response_content_formated
 
     except Exception as e:
@@ -270,3 +336,68 @@ def comment_on_dashboard_file(file_bytes:bytes, file_format:str, custom_prompt:s
         message = f"Something went wrong handling this request to the OpenAI API:\n\t{e}\n\t{traceback.format_exc()}"
         log_and_display_message(message=message, level="error")
         raise Exception(message)
+
+def request_dashboard_comment(openai_settings:OpenAISettings, file_bytes:bytes, file_format:str, file_content_type:str, file_reference:str, custom_prompt:str, max_response_words:int, on_partial_response:typing.Callable[[str], None], cache_key:str, image_detail:str="high") -> str:
+    """
+    The OpenAI API call of comment_on_dashboard_file: send the file with the prompt, and return the (unformatted) response, which is also stored in Django's cache under cache_key.
+    """
+
+    file_base64 = base64.b64encode(file_bytes).decode("utf-8")
+
+    content_message_file = {}
+    if file_content_type.startswith("image/"):
+        content_message_file = { 
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/png;base64, { file_base64 }",
+                "detail": image_detail
+            }
+        }
+    else:
+        content_message_file = { 
+            "type": "file",
+            "file": {
+                "filename": file_reference,
+                "file_data": f"data:{ file_content_type };base64, { file_base64 }"
+            }
+        }
+    
+    # Call the OpenAI API to analyze the dataset
+    completion_arguments = dict(
+        model=openai_settings.preferred_model,
+        messages=[
+            { 
+                "role": "user",
+                "content": [
+                    content_message_file,
+                    { "type": "text", "text": custom_prompt }
+                ]
+            }
+        ],
+        max_tokens=max_response_words,
+        temperature=0.5
+    )
+
+    client = get_openai_client(openai_settings)
+
+    if on_partial_response is None:
+        response = client.chat.completions.create(**completion_arguments)
+        response_content = response.choices[0].message.content
+        usage = response.usage
+    else:
+        response_content = ""
+        usage = None
+        for chunk in client.chat.completions.create(**completion_arguments, stream=True, stream_options={ "include_usage": True }):
+            if chunk.usage is not None: # Only in the last chunk
+                usage = chunk.usage
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                response_content += chunk.choices[0].delta.content
+                on_partial_response(response_content)
+
+    if usage is not None:
+        log_and_display_message(f"[comment_on_dashboard_file] Tokens used with model { openai_settings.preferred_model }: { usage.prompt_tokens } for prompt, { usage.completion_tokens } for completion; { usage.total_tokens } total", level="info")
+
+    if response_content and settings.TNQ_VISION_CACHE_SECONDS > 0:
+        cache.set(cache_key, { "content": response_content, "total_tokens": usage.total_tokens if usage is not None else None }, timeout=settings.TNQ_VISION_CACHE_SECONDS)
+
+    return response_content
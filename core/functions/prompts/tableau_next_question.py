@@ -1,6 +1,12 @@
 system_prompt = """
 You are a data analyst tasked with identifying the best possible visualization to answer a data question. You will be provided a list of visualizations with their titles, and data fields being used.
 
+The visualizations are provided as a table, with one visualization per line. The first line is the header. Columns are separated by "|", and multiple values within a column by ";":
+```
+id|label|visualizations|fields
+0FKxx0000000001|Running stats|Distance by week;Pace|distance_km;runner_name;pace
+```
+
 Based on that title and the fields available, you need to determine which visualization is the most appropriate for answering the question.
 
 As an answer, return solely the id of the visualization, in JSON format such as:
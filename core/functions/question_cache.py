@@ -0,0 +1,103 @@
+# imports - Python/general
+import datetime, hashlib
+import numpy as np
+
+# imports - Django
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+# imports - our app
+# Models
+from core.models import QuestionCacheEntry
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.catalog_embeddings as catalog_embeddings
+
+# Many questions are paraphrases of earlier ones ("km run by team last month" vs. "how far did the team run"), and would end up with the same visualization after crawling the catalog and asking OpenAI to select one. So we remember which visualization we selected for which question, by the question's embedding:
+#
+# - A new question whose embedding is at least TNQ_QUESTION_CACHE_SIMILARITY (cosine) similar to that of an earlier question reuses its selection.
+# - With each selection, we keep a hash of the selected candidate's text (label, visualizations and fields; see catalog_embeddings.candidate_text). If the candidate changed in the catalog since, or is gone, the selection is forgotten and we select again.
+# - Selections expire after TNQ_QUESTION_CACHE_SECONDS, and we keep at most TNQ_QUESTION_CACHE_SIZE of them (the least recently used make way).
+
+def candidate_hash(candidate:dict) -> str:
+    """
+    The hash of a candidate (from visualizations_for_review) that tells us whether it changed. The same hash as in the catalog index.
+    """
+    return hashlib.sha256(catalog_embeddings.candidate_text(candidate).encode("utf-8")).hexdigest()
+
+def embed_question(question:str, embedder) -> np.ndarray:
+    """
+    The question's embedding, with unit length.
+    """
+    return catalog_embeddings.normalize_rows(np.asarray(embedder.embed([question]), dtype=np.float32))[0]
+
+def find_selection(question_vector:np.ndarray, embedder_name:str, platforms:list) -> QuestionCacheEntry | None:
+    """
+    The (unexpired) selection of the earlier question most similar to this one, on one of the platforms, if it is similar enough. Its similarity is set as `similarity`.
+    """
+    if settings.TNQ_QUESTION_CACHE_SECONDS <= 0 or len(platforms) == 0:
+        return None
+
+    question_cache_entries = list(QuestionCacheEntry.objects.filter(embedder=embedder_name, platform__in=platforms, expires_at__gte=timezone.now()))
+    if len(question_cache_entries) == 0:
+        return None
+
+    matrix = np.stack([np.frombuffer(bytes(question_cache_entry.embedding), dtype=np.float32) for question_cache_entry in question_cache_entries])
+    if matrix.shape[1] != question_vector.shape[0]:
+        return None
+    similarities = matrix @ question_vector
+    best_row = int(np.argmax(similarities))
+    if similarities[best_row] < settings.TNQ_QUESTION_CACHE_SIMILARITY:
+        log_and_display_message(f"No earlier question is similar enough to reuse its selection (best: { float(similarities[best_row]):.3f}, needed: { settings.TNQ_QUESTION_CACHE_SIMILARITY }).")
+        return None
+
+    question_cache_entry = question_cache_entries[best_row]
+    question_cache_entry.similarity = float(similarities[best_row])
+    log_and_display_message(f"The question is { question_cache_entry.similarity:.3f} similar to the earlier \"{ question_cache_entry.question }\", for which we selected { question_cache_entry.entity_id } on { question_cache_entry.platform }.")
+    return question_cache_entry
+
+def is_unchanged(question_cache_entry:QuestionCacheEntry, candidate:dict) -> bool:
+    """
+    Whether the candidate is (still) the one we selected: the same, and unchanged since.
+    """
+    return candidate is not None and candidate.get("id") == question_cache_entry.entity_id and candidate_hash(candidate) == question_cache_entry.content_hash
+
+def record_hit(question_cache_entry:QuestionCacheEntry):
+    """
+    Count that a selection was reused, which also keeps it from making way for others.
+    """
+    QuestionCacheEntry.objects.filter(id=question_cache_entry.id).update(hits=F("hits") + 1, last_used_at=timezone.now())
+
+def forget_selection(question_cache_entry:QuestionCacheEntry, reason:str):
+    """
+    Remove a selection we can no longer reuse, e.g. because the candidate changed.
+    """
+    log_and_display_message(f"Forgetting the selection of { question_cache_entry.entity_id } on { question_cache_entry.platform } for \"{ question_cache_entry.question }\": { reason }.")
+    QuestionCacheEntry.objects.filter(id=question_cache_entry.id).delete()
+
+def save_selection(question:str, question_vector:np.ndarray, embedder_name:str, candidate:dict) -> QuestionCacheEntry | None:
+    """
+    Remember the candidate we selected for the question. Expired selections, and the least recently used ones beyond TNQ_QUESTION_CACHE_SIZE, are cleaned up along the way.
+    """
+    if settings.TNQ_QUESTION_CACHE_SECONDS <= 0 or settings.TNQ_QUESTION_CACHE_SIZE <= 0:
+        return None
+
+    now = timezone.now()
+    QuestionCacheEntry.objects.filter(expires_at__lt=now).delete()
+    question_cache_entry = QuestionCacheEntry.objects.create(
+        question=question,
+        embedder=embedder_name,
+        embedding=np.asarray(question_vector, dtype=np.float32).tobytes(),
+        platform=candidate.get("source"),
+        entity_id=candidate.get("id"),
+        content_hash=candidate_hash(candidate),
+        created_at=now,
+        last_used_at=now,
+        expires_at=now + datetime.timedelta(seconds=settings.TNQ_QUESTION_CACHE_SECONDS)
+    )
+
+    ids_to_keep = QuestionCacheEntry.objects.order_by("-last_used_at", "-id").values_list("id", flat=True)[:settings.TNQ_QUESTION_CACHE_SIZE]
+    QuestionCacheEntry.objects.exclude(id__in=list(ids_to_keep)).delete()
+
+    return question_cache_entry
@@ -1,5 +1,5 @@
 # imports - Python/general
-import re, requests, json
+import re, requests, json, time, threading
 import traceback
 import slack_sdk
 import urllib.parse
@@ -15,12 +15,20 @@ from core.models import SlackCredential
 # Functions
 from tableau_next_question.functions import log_and_display_message
 import core.functions.helpers_other as helpers_other
+import core.functions.cached_settings as cached_settings
+import core.functions.slack_dispatch as slack_dispatch
 
 # Our app to Slack #
 # ################## #
 
 # Functions for interacting with Slack
 
+def get_slack_credential(create:bool=False) -> SlackCredential:
+    """
+    The Slack credentials we use (the first ones), cached in this process; see core.functions.cached_settings. With `create`, empty ones are created if there are none.
+    """
+    return cached_settings.get_first(SlackCredential, create=create)
+
 def check_slack_credentials(slack_credentials:SlackCredential) -> SlackCredential | str | None:
     """
     Connects to Slack to verify the validity of stored Slack Credentials. Returns the same SlackCredential object if successful. If no credentials exist, it returns None. But if credentials exist and they yield an error message, that error is returned.
@@ -28,7 +36,7 @@ def check_slack_credentials(slack_credentials:SlackCredential) -> SlackCredentia
     log_and_display_message(f"Checking Slack App credentials validity for { slack_credentials.slack_app }.")
 
     try:
-        slack_webclient = slack_sdk.WebClient(token=slack_credentials.slack_workspace_bot_user_access_token)
+        slack_webclient = get_webclient(slack_credentials)
         test_result = slack_webclient.auth_test()
         if test_result.get("ok", False):
             return slack_credentials
@@ -39,15 +47,87 @@ def check_slack_credentials(slack_credentials:SlackCredential) -> SlackCredentia
         log_and_display_message(f"There was an error connecting to Slack.\n\t{e}\n\t{traceback.format_exc()}")
         return str(e)
 
+# Clients and channel membership #
+# ------------------------------ #
+# A WebClient per bot token, reused for every call in this process rather than created per message. We also remember which channels the bot is a member of, for TNQ_SLACK_CHANNEL_MEMBERSHIP_TTL_SECONDS, so that we check (and join) a channel once rather than before every message. If Slack tells us we're not in a channel after all (e.g. the bot was removed), we forget that, join, and try again.
+
+webclients = {}
+webclients_lock = threading.Lock()
+
+# (bot token, channel) -> when we stop assuming the bot is a member (time.monotonic())
+channel_memberships = {}
+channel_memberships_lock = threading.Lock()
+
+def get_webclient(slack_credential:SlackCredential) -> slack_sdk.WebClient:
+    """
+    Get the (shared) WebClient for the bot token of these credentials.
+    """
+    token = slack_credential.slack_workspace_bot_user_access_token
+    with webclients_lock:
+        slack_webclient = webclients.get(token)
+        if slack_webclient is None:
+            slack_webclient = slack_sdk.WebClient(token=token)
+            webclients[token] = slack_webclient
+        return slack_webclient
+
+def dispatch(slack_credential:SlackCredential, method_name:str, **kwargs) -> dict:
+    """
+    Call a Slack API method that writes (e.g. "chat_postMessage") through the outbound queue of the workspace; see core.functions.slack_dispatch.
+    """
+    return slack_dispatch.send(get_webclient(slack_credential), method_name, workspace_id=slack_credential.slack_workspace_id, **kwargs)
+
+def is_known_member(slack_channel:str, slack_webclient:slack_sdk.WebClient) -> bool:
+    """
+    Whether we checked (or made sure) recently that the bot is a member of the channel.
+    """
+    with channel_memberships_lock:
+        return channel_memberships.get((slack_webclient.token, slack_channel), 0) > time.monotonic()
+
+def remember_membership(slack_channel:str, slack_webclient:slack_sdk.WebClient):
+    """
+    Note that the bot is a member of the channel (for TNQ_SLACK_CHANNEL_MEMBERSHIP_TTL_SECONDS).
+    """
+    with channel_memberships_lock:
+        channel_memberships[(slack_webclient.token, slack_channel)] = time.monotonic() + settings.TNQ_SLACK_CHANNEL_MEMBERSHIP_TTL_SECONDS
+
+def forget_membership(slack_channel:str, slack_webclient:slack_sdk.WebClient):
+    """
+    Stop assuming the bot is a member of the channel, e.g. because Slack said it isn't.
+    """
+    with channel_memberships_lock:
+        channel_memberships.pop((slack_webclient.token, slack_channel), None)
+
 def check_and_join_channel(slack_channel:str, slack_webclient:slack_sdk.WebClient) -> bool:
     """
     If we are posting to a channel, we need to join that channel. Unless we are posting a DM, in which case we need to initiate the conversation with the user if that wasn't done already.
+
+    Channels we know the bot is a member of (see is_known_member) are not checked again.
     """
 
     if not slack_channel.startswith("D") and not slack_channel.startswith("U"):
+        if is_known_member(slack_channel, slack_webclient):
+            return None
         if not slack_webclient.conversations_info(channel=slack_channel).get("channel", {}).get("is_member", False):
             log_and_display_message(f"Bot is not a member of channel { slack_channel } yet; joining it first.")
-            return slack_webclient.conversations_join(channel=slack_channel)
+            response = slack_webclient.conversations_join(channel=slack_channel)
+            remember_membership(slack_channel, slack_webclient)
+            return response
+        remember_membership(slack_channel, slack_webclient)
+
+def call_in_channel(slack_channel:str, slack_webclient:slack_sdk.WebClient, slack_api_call):
+    """
+    Make sure we are in the channel, then make the call (a function without arguments, calling the Slack API). If Slack says we're not in the channel after all, join it and try (once) again.
+    """
+    check_and_join_channel(slack_channel, slack_webclient)
+    try:
+        return slack_api_call()
+    except slack_sdk.errors.SlackApiError as e:
+        if e.response.get("error") != "not_in_channel":
+            raise
+        log_and_display_message(f"Bot is no longer a member of channel { slack_channel }; joining it again.", level="warning")
+        forget_membership(slack_channel, slack_webclient)
+        check_and_join_channel(slack_channel, slack_webclient)
+        return slack_api_call()
 
 def get_user_info(slack_user_id:str, slack_credential:SlackCredential) -> dict:
     """
@@ -55,7 +135,7 @@ def get_user_info(slack_user_id:str, slack_credential:SlackCredential) -> dict:
     """
 
     log_and_display_message(f"Getting user and their profile for Slack user ID { slack_user_id }.")
-    slack_webclient = slack_sdk.WebClient(token=slack_credential.slack_workspace_bot_user_access_token)
+    slack_webclient = get_webclient(slack_credential)
 
     try:
         response = slack_webclient.users_info(user=slack_user_id)
@@ -73,14 +153,12 @@ def upload_file(slack_channel:str, slack_credential:SlackCredential, file:bytes,
     """
 
     log_and_display_message(f"Connecting to Slack workspace and uploading file to channel: { slack_channel }.")
-    slack_webclient = slack_sdk.WebClient(token=slack_credential.slack_workspace_bot_user_access_token)
-
-    check_and_join_channel(slack_channel, slack_webclient)
+    slack_webclient = get_webclient(slack_credential)
 
     file_title_for_upload = helpers_other.slugify(file_title) if file_title else "uploaded_file"
     file_name_for_upload = f"{ file_title_for_upload }.{ file_format }" if file_format else f"{ file_title_for_upload }.png"
     
-    return slack_webclient.files_upload_v2(file=file, filename=file_name_for_upload, channel=slack_channel, initial_comment=initial_comment, title=file_title, thread_ts=thread_ts)
+    return call_in_channel(slack_channel, slack_webclient, lambda: dispatch(slack_credential, "files_upload_v2", file=file, filename=file_name_for_upload, channel=slack_channel, initial_comment=initial_comment, title=file_title, thread_ts=thread_ts))
 
 def post_message(slack_channel:str, slack_credential:SlackCredential, text:str=None, blocks:list=[], icon_emoji:str=None, thread_ts:str=None) -> dict:
     """
@@ -91,20 +169,18 @@ def post_message(slack_channel:str, slack_credential:SlackCredential, text:str=N
         raise Exception("No text or blocks provided to post_message.")
 
     log_and_display_message(f"Connecting to Slack workspace and posting to channel: { slack_channel }.")
-    slack_webclient = slack_sdk.WebClient(token=slack_credential.slack_workspace_bot_user_access_token)
-
-    check_and_join_channel(slack_channel, slack_webclient)
+    slack_webclient = get_webclient(slack_credential)
 
     if blocks and len(blocks) > 0:
         if icon_emoji is not None:
-            return slack_webclient.chat_postMessage(channel=slack_channel, text=text, blocks=blocks, icon_emoji=icon_emoji, thread_ts=thread_ts)
+            return call_in_channel(slack_channel, slack_webclient, lambda: dispatch(slack_credential, "chat_postMessage", channel=slack_channel, text=text, blocks=blocks, icon_emoji=icon_emoji, thread_ts=thread_ts))
         else:
-            return slack_webclient.chat_postMessage(channel=slack_channel, text=text, blocks=blocks, thread_ts=thread_ts)
+            return call_in_channel(slack_channel, slack_webclient, lambda: dispatch(slack_credential, "chat_postMessage", channel=slack_channel, text=text, blocks=blocks, thread_ts=thread_ts))
     else: # Then it has to be text
         if icon_emoji is not None:
-            return slack_webclient.chat_postMessage(channel=slack_channel, markdown_text=text, icon_emoji=icon_emoji, thread_ts=thread_ts)
+            return call_in_channel(slack_channel, slack_webclient, lambda: dispatch(slack_credential, "chat_postMessage", channel=slack_channel, markdown_text=text, icon_emoji=icon_emoji, thread_ts=thread_ts))
         else:
-            return slack_webclient.chat_postMessage(channel=slack_channel, markdown_text=text, thread_ts=thread_ts)
+            return call_in_channel(slack_channel, slack_webclient, lambda: dispatch(slack_credential, "chat_postMessage", channel=slack_channel, markdown_text=text, thread_ts=thread_ts))
     
 
 def update_message(slack_channel:str, slack_credential:SlackCredential, text:str=None, blocks:list=[], thread_ts:str=None) -> dict:
@@ -116,12 +192,12 @@ def update_message(slack_channel:str, slack_credential:SlackCredential, text:str
         raise Exception("No text or blocks provided to update_message.")
 
     log_and_display_message(f"Connecting to Slack workspace and updating message with ts { thread_ts } in channel: { slack_channel }.")
-    slack_webclient = slack_sdk.WebClient(token=slack_credential.slack_workspace_bot_user_access_token)
+    slack_webclient = get_webclient(slack_credential)
 
     if blocks and len(blocks) > 0:
-        return slack_webclient.chat_update(channel=slack_channel, text=text, blocks=blocks, ts=thread_ts)
+        return dispatch(slack_credential, "chat_update", channel=slack_channel, text=text, blocks=blocks, ts=thread_ts)
     else: # Then it has to be text
-        return slack_webclient.chat_update(channel=slack_channel, text=text, ts=thread_ts)
+        return dispatch(slack_credential, "chat_update", channel=slack_channel, text=text, ts=thread_ts)
     
 
 
@@ -142,9 +218,7 @@ def post_status_message(slack_channel:str, slack_credential:SlackCredential, pre
     """
 
     log_and_display_message(f"Connecting to Slack workspace and posting status message to channel: { slack_channel }.")
-    slack_webclient = slack_sdk.WebClient(token=slack_credential.slack_workspace_bot_user_access_token)
-
-    check_and_join_channel(slack_channel, slack_webclient)
+    slack_webclient = get_webclient(slack_credential)
 
     if text is not None:
         text = f"{ icon_emoji } { text }"
@@ -154,7 +228,7 @@ def post_status_message(slack_channel:str, slack_credential:SlackCredential, pre
         # Update this message
         log_and_display_message(f"Updating previous status message in channel { slack_channel } with text: { text }.", level="debug")
         try:
-            response = slack_webclient.chat_update(channel=slack_channel, ts=previous_status_message_ts, text=text)
+            response = dispatch(slack_credential, "chat_update", channel=slack_channel, ts=previous_status_message_ts, text=text)
             return response
         except slack_sdk.errors.SlackApiError as e:
             log_and_display_message(f"There was an error updating the status message in Slack: { e.response['error'] }", level="error")
@@ -162,7 +236,7 @@ def post_status_message(slack_channel:str, slack_credential:SlackCredential, pre
     elif text is not None:
         log_and_display_message(f"Posting new status message in channel { slack_channel } with text: { text }.", level="debug")
         try:
-            response = slack_webclient.chat_postMessage(channel=slack_channel, text=text, thread_ts=thread_ts)
+            response = call_in_channel(slack_channel, slack_webclient, lambda: dispatch(slack_credential, "chat_postMessage", channel=slack_channel, text=text, thread_ts=thread_ts))
             return response
         except slack_sdk.errors.SlackApiError as e:
             log_and_display_message(f"There was an error posting the status message in Slack: { e.response['error'] }", level="error")
@@ -171,7 +245,7 @@ def post_status_message(slack_channel:str, slack_credential:SlackCredential, pre
         # Delete the previous message
         log_and_display_message(f"Deleting previous status message in channel { slack_channel } with timestamp: { previous_status_message_ts }.", level="debug")
         try:
-            response = slack_webclient.chat_delete(channel=slack_channel, ts=previous_status_message_ts)
+            response = dispatch(slack_credential, "chat_delete", channel=slack_channel, ts=previous_status_message_ts)
             return response
         except slack_sdk.errors.SlackApiError as e:
             log_and_display_message(f"There was an error deleting the status message in Slack: { e.response['error'] }", level="error")
@@ -0,0 +1,187 @@
+# imports - Python/general
+import time, threading, queue
+import concurrent.futures
+import slack_sdk
+import slack_sdk.errors
+
+# imports - Django
+from django.conf import settings
+
+# imports - our app
+# Functions
+from tableau_next_question.functions import log_and_display_message
+
+# Outbound queue for the Slack API calls that write (post, update, delete messages, upload files). Slack rate limits its methods per workspace in "tiers" (https://api.slack.com/apis/rate-limits), and chat.postMessage to about one message per second per channel. Rather than sending right away and losing the message when Slack answers "ratelimited", every call goes through a queue per workspace and tier (and per channel, for chat.postMessage), which:
+# - spaces the calls according to the tier's rate,
+# - when Slack rate limits us anyway, waits as long as its Retry-After header says and tries again (up to TNQ_SLACK_MAX_RETRIES times),
+# - keeps count of the queue depth, how long calls waited in the queue, and how long sending them took.
+#
+# Each queue has its own thread, which stops when the queue has been idle for a while. send() waits for the call's response (for at most TNQ_SLACK_DISPATCH_TIMEOUT_SECONDS), so callers work as before; with wait=False, it returns a Future instead.
+
+# Requests per minute Slack allows per workspace, by tier. "special" is chat.postMessage: about one per second, per channel.
+tier_requests_per_minute = {
+    "tier2": 20,
+    "tier3": 50,
+    "tier4": 100,
+    "special": 60
+}
+
+# The tier of each method we send through here (as named on the WebClient).
+method_tiers = {
+    "chat_postMessage": "special",
+    "chat_update": "tier3",
+    "chat_delete": "tier3",
+    "files_upload_v2": "tier4" # files.getUploadURLExternal and files.completeUploadExternal are both tier 4
+}
+
+# A queue's thread stops after this long without calls; the next call starts a new one.
+queue_idle_seconds = 60
+
+# (workspace, tier, channel) -> DispatchQueue
+dispatch_queues = {}
+dispatch_queues_lock = threading.Lock()
+
+# Per method: { "sent": ..., "errors": ..., "retries": ..., "total_wait_seconds": ..., "max_wait_seconds": ..., "total_send_seconds": ..., "max_send_seconds": ... }
+method_statistics = {}
+method_statistics_lock = threading.Lock()
+
+def record_method_statistic(method_name:str, **increments):
+    """
+    Add to the counters of a method. Keys starting with "max_" are kept as a maximum rather than a sum.
+    """
+    with method_statistics_lock:
+        statistics = method_statistics.setdefault(method_name, { "sent": 0, "errors": 0, "retries": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0, "total_send_seconds": 0.0, "max_send_seconds": 0.0 })
+        for key, value in increments.items():
+            if key.startswith("max_"):
+                statistics[key] = max(statistics[key], value)
+            else:
+                statistics[key] += value
+
+class DispatchQueue:
+    """
+    The calls for one workspace and tier (and channel, for chat.postMessage), sent one at a time and spaced according to the tier's rate by the queue's thread.
+    """
+
+    def __init__(self, queue_key:tuple):
+        self.queue_key = queue_key
+        self.calls = queue.Queue()
+        self.interval_seconds = 60 / tier_requests_per_minute[queue_key[1]]
+        self.last_sent_at = 0
+        self.thread = threading.Thread(target=self.run, name=f"slack-dispatch-{ queue_key[1] }", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        The queue's thread: send the calls in order, until the queue has been idle for queue_idle_seconds.
+        """
+        while True:
+            try:
+                call = self.calls.get(timeout=queue_idle_seconds)
+            except queue.Empty:
+                with dispatch_queues_lock:
+                    # Calls are only added with the lock held, so nothing can slip in between checking and removing.
+                    if self.calls.empty():
+                        dispatch_queues.pop(self.queue_key, None)
+                        return
+                continue
+            self.send(*call)
+
+    def send(self, future:concurrent.futures.Future, slack_webclient:slack_sdk.WebClient, method_name:str, kwargs:dict, queued_at:float):
+        """
+        Send one call, retrying when Slack rate limits it, and resolve its Future with the response (or the error).
+        """
+        if not future.set_running_or_notify_cancel():
+            return
+        record_method_statistic(method_name, total_wait_seconds=time.monotonic() - queued_at, max_wait_seconds=time.monotonic() - queued_at)
+        send_started_at = time.monotonic()
+        retries = 0
+        while True:
+            wait_seconds = self.last_sent_at + self.interval_seconds - time.monotonic()
+            if wait_seconds > 0:
+                time.sleep(wait_seconds)
+            self.last_sent_at = time.monotonic()
+            try:
+                response = getattr(slack_webclient, method_name)(**kwargs)
+            except slack_sdk.errors.SlackApiError as e:
+                if e.response.status_code == 429 and retries < settings.TNQ_SLACK_MAX_RETRIES:
+                    retries += 1
+                    retry_after_seconds = float(e.response.headers.get("Retry-After", 1))
+                    log_and_display_message(f"Slack rate limited { method_name }; retrying in { retry_after_seconds } seconds (retry { retries } of { settings.TNQ_SLACK_MAX_RETRIES }).", level="warning")
+                    record_method_statistic(method_name, retries=1)
+                    # Slack applies the wait to the whole method (and workspace), so the rest of the queue waits too.
+                    self.last_sent_at = time.monotonic() + retry_after_seconds - self.interval_seconds
+                    continue
+                self.finish(method_name, send_started_at, errors=1)
+                future.set_exception(e)
+                return
+            except Exception as e:
+                self.finish(method_name, send_started_at, errors=1)
+                future.set_exception(e)
+                return
+            self.finish(method_name, send_started_at, errors=0)
+            future.set_result(response)
+            return
+
+    def finish(self, method_name:str, send_started_at:float, errors:int):
+        """
+        Record that a call was sent (successfully or not), and how long that took, retries included.
+        """
+        send_seconds = time.monotonic() - send_started_at
+        record_method_statistic(method_name, sent=1, errors=errors, total_send_seconds=send_seconds, max_send_seconds=send_seconds)
+
+def send(slack_webclient:slack_sdk.WebClient, method_name:str, workspace_id:str=None, wait:bool=True, **kwargs):
+    """
+    Call a Slack API method through its queue, e.g. `send(slack_webclient, "chat_postMessage", workspace_id=..., channel=..., text=...)`. Returns the response (or raises the SlackApiError) like calling the method directly would; with `wait=False`, returns a Future of that instead.
+
+    If the response doesn't come within TNQ_SLACK_DISPATCH_TIMEOUT_SECONDS (e.g. because the queue's thread is stuck on an earlier call), a TimeoutError is raised. The call is then taken off the queue if it wasn't sent yet; if it was, it may still come through.
+
+    `workspace_id` identifies the workspace whose rate limits apply; without it, calls share the limits of one (unknown) workspace.
+    """
+    tier = method_tiers.get(method_name)
+    if tier is None:
+        raise ValueError(f"Slack method { method_name } is not dispatched through a queue; use one of: { ', '.join(method_tiers) }.")
+    queue_key = (workspace_id or "unknown", tier, kwargs.get("channel") if tier == "special" else None)
+
+    future = concurrent.futures.Future()
+    with dispatch_queues_lock:
+        dispatch_queue = dispatch_queues.get(queue_key)
+        if dispatch_queue is None:
+            dispatch_queue = DispatchQueue(queue_key)
+            dispatch_queues[queue_key] = dispatch_queue
+        dispatch_queue.calls.put((future, slack_webclient, method_name, kwargs, time.monotonic()))
+
+    if not wait:
+        return future
+    try:
+        return future.result(timeout=settings.TNQ_SLACK_DISPATCH_TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        was_cancelled = future.cancel()
+        log_and_display_message(f"Slack { method_name } was not sent within { settings.TNQ_SLACK_DISPATCH_TIMEOUT_SECONDS } seconds; { 'taking it off the queue' if was_cancelled else 'no longer waiting for it' }.", level="error")
+        raise TimeoutError(f"Slack { method_name } was not sent within { settings.TNQ_SLACK_DISPATCH_TIMEOUT_SECONDS } seconds.")
+
+def get_queue_depths() -> dict:
+    """
+    How many calls are waiting, per workspace and tier (summed over channels).
+    """
+    queue_depths = {}
+    with dispatch_queues_lock:
+        for (workspace_id, tier, channel), dispatch_queue in dispatch_queues.items():
+            queue_depths[f"{ workspace_id }:{ tier }"] = queue_depths.get(f"{ workspace_id }:{ tier }", 0) + dispatch_queue.calls.qsize()
+    return queue_depths
+
+def get_method_statistics() -> dict:
+    """
+    A copy of the counters per method, including the average wait and send time.
+    """
+    with method_statistics_lock:
+        return { method_name: { **statistics, "average_wait_seconds": statistics["total_wait_seconds"] / statistics["sent"] if statistics["sent"] > 0 else 0, "average_send_seconds": statistics["total_send_seconds"] / statistics["sent"] if statistics["sent"] > 0 else 0 } for method_name, statistics in method_statistics.items() }
+
+def log_dispatch_statistics():
+    """
+    Log the counters per method (since the process started), and the current queue depths.
+    """
+    for method_name, statistics in get_method_statistics().items():
+        log_and_display_message(f"Slack { method_name }: { statistics['sent'] } sent, { statistics['retries'] } retries, { statistics['errors'] } errors; waited { statistics['average_wait_seconds']:.2f}s average ({ statistics['max_wait_seconds']:.2f}s max), sent in { statistics['average_send_seconds']:.2f}s average ({ statistics['max_send_seconds']:.2f}s max).")
+    for queue_name, queue_depth in get_queue_depths().items():
+        if queue_depth > 0:
+            log_and_display_message(f"Slack queue { queue_name }: { queue_depth } calls waiting.")
@@ -0,0 +1,178 @@
+# imports - Python/general
+import time, threading
+import traceback
+import slack_sdk.errors
+
+# imports - Django
+from django.conf import settings
+
+# imports - our app
+# Models
+from core.models import SlackCredential
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.slack as slack
+
+# Status messages ("Finding visualizations...", "Formulating an answer...") shown in a thread while we work on a question, without holding up the work itself.
+#
+# A StatusReporter keeps the status we _want_ to show, and a background thread makes Slack show it:
+# - Changes in quick succession are coalesced: we wait TNQ_SLACK_STATUS_DEBOUNCE_SECONDS after a change, and only send the latest one.
+# - The calls go through the outbound queue of the workspace (see core.functions.slack_dispatch), which spaces them according to Slack's rate limits and retries them when Slack rate limits us anyway.
+# - close() removes the status message and waits for that to be done, so use the reporter as a context manager (or call close() in a finally), and no status message is left behind when something fails.
+#
+# Usage:
+#
+#   with StatusReporter(slack_channel=..., slack_credential=..., thread_ts=...) as status_reporter:
+#       status_reporter.update("Finding visualizations...")
+#       ...
+#       status_reporter.clear() # Remove the status message, e.g. before posting a file. A status after this is a new message, below the file.
+
+# How often we try a change (including the final delete) before giving up on it.
+max_attempts = 3
+
+# Errors after which retrying the same call is pointless.
+final_slack_errors = ["message_not_found", "channel_not_found", "cant_update_message", "cant_delete_message"]
+
+class StatusReporter:
+    """
+    The status message of one thread; see the comments at the top of this module.
+    """
+
+    def __init__(self, slack_channel:str, slack_credential:SlackCredential, thread_ts:str=None, icon_emoji:str=":thinkspin:"):
+        self.slack_channel = slack_channel
+        self.slack_credential = slack_credential
+        self.thread_ts = thread_ts
+        self.icon_emoji = icon_emoji
+
+        # What we want to show. Every clear() starts a new "generation": a status set after it is a new message.
+        self.wanted_text = None
+        self.wanted_generation = 0
+        # What Slack shows.
+        self.shown_ts = None
+        self.shown_text = None
+        self.shown_generation = 0
+
+        self.closing = False
+        self.changed = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=f"slack-status-{ slack_channel }", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def update(self, text:str):
+        """
+        Show this status (replacing the current one). Returns right away; the message is sent in the background.
+        """
+        with self.changed:
+            self.wanted_text = f"{ self.icon_emoji } { text }"
+            self.changed.notify()
+
+    def clear(self):
+        """
+        Remove the status message. Returns right away; the message is removed in the background.
+        """
+        with self.changed:
+            self.wanted_text = None
+            self.wanted_generation += 1
+            self.changed.notify()
+
+    def close(self, timeout:float=None):
+        """
+        Remove the status message, and wait (at most TNQ_SLACK_STATUS_CLOSE_TIMEOUT_SECONDS, unless specified) until it is gone. No updates are sent after this.
+        """
+        timeout = timeout if timeout is not None else settings.TNQ_SLACK_STATUS_CLOSE_TIMEOUT_SECONDS
+        with self.changed:
+            self.wanted_text = None
+            self.wanted_generation += 1
+            self.closing = True
+            self.changed.notify()
+        self.thread.join(timeout=timeout)
+        if self.thread.is_alive():
+            log_and_display_message(f"The status message in { self.slack_channel } was not removed within { timeout } seconds.", level="warning")
+
+    def is_settled(self) -> bool:
+        """
+        Whether Slack shows what we want to show. Call with self.changed held.
+        """
+        if self.wanted_text is None:
+            return self.shown_ts is None
+        return self.shown_ts is not None and self.shown_generation == self.wanted_generation and self.shown_text == self.wanted_text
+
+    def run(self):
+        """
+        The background thread: wait for changes, and send them (coalesced) until closed.
+        """
+        failures = 0
+        while True:
+            with self.changed:
+                while self.is_settled() and not self.closing:
+                    self.changed.wait()
+                if self.is_settled() and self.closing:
+                    return
+                closing = self.closing
+
+            if not closing:
+                # Give the status a moment to change again, so we only send the latest.
+                time.sleep(settings.TNQ_SLACK_STATUS_DEBOUNCE_SECONDS)
+
+            try:
+                self.send_next()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                log_and_display_message(f"Failed to update the status message in { self.slack_channel } (attempt { failures } of { max_attempts }):\n\t{e}\n\t{traceback.format_exc()}", level="error")
+                if failures >= max_attempts:
+                    failures = 0
+                    with self.changed:
+                        if self.closing:
+                            return
+                        self.give_up_on_change()
+
+    def give_up_on_change(self):
+        """
+        Stop trying to send the current change, and act as if Slack shows what we want, until the next change (or close()). Call with self.changed held.
+        """
+        if self.shown_ts is not None and (self.wanted_text is None or self.shown_generation != self.wanted_generation):
+            # The message we failed to delete stays.
+            self.shown_ts, self.shown_text = None, None
+        elif self.shown_ts is None:
+            self.wanted_text = None
+        else:
+            self.shown_text = self.wanted_text
+
+    def send_next(self):
+        """
+        Make one Slack call bringing what Slack shows closer to what we want: delete an outdated message, post a new one, or update the current one.
+        """
+        with self.changed:
+            wanted_text, wanted_generation = self.wanted_text, self.wanted_generation
+            shown_ts, shown_generation = self.shown_ts, self.shown_generation
+            if wanted_text is None and shown_ts is None:
+                return
+
+        slack_webclient = slack.get_webclient(self.slack_credential)
+        try:
+            if shown_ts is not None and (wanted_text is None or shown_generation != wanted_generation):
+                slack.dispatch(self.slack_credential, "chat_delete", channel=self.slack_channel, ts=shown_ts)
+                shown_ts, shown_text = None, None
+            elif shown_ts is None:
+                response = slack.call_in_channel(self.slack_channel, slack_webclient, lambda: slack.dispatch(self.slack_credential, "chat_postMessage", channel=self.slack_channel, text=wanted_text, thread_ts=self.thread_ts))
+                shown_ts, shown_text, shown_generation = response.get("ts"), wanted_text, wanted_generation
+            else:
+                slack.dispatch(self.slack_credential, "chat_update", channel=self.slack_channel, ts=shown_ts, text=wanted_text)
+                shown_text = wanted_text
+        except slack_sdk.errors.SlackApiError as e:
+            if e.response.get("error") in final_slack_errors:
+                # The message is gone (or can't be changed); act as if it is gone.
+                log_and_display_message(f"The status message in { self.slack_channel } can no longer be changed ({ e.response.get('error') }).", level="warning")
+                shown_ts, shown_text = None, None
+            else:
+                raise
+
+        with self.changed:
+            self.shown_ts, self.shown_text, self.shown_generation = shown_ts, shown_text, shown_generation
@@ -0,0 +1,115 @@
+# imports - Python/general
+import time
+import traceback
+import concurrent.futures
+
+# imports - Django
+from django.conf import settings
+
+# imports - our app
+# Models
+from core.models import SlackCredential
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.slack as slack
+
+# A Slack message that is written while the answer comes in (e.g. streamed from OpenAI), rather than posted when the answer is complete, so people see the first words of the answer seconds earlier.
+#
+# - The first update posts the message; later updates edit it (chat.update), at most every TNQ_SLACK_STREAM_UPDATE_SECONDS. Updates in between are skipped: the next one has all the text anyway.
+# - The calls go through the outbound queue of the workspace (see core.functions.slack_dispatch), without waiting for them, so they don't hold up reading the stream. While a call is on its way, updates are skipped as well.
+# - finish() shows the final text. If streaming didn't work out, it posts the final text as a new message, so the answer is never lost.
+# - The text is (standard) Markdown, as OpenAI writes it, and goes to Slack as markdown_text for the post, every update and the final text alike (slack.post_message sends text that way too). So the message doesn't change format when it's done; don't convert it to Slack's mrkdwn.
+#
+# Usage:
+#
+#   streaming_message = StreamingMessage(slack_channel=..., slack_credential=..., thread_ts=...)
+#   answer = openai.comment_on_dashboard_file(..., convert_to_slack_markdown=False, on_partial_response=streaming_message.update)
+#   streaming_message.finish(answer)
+
+# Shown at the end of the message while it is still being written.
+writing_indicator = " :writing_hand:"
+
+class StreamingMessage:
+    """
+    One message written while the text comes in; see the comments at the top of this module.
+    """
+
+    def __init__(self, slack_channel:str, slack_credential:SlackCredential, thread_ts:str=None):
+        self.slack_channel = slack_channel
+        self.slack_credential = slack_credential
+        self.thread_ts = thread_ts
+
+        self.message_ts = None
+        self.pending_call = None # Future of the call on its way, if any
+        self.last_sent_at = 0
+        self.failed = False
+
+        self.started_at = time.monotonic()
+        self.first_shown_after_seconds = None
+
+    def update(self, text:str):
+        """
+        Show the (Markdown) text so far, unless we updated the message very recently (or an update is still on its way). Returns right away.
+        """
+        if self.failed or len(text.strip()) == 0:
+            return
+        if not self.collect_pending_call(wait=False):
+            return
+        if time.monotonic() - self.last_sent_at < settings.TNQ_SLACK_STREAM_UPDATE_SECONDS:
+            return
+
+        self.last_sent_at = time.monotonic()
+        try:
+            if self.message_ts is None:
+                # Posting isn't queued without waiting: we need the message's ts for the updates, and the bot may need to join the channel first.
+                response = slack.post_message(slack_channel=self.slack_channel, slack_credential=self.slack_credential, text=f"{ text }{ writing_indicator }", thread_ts=self.thread_ts)
+                self.message_ts = response.get("ts")
+                self.first_shown_after_seconds = time.monotonic() - self.started_at
+            else:
+                self.pending_call = slack.dispatch(self.slack_credential, "chat_update", wait=False, channel=self.slack_channel, ts=self.message_ts, markdown_text=f"{ text }{ writing_indicator }")
+        except Exception as e:
+            self.give_up(e)
+
+    def collect_pending_call(self, wait:bool) -> bool:
+        """
+        Check on the call on its way (waiting for it, if asked). Returns whether there is none (anymore).
+        """
+        if self.pending_call is None:
+            return True
+        try:
+            self.pending_call.result(timeout=None if wait else 0)
+        except concurrent.futures.TimeoutError:
+            return False
+        except Exception as e:
+            self.give_up(e)
+        self.pending_call = None
+        return True
+
+    def give_up(self, e:Exception):
+        """
+        Stop updating the message; finish() will post the final text as a new message.
+        """
+        log_and_display_message(f"Failed to update the streamed message in { self.slack_channel }; the final text will be posted as a new message:\n\t{e}\n\t{traceback.format_exc()}", level="error")
+        self.failed = True
+
+    def finish(self, text:str) -> dict:
+        """
+        Show the final (Markdown) text, replacing what was streamed (or posting it, if nothing was). Waits until it is sent, and returns the JSON/dict response from the Slack API.
+        """
+        self.collect_pending_call(wait=True)
+        if self.first_shown_after_seconds is not None:
+            log_and_display_message(f"Streamed message in { self.slack_channel }: first shown after { self.first_shown_after_seconds:.2f} seconds, complete after { time.monotonic() - self.started_at:.2f} seconds.")
+
+        if self.message_ts is not None and not self.failed:
+            try:
+                return slack.dispatch(self.slack_credential, "chat_update", channel=self.slack_channel, ts=self.message_ts, markdown_text=text)
+            except Exception as e:
+                self.give_up(e)
+
+        if self.message_ts is not None:
+            # Don't leave the half-written message behind.
+            try:
+                slack.dispatch(self.slack_credential, "chat_delete", channel=self.slack_channel, ts=self.message_ts)
+            except Exception as e:
+                log_and_display_message(f"Failed to remove the streamed message in { self.slack_channel }:\n\t{e}", level="warning")
+        return slack.post_message(slack_channel=self.slack_channel, slack_credential=self.slack_credential, text=text, thread_ts=self.thread_ts)
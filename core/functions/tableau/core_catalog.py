@@ -0,0 +1,124 @@
+# imports - Python/general
+import asyncio, traceback
+
+# imports - Django
+from django.conf import settings
+from asgiref.sync import async_to_sync
+
+# imports - our app
+# Models
+from core.models import CatalogEntry
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.catalog_store as catalog_store
+import core.functions.tableau.metadata_api as tableau_metadata_api
+import core.functions.tableau.metadata_api_async as tableau_metadata_api_async
+import core.functions.tableau.rest_api_async as tableau_rest_api_async
+
+# The Tableau Core catalog: a local snapshot of the dashboards, sheets and fields on the site, as we get them from the Metadata API. We store it per workbook (see core.functions.catalog_store), so that we only need to re-download the workbooks whose updatedAt changed since the last sync.
+
+catalog_platform = "tableau_core"
+catalog_entity_type = "workbook"
+
+# How many workbooks we ask for in one filtered (luidWithin) Metadata API query. The queries for the batches are in flight at the same time (at most TNQ_DISCOVERY_MAX_WORKERS), on the worker's own thread; see fetch_workbooks.
+changed_workbooks_batch_size = 100
+
+def get_dashboards(rest_api_connection:dict, force_refresh:bool=False) -> list:
+    """
+    Get all dashboards on the Tableau site, in the same shape as the dashboardsSheetsAndFields Metadata API query returns them, with the addition of their upstreamDatasources and workbook:
+
+    ```
+    [
+        {
+            "luid": "...",
+            "name": "...",
+            "sheets": [ { "name": "...", "sheetFieldInstances": [ { "name": "..." }, ... ] }, ... ],
+            "upstreamDatasources": [ { "id": "...", "name": "..." }, ... ],
+            "workbook": { "luid": "...", "name": "..." }
+        },
+        ...
+    ]
+    ```
+
+    These come from our snapshot as long as it is not older than TNQ_CATALOG_MAX_AGE_SECONDS. If it is, only the workbooks that changed are re-downloaded first. `force_refresh` skips the staleness check and re-downloads everything.
+    """
+
+    if force_refresh or not catalog_store.is_fresh(catalog_platform, [catalog_entity_type], max_age_seconds=settings.TNQ_CATALOG_MAX_AGE_SECONDS):
+        try:
+            refresh_catalog(rest_api_connection, force_full=force_refresh)
+        except Exception as e:
+            # Same as for Tableau Next: a stale snapshot is better than nothing, unless it is really old (or there is none).
+            if not catalog_store.is_fresh(catalog_platform, [catalog_entity_type], max_age_seconds=settings.TNQ_CATALOG_FULL_REFRESH_SECONDS):
+                raise
+            log_and_display_message(f"Failed to refresh the Tableau Core catalog, using the stored version instead:\n\t{e}\n\t{traceback.format_exc()}", level="warning")
+    else:
+        log_and_display_message(f"Using the stored Tableau Core catalog, synced less than { settings.TNQ_CATALOG_MAX_AGE_SECONDS } seconds ago.")
+
+    return load_dashboards()
+
+def load_dashboards() -> list:
+    """
+    Read the dashboards from the stored snapshot, without contacting Tableau at all.
+    """
+    dashboards = []
+    for workbook in catalog_store.load_entries(catalog_platform, catalog_entity_type):
+        for dashboard in workbook.get("dashboards", []):
+            dashboards.append({ **dashboard, "workbook": { "luid": workbook.get("luid"), "name": workbook.get("name") } })
+    return dashboards
+
+def refresh_catalog(rest_api_connection:dict, force_full:bool=False) -> dict:
+    """
+    Refresh the snapshot. A full refresh downloads all workbooks with their dashboards, sheets and fields. An incremental refresh only lists the workbooks with their updatedAt, and downloads the ones that are new or changed. Workbooks that no longer exist are removed either way.
+    """
+
+    sync_state = catalog_store.get_sync_state(catalog_platform, catalog_entity_type)
+
+    if force_full or catalog_store.needs_full_sync(sync_state, full_sync_interval_seconds=settings.TNQ_CATALOG_FULL_REFRESH_SECONDS):
+        log_and_display_message(f"Refreshing the Tableau Core catalog (full refresh).")
+        workbooks = tableau_metadata_api.query_metadata_api_paginated(rest_api_connection=rest_api_connection, raw_query=get_query("workbooksDashboardsSheetsAndFields"))
+        return catalog_store.store_entries(catalog_platform, catalog_entity_type, records=workbooks, id_key="luid", modified_key="updatedAt", full_sync=True)
+
+    log_and_display_message(f"Refreshing the Tableau Core catalog (incremental refresh).")
+
+    workbooks_updated_at = tableau_metadata_api.query_metadata_api_paginated(rest_api_connection=rest_api_connection, raw_query=get_query("workbooksUpdatedAt"))
+    stored_workbooks_modified_at = dict(CatalogEntry.objects.filter(platform=catalog_platform, entity_type=catalog_entity_type).values_list("entity_id", "modified_at"))
+
+    changed_workbook_luids = [workbook.get("luid") for workbook in workbooks_updated_at if workbook.get("luid") not in stored_workbooks_modified_at or stored_workbooks_modified_at[workbook.get("luid")] != catalog_store.parse_modified_at(workbook.get("updatedAt"))]
+    current_workbook_luids = set(workbook.get("luid") for workbook in workbooks_updated_at)
+    deleted_workbook_luids = [luid for luid in stored_workbooks_modified_at if luid not in current_workbook_luids]
+
+    if len(changed_workbook_luids) == 0 and len(deleted_workbook_luids) == 0:
+        catalog_store.touch_sync_state(catalog_platform, catalog_entity_type)
+        return { "stored": 0, "deleted": 0, "full_sync": False }
+
+    log_and_display_message(f"{ len(changed_workbook_luids) } workbooks changed and { len(deleted_workbook_luids) } were removed on Tableau since the last sync.")
+
+    changed_workbook_luids_batches = [changed_workbook_luids[batch_start:batch_start + changed_workbooks_batch_size] for batch_start in range(0, len(changed_workbook_luids), changed_workbooks_batch_size)]
+    changed_workbooks = async_to_sync(fetch_workbooks)(rest_api_connection, changed_workbook_luids_batches)
+
+    return catalog_store.store_entries(catalog_platform, catalog_entity_type, records=changed_workbooks, id_key="luid", modified_key="updatedAt", deleted_ids=deleted_workbook_luids)
+
+async def fetch_workbooks(rest_api_connection:dict, workbook_luids_batches:list) -> list:
+    """
+    Download the workbooks with their dashboards, sheets and fields, with one (filtered) Metadata API query per batch of luids. The queries run concurrently, at most TNQ_DISCOVERY_MAX_WORKERS at a time, over an async connection for the same signed-in session as `rest_api_connection`.
+    """
+
+    async_rest_api_connection = tableau_rest_api_async.from_connection(rest_api_connection)
+    semaphore = asyncio.Semaphore(max(1, settings.TNQ_DISCOVERY_MAX_WORKERS))
+
+    async def fetch_batch(workbook_luids:list) -> list:
+        async with semaphore:
+            return await tableau_metadata_api_async.query_metadata_api_paginated(rest_api_connection=async_rest_api_connection, raw_query=get_query("workbooksDashboardsSheetsAndFields"), mda_filter={ "luidWithin": workbook_luids })
+
+    try:
+        workbooks_per_batch = await asyncio.gather(*[fetch_batch(workbook_luids) for workbook_luids in workbook_luids_batches])
+    finally:
+        await tableau_rest_api_async.close(async_rest_api_connection)
+
+    return [workbook for workbooks in workbooks_per_batch for workbook in workbooks]
+
+def get_query(query_name:str) -> str:
+    """
+    Get the contents of one of our predefined Metadata API queries by name.
+    """
+    return next((maq for maq in tableau_metadata_api.metadata_api_queries if maq.get("query_name", "?") == query_name), None)["query_contents"]
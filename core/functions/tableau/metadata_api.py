@@ -1,5 +1,5 @@
 # imports - Python/general
-import requests, re
+import requests, re, json
 
 # imports - Django
 # N/A
@@ -7,6 +7,8 @@ import requests, re
 # imports - our app
 # Models
 # N/A
+# Functions
+import core.functions.http_transport as http_transport
 
 # At least two functions here (parse_query_to_components and query_metadata_api_paginated) were copied from our Biztory tableau-tools repository (https://github.com/biztory/tableau-tools/blob/7bc15dda0065c04567c22df5af8a3b5a7963ef20/tableau-rls-finder/functions/metadata_api.py#L7)
 
@@ -41,6 +43,43 @@ def parse_query_to_components(raw_query:str):
     except Exception as e:
         raise Exception(e)
 
+def build_paginated_query_payload(query_components:dict, mda_filter:dict, page_size:int, end_cursor:str=None) -> dict:
+    """
+    Build the payload for one page of a query (as parsed by parse_query_to_components), with pagination and optionally a filter.
+    """
+    # Manipulate the query to include pagination logic, and the filter if any
+    # { root_part } (filter: { luidWithin: [...] }, first: 666, after: <cursor>, orderBy: { field: ID, direction: ASC }) { not_root_part }
+    # The first time, we won't have a cursor; afterwards, we will
+    if mda_filter == {}:
+        query_filter_component = ""
+    elif isinstance(list(mda_filter.values())[0], list):
+        # Filter on a list of values (e.g. luidWithin), which GraphQL expects as a list of strings. json.dumps gives us exactly that.
+        query_filter_component = f"filter: {{ { list(mda_filter.keys())[0] }: { json.dumps(list(mda_filter.values())[0]) } }}, "
+    else:
+        # Filter, we go for broke. Do note that the key has no quotes, the value does.
+        query_filter_component = f"filter: {{ { list(mda_filter.keys())[0] }: \"{ list(mda_filter.values())[0] }\" }}, "
+    if end_cursor is not None:
+        query_pagination_after_component = f", after: \"{ end_cursor }\""
+    else:
+        query_pagination_after_component = ""
+    # A filtered query can have more results than fit on one page as well, so it paginates the same way.
+    query_pagination_component = f"({ query_filter_component }first: { page_size }{ query_pagination_after_component }, orderBy: {{ field: ID, direction: ASC }})"
+
+    return {
+        "query": f"query { query_components['name'] } { query_components['root_part'] }{ query_pagination_component }{ query_components['not_root_part'] }"
+    }
+
+def parse_paginated_query_response(query_components:dict, response_json:dict) -> dict:
+    """
+    Get the results of one page of a query (see build_paginated_query_payload) from the response's JSON: a dict with the "nodes", and "has_next_page" and "end_cursor" to get the next page with.
+    """
+    metadata_query_results = response_json["data"][query_components["root_part_name"]]
+    return {
+        "nodes": metadata_query_results.get("nodes", []),
+        "has_next_page": metadata_query_results.get("pageInfo", {}).get("hasNextPage", False),
+        "end_cursor": metadata_query_results.get("pageInfo", {}).get("endCursor", None)
+    }
+
 def query_metadata_api_paginated(rest_api_connection:dict, raw_query:str, mda_filter:dict={}) -> list:
     """
     Receive a "generic" Metadata API query, and transform it into a parametrized query with pagination. 
@@ -64,33 +103,19 @@ def query_metadata_api_paginated(rest_api_connection:dict, raw_query:str, mda_fi
     while has_next_page:
 
         # logging.info(f"\tProcessing query with pagination, page { pages_processed }.")
-        # Manipulate the query to include pagination logic
-        # { root_part } (first: 666, after: <cursor>, orderBy: { field: ID, direction: ASC }) { not_root_part }
-        # The first time, we won't have a cursor; afterwards, we will
-        if end_cursor is not None:
-            query_pagination_after_component = f", after: \"{ end_cursor }\""
-        else:
-            query_pagination_after_component = ""
-        if mda_filter == {}:
-            # No filter, just paginate
-            query_pagination_component = f"(first: { page_size }{ query_pagination_after_component }, orderBy: {{ field: ID, direction: ASC }})"
-        else:
-            # Filter, we go for broke. Do note that the key has no quotes, the value does.
-            query_pagination_component = f"(filter: {{ { list(mda_filter.keys())[0] }: \"{ list(mda_filter.values())[0] }\" }})"
-
-        payload = {
-            "query": f"query { query_components['name'] } { query_components['root_part'] }{ query_pagination_component }{ query_components['not_root_part'] }"
-        }
+        payload = build_paginated_query_payload(query_components, mda_filter=mda_filter, page_size=page_size, end_cursor=end_cursor)
+        metadata_query_response = None
         try:
-            metadata_query_response = requests.post(url=metadata_api_endpoint_url, json=payload, headers=rest_api_connection["headers"])
-            metadata_query_results = metadata_query_response.json()["data"][query_components["root_part_name"]]
+            # The connection's session keeps the connection to Tableau alive between pages (and queries).
+            metadata_query_response = rest_api_connection.get("session", http_transport.shared_session).post(url=metadata_api_endpoint_url, json=payload, headers=rest_api_connection["headers"])
+            page = parse_paginated_query_response(query_components, metadata_query_response.json())
         except Exception as e:
-            raise Exception(f"Something went wrong querying the metadata API for query { query_components['name'] }.\n\t{e}The response was:{ metadata_query_response.text }")
+            raise Exception(f"Something went wrong querying the metadata API for query { query_components['name'] }.\n\t{e}The response was:{ metadata_query_response.text if metadata_query_response is not None else '' }")
         
-        has_next_page = metadata_query_results.get("pageInfo", {}).get("hasNextPage", False)
-        end_cursor = metadata_query_results.get("pageInfo", {}).get("endCursor", None)
+        has_next_page = page["has_next_page"]
+        end_cursor = page["end_cursor"]
         results_processed += page_size
-        results += metadata_query_results.get("nodes", [])
+        results += page["nodes"]
         # logger.info(f"\tResults processed: { results_processed }")
         pages_processed += 1
 
@@ -171,5 +196,54 @@ metadata_api_queries = [
                 }
             }
         """
+    },
+    { 
+        "query_name": "workbooksUpdatedAt",
+        "query_contents": """
+            query workbooksUpdatedAt {
+                workbooksConnection {
+                    nodes {
+                        luid,
+                        updatedAt
+                    },
+                    pageInfo {
+                        hasNextPage,
+                        endCursor
+                    }
+                }
+            }
+        """
+    },
+    { 
+        "query_name": "workbooksDashboardsSheetsAndFields",
+        "query_contents": """
+            query workbooksDashboardsSheetsAndFields {
+                workbooksConnection {
+                    nodes {
+                        luid,
+                        name,
+                        updatedAt,
+                        dashboards {
+                            luid,
+                            name,
+                            sheets {
+                                name,
+                                sheetFieldInstances {
+                                    name
+                                }
+                            },
+                            upstreamDatasources {
+                                id,
+                                name
+                            }
+                        }
+                    },
+                    pageInfo {
+                        hasNextPage,
+                        endCursor
+                    }
+                }
+            }
+        """
     }
 ]
\ No newline at end of file
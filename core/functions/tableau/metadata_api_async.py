@@ -0,0 +1,44 @@
+# imports - Python/general
+# N/A
+
+# imports - Django
+# N/A
+
+# imports - our app
+# Models
+# N/A
+# Functions
+from core.functions.tableau.metadata_api import parse_query_to_components, build_paginated_query_payload, parse_paginated_query_response
+
+# Async counterpart of query_metadata_api_paginated in core.functions.tableau.metadata_api, for a connection from core.functions.tableau.rest_api_async, so that several queries can be in flight at once on one thread (e.g. the batches of changed workbooks in core.functions.tableau.core_catalog). Building the queries and reading the pages is shared with the sync version; the predefined queries are the same (metadata_api_queries).
+
+async def query_metadata_api_paginated(rest_api_connection:dict, raw_query:str, mda_filter:dict={}) -> list:
+    """
+    Receive a "generic" Metadata API query, and transform it into a parametrized query with pagination. See metadata_api.query_metadata_api_paginated.
+    """
+
+    page_size = 666
+
+    query_components = parse_query_to_components(raw_query)
+
+    metadata_api_endpoint_url = rest_api_connection['tableau_url'] + "/api/metadata/graphql"
+
+    has_next_page = True
+    end_cursor = None
+    results = []
+
+    while has_next_page:
+
+        payload = build_paginated_query_payload(query_components, mda_filter=mda_filter, page_size=page_size, end_cursor=end_cursor)
+        metadata_query_response = None
+        try:
+            metadata_query_response = await rest_api_connection["client"].post(url=metadata_api_endpoint_url, json=payload)
+            page = parse_paginated_query_response(query_components, metadata_query_response.json())
+        except Exception as e:
+            raise Exception(f"Something went wrong querying the metadata API for query { query_components['name'] }.\n\t{e}The response was:{ metadata_query_response.text if metadata_query_response is not None else '' }")
+
+        has_next_page = page["has_next_page"]
+        end_cursor = page["end_cursor"]
+        results += page["nodes"]
+
+    return results
@@ -1,5 +1,5 @@
 # imports - Python/general
-import requests, copy, base64
+import requests, copy, base64, datetime
 
 # imports - Django
 from django.conf import settings
@@ -9,37 +9,22 @@ from django.conf import settings
 # N/A
 # Functions
 from tableau_next_question.functions import log_and_display_message
+import core.functions.http_transport as http_transport
+import core.functions.tableau.next_auth as tableau_next_auth
 
-def connect() -> dict:
-
-    sf_ext_client_app_consumer_key = settings.SF_EXT_CLIENT_APP_CONSUMER_KEY
-    sf_ext_client_app_consumer_secret = settings.SF_EXT_CLIENT_APP_CONSUMER_SECRET
-    sf_ext_client_app_redirect_uri = settings.SF_EXT_CLIENT_APP_REDIRECT_URI
-    sf_org_domain = settings.SF_ORG_DOMAIN
-    # sf_connect_user_username = os.getenv("sf_connect_user_username")
-    # sf_connect_user_password = os.getenv("sf_connect_user_password")
-
-    log_and_display_message(f"Salesforce External Client App Consumer Key: { sf_ext_client_app_consumer_key }\nSalesforce Org Domain: { sf_org_domain }\n")
-
-    # Step 1: Authenticate using JWT Bearer Token Flow
-    log_and_display_message("Authenticating using JWT Bearer Token Flow...")
+def connect(force_token_refresh:bool=False) -> dict:
+    """
+    Connect to Tableau Next. Returns a connection dict with a session (with the access token in its headers), or {} if authentication fails.
 
-    response = requests.post(
-        f"{sf_org_domain}services/oauth2/token",
-        data={
-            "grant_type": "client_credentials",
-            "client_id": sf_ext_client_app_consumer_key,
-            "client_secret": sf_ext_client_app_consumer_secret,
-        },
-    )
+    The access token comes from core.functions.tableau.next_auth, which shares it between workers and only gets a new one when it is about to expire. Use `force_token_refresh` if the API rejected the token.
+    """
 
-    if response.status_code != 200:
-        log_and_display_message(f"Error: {response.status_code} - {response.text}")
+    token = tableau_next_auth.get_token(force_refresh=force_token_refresh)
+    if not token:
         return {}
 
-    response_data = response.json()
-    access_token = response_data.get("access_token")
-    instance_url = response_data.get("instance_url")
+    access_token = token.get("access_token")
+    instance_url = token.get("instance_url")
     
     connect_api_base_url = f"{instance_url}/services/data/v64.0"
     headers = {
@@ -48,7 +33,7 @@ def connect() -> dict:
         "Accept": "application/json"
     }
     
-    session = requests.Session()
+    session = http_transport.create_session()
     session.headers.update(headers)
     connection_dict = {
         "session": session,
@@ -56,7 +41,23 @@ def connect() -> dict:
         "instance_url": instance_url,
         "connect_api_base_url": connect_api_base_url
     }
-    log_and_display_message("Authentication successful.")
+
+    def reauthenticate_on_401(response:requests.Response, *args, **kwargs) -> requests.Response:
+        # The cached token may have been revoked before it expired. Get a new one, and retry the request with it (once).
+        if response.status_code != 401 or getattr(response.request, "reauthenticated", False):
+            return response
+        new_token = tableau_next_auth.get_token(force_refresh=True)
+        if not new_token:
+            return response
+        log_and_display_message("Tableau Next rejected the access token; retrying with a new one.", level="warning")
+        headers["Authorization"] = f"Bearer { new_token.get('access_token') }"
+        session.headers.update(headers)
+        retried_request = response.request.copy()
+        retried_request.headers["Authorization"] = headers["Authorization"]
+        retried_request.reauthenticated = True
+        return session.send(retried_request, **kwargs)
+
+    session.hooks["response"].append(reauthenticate_on_401)
 
     return connection_dict
 
@@ -271,22 +272,39 @@ def post_visualization(connection_dict: dict, visualization_definition) -> dict:
     return response.json()
     
 # Useful in case there's info we _can't_ get with the "official" Tableau Next API: we can still use SOQL
-def get_entities_through_soql(connection:dict, entity_type:str) -> list:
+def build_soql_query(entity_type:str, fields:list=None, modified_since:datetime.datetime=None) -> str:
+    """
+    Build a SOQL query for entities of a certain type, in the form we put in a query URL (with "+" for spaces). Without `fields`, all standard fields are selected. See get_entities_through_soql for `modified_since`.
+    """
+
+    query_for_entities = f"SELECT+{ ','.join(fields) if fields else 'FIELDS(Standard)' }+FROM+{ entity_type }"
+    if modified_since is not None:
+        # SOQL datetime literals are not quoted, and must be in UTC.
+        query_for_entities += f"+WHERE+SystemModstamp+>+{ modified_since.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ') }"
+
+    return query_for_entities
+
+def get_entities_through_soql(connection:dict, entity_type:str, modified_since:datetime.datetime=None, include_deleted:bool=False, fields:list=None) -> list:
     """
     Get entities of a certain type from Tableau Next via SOQL through the Salesforce API/REST API connection. Returns a list of dicts, each dict representing an entity.
 
     Also implemented pagination for large result sets.
 
     Entity Types supported include but are not limited to: AnalyticsDashboard, AnalyticsDashboardWidget, AnalyticsVizWidgetDef, AnalyticsVisualization
+
+    `modified_since`: only return entities whose SystemModstamp is more recent than this (timezone-aware) datetime. Used for incremental refreshes of our catalog.
+    `include_deleted`: use the queryAll endpoint, which also returns deleted entities (with IsDeleted = true), so we can remove them from our catalog.
+    `fields`: the fields to select, e.g. ["Id", "MasterLabel"]. Defaults to all standard fields (FIELDS(Standard)), which is a lot more data than we usually need.
     """
 
-    log_and_display_message(f"Getting entities of type { entity_type } from Tableau Next/Salesforce via SOQL through the REST API.")
+    log_and_display_message(f"Getting entities of type { entity_type } from Tableau Next/Salesforce via SOQL through the REST API{ f' (modified since { modified_since.isoformat() })' if modified_since is not None else '' }.")
 
     entities = []
 
-    query_for_entities = f"SELECT+FIELDS(Standard)+FROM+{ entity_type }"
+    query_for_entities = build_soql_query(entity_type, fields=fields, modified_since=modified_since)
 
-    request_url_base = f"{ connection['instance_url'] }/services/data/v64.0/query?q={ query_for_entities }"
+    query_endpoint = "queryAll" if include_deleted else "query"
+    request_url_base = f"{ connection['instance_url'] }/services/data/v64.0/{ query_endpoint }?q={ query_for_entities }"
     request_url = request_url_base
 
     fetched_all_records = False
@@ -303,4 +321,62 @@ def get_entities_through_soql(connection:dict, entity_type:str) -> list:
         else:
             raise Exception(f"The response from the API, while trying to fetch { entity_type }, was not ok.\n\t{ response.text }")
 
-    return entities
\ No newline at end of file
+    return entities
+
+def get_entities_through_soql_composite(connection:dict, queries:dict, include_deleted:bool=False) -> dict:
+    """
+    Run several SOQL queries in a single round trip, through the Composite API (https://developer.salesforce.com/docs/atlas.en-us.api_rest.meta/api_rest/resources_composite_composite.htm). Only result sets that don't fit in one response need additional requests, to follow their nextRecordsUrl.
+
+    `queries` is a dict with a name and a SOQL query (see build_soql_query) for each, e.g.:
+
+    ```
+    {
+        "AnalyticsDashboard": "SELECT+Id,MasterLabel,DeveloperName+FROM+AnalyticsDashboard",
+        ...
+    }
+    ```
+
+    Returns a dict with the same names, and for each of them the list of records. The Composite API takes at most 25 subrequests; `include_deleted` works as for get_entities_through_soql.
+    """
+
+    if len(queries) > 25:
+        raise ValueError(f"The Composite API supports at most 25 subrequests, { len(queries) } queries were provided.")
+
+    log_and_display_message(f"Getting entities of types { ', '.join(queries) } from Tableau Next/Salesforce via SOQL through the Composite API.")
+
+    query_endpoint = "queryAll" if include_deleted else "query"
+    composite_request_body = {
+        "allOrNone": False,
+        "compositeRequest": [
+            {
+                "method": "GET",
+                "url": f"/services/data/v64.0/{ query_endpoint }?q={ query }",
+                "referenceId": name
+            } for name, query in queries.items()
+        ]
+    }
+
+    response = connection['session'].post(url=f"{ connection['instance_url'] }/services/data/v64.0/composite", json=composite_request_body)
+    if not response.ok:
+        raise Exception(f"The response from the Composite API, while trying to fetch { ', '.join(queries) }, was not ok.\n\t{ response.text }")
+
+    entities_per_query = {}
+    for subresponse in response.json().get("compositeResponse", []):
+        name = subresponse.get("referenceId")
+        if subresponse.get("httpStatusCode") != 200:
+            raise Exception(f"The response from the Composite API, while trying to fetch { name }, was not ok.\n\t{ subresponse.get('body') }")
+        response_json = subresponse.get("body", {})
+        entities = response_json.get("records", [])
+        while "nextRecordsUrl" in response_json:
+            next_response = connection['session'].get(url=f"{ connection['instance_url'] }{ response_json['nextRecordsUrl'] }")
+            if not next_response.ok:
+                raise Exception(f"The response from the API, while trying to fetch { name }, was not ok.\n\t{ next_response.text }")
+            response_json = next_response.json()
+            entities += response_json.get("records", [])
+        entities_per_query[name] = entities
+
+    missing_queries = [name for name in queries if name not in entities_per_query]
+    if len(missing_queries) > 0:
+        raise Exception(f"The Composite API did not return results for { ', '.join(missing_queries) }.")
+
+    return entities_per_query
@@ -0,0 +1,319 @@
+# imports - Python/general
+import httpx, base64, datetime
+
+# imports - Django
+from asgiref.sync import sync_to_async
+
+# imports - our app
+# Models
+# N/A
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.http_transport as http_transport
+import core.functions.tableau.next_auth as tableau_next_auth
+from core.functions.tableau.next_api import build_soql_query
+
+# Async counterparts of the functions in core.functions.tableau.next_api, with the same signatures, so that many requests to Tableau Next can be in flight at once within one worker (e.g. with asyncio.gather). The connection dict holds an httpx.AsyncClient ("client") rather than a requests.Session ("session"); close it with close() when done.
+#
+# The access token is shared with the sync functions (see core.functions.tableau.next_auth). As that goes through Django's cache, i.e. the database, it is called through sync_to_async.
+
+async def connect(force_token_refresh:bool=False) -> dict:
+    """
+    Connect to Tableau Next. Returns a connection dict with an httpx.AsyncClient (with the access token in its headers), or {} if authentication fails. See next_api.connect.
+    """
+
+    token = await sync_to_async(tableau_next_auth.get_token)(force_refresh=force_token_refresh)
+    if not token:
+        return {}
+
+    access_token = token.get("access_token")
+    instance_url = token.get("instance_url")
+
+    connect_api_base_url = f"{instance_url}/services/data/v64.0"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+
+    connection_dict = {
+        "headers": headers,
+        "instance_url": instance_url,
+        "connect_api_base_url": connect_api_base_url
+    }
+
+    async def refresh_access_token(rejected_authorization:str) -> str:
+        # The cached token may have been revoked before it expired. Get a new one, and retry the request with it (once).
+        new_token = await sync_to_async(tableau_next_auth.get_token)(force_refresh=True)
+        if not new_token:
+            return None
+        log_and_display_message("Tableau Next rejected the access token; retrying with a new one.", level="warning")
+        headers["Authorization"] = f"Bearer { new_token.get('access_token') }"
+        connection_dict["client"].headers.update(headers)
+        return headers["Authorization"]
+
+    connection_dict["client"] = http_transport.create_async_client(headers=headers, auth=http_transport.ReauthenticatingAuth("Authorization", refresh_access_token))
+
+    return connection_dict
+
+async def close(connection_dict:dict):
+    """
+    Close the connection's client, and the connections it keeps open.
+    """
+    if "client" in connection_dict:
+        await connection_dict["client"].aclose()
+
+async def list_workspaces(connection_dict: dict) -> list:
+    """
+    List all workspaces in the Tableau Next API.
+    """
+
+    connect_api_get_workspaces_url = f"{ connection_dict['connect_api_base_url'] }/tableau/workspaces"
+
+    response = await connection_dict["client"].get(connect_api_get_workspaces_url)
+    response_data = response.json()
+
+    return response_data.get("workspaces", [])
+
+async def get_workspace_asset_collection(connection_dict: dict, workspace_id: str) -> list:
+    """
+    List all assets in a specific workspace.
+    """
+
+    connect_api_get_assets_url = f"{ connection_dict['connect_api_base_url'] }/tableau/workspaces/{workspace_id}/assets"
+
+    response = await connection_dict["client"].get(connect_api_get_assets_url)
+    response_data = response.json()
+
+    return response_data.get("workspaceAssets", [])
+
+async def post_image_download(connection_dict: dict, asset: dict, metadata_only:bool=False) -> dict:
+    """
+    Post a request to download an image or metadata of a specific asset. See next_api.post_image_download for the format of what is returned.
+    """
+
+    connect_api_post_image_download_url = f"{ connection_dict['connect_api_base_url'] }/tableau/download"
+
+    metadata_only_query_param = "?metadataOnly=true" if metadata_only else "?metadataOnly=false"
+    connect_api_post_image_download_url += metadata_only_query_param
+
+    # Determine asset_type
+    asset_type = "AnalyticsDashboard" # Default
+    # For dashboard, this will be in attributes -> type.
+    asset_type_from_attributes = asset.get("attributes", {}).get("type")
+    if asset_type_from_attributes is not None:
+        asset_type = asset_type_from_attributes
+    # Otherwise, if we have an insightsSettings key/dict as part of our assets, it's a metric (which is called Submetric here)
+    else:
+        insights_settings = asset.get("insightsSettings", {})
+        if insights_settings:
+            asset_type = "Submetric"
+
+    # The values and body are different depending on whether we're dealing with a dashboard or a metric
+    connect_api_post_image_body = {}
+    if asset_type == "AnalyticsDashboard":
+        asset_name = asset.get("DeveloperName") or ""
+        connect_api_post_image_body = {
+            "asset": {
+                "dashboardName": asset_name,
+                "type": "Dashboard"
+            }
+        }
+
+    elif asset_type == "Submetric":
+        connect_api_post_image_body = {
+            "asset": {
+                "assetId": asset.get("id"),
+                "type": "Submetric"
+            }
+        }
+
+    response = await connection_dict["client"].post(connect_api_post_image_download_url, json=connect_api_post_image_body)
+
+    if not response.is_success:
+        log_and_display_message(f"Error downloading data: {response.status_code} - {response.text}")
+        # As in next_api.post_image_download: the Tableau Next API is not working yet, so we return an image we already have.
+        sample_image_location = "resources/biztory_team_members_strava_data.png"
+        with open(sample_image_location, "rb") as sample_image_file:
+            sample_image_content = sample_image_file.read()
+        return {
+            "original_response": response.json(),
+            "image_bytes": sample_image_content
+        }
+
+    if metadata_only:
+        return response.json()
+    else:
+        return {
+            "original_response": response.json(),
+            "image_bytes": base64.b64decode(response.json().get("downloadFile", {}).get("base64EncodedData", ""))
+        }
+
+async def get_all_semantic_models(connection_dict: dict) -> dict:
+    """
+    Get all semantic models.
+    """
+
+    connect_api_get_semantic_model_url = f"{ connection_dict['connect_api_base_url'] }/ssot/semantic/models"
+
+    response = await connection_dict["client"].get(connect_api_get_semantic_model_url)
+
+    if response.status_code != 200:
+        log_and_display_message(f"Error getting semantic model: {response.status_code} - {response.text}")
+        return {}
+
+    return response.json()
+
+async def get_semantic_model_metadata(connection_dict: dict, semantic_data_model:dict) -> dict:
+    """
+    Get additional metadata about a semantic model, including information about its fields (in semanticDataObjects). See next_api.get_semantic_model_metadata.
+    """
+
+    connect_api_get_semantic_model_contents_url = f"{ connection_dict['connect_api_base_url'] }/ssot/semantic/models/{ semantic_data_model.get('apiName') }"
+
+    response = await connection_dict["client"].get(connect_api_get_semantic_model_contents_url)
+
+    if response.status_code != 200:
+        log_and_display_message(f"Error getting semantic model contents: {response.status_code} - {response.text}")
+        return []
+
+    return response.json()
+
+async def get_metric_metadata(connection_dict:dict, semantic_data_model:dict, metric_api_name:str) -> dict:
+    """
+    Get information on a Metric defined as part of a Semantic Model. See next_api.get_metric_metadata.
+    """
+
+    connect_api_get_semantic_model_contents_url = f"{ connection_dict['connect_api_base_url'] }/ssot/semantic/models/{ semantic_data_model.get('apiName') }/metrics/{ metric_api_name }"
+
+    response = await connection_dict["client"].get(connect_api_get_semantic_model_contents_url)
+
+    if response.status_code != 200:
+        log_and_display_message(f"Error getting semantic model metric contents: {response.status_code} - {response.text}")
+        return []
+
+    return response.json()
+
+async def get_visualization_collection(connection_dict: dict) -> list:
+    """
+    Get a collection of visualizations.
+    """
+
+    # Bug fix/workaround: this is not available in v64.0; we need to also specify ?minorVersion=-1.
+    connect_api_get_visualizations_url = f"{ connection_dict['connect_api_base_url'] }/tableau/visualizations?minorVersion=-1"
+
+    response = await connection_dict["client"].get(connect_api_get_visualizations_url)
+
+    if response.status_code != 200:
+        log_and_display_message(f"Error getting visualizations: {response.status_code} - {response.text}")
+        return []
+
+    return response.json().get("visualizations", [])
+
+async def get_visualization(connection_dict: dict, asset_id_or_name: str) -> dict:
+    """
+    Get a specific visualization by its ID.
+    """
+
+    # Bug fix/workaround: this is not available in v64.0; we need to also specify ?minorVersion=-1.
+    connect_api_get_visualization_url = f"{ connection_dict['connect_api_base_url'] }/tableau/visualizations/{asset_id_or_name}?minorVersion=-1"
+
+    response = await connection_dict["client"].get(connect_api_get_visualization_url)
+
+    if response.status_code != 200:
+        log_and_display_message(f"Error getting visualization: {response.status_code} - {response.text}")
+        return {}
+
+    return response.json()
+
+async def post_visualization(connection_dict: dict, visualization_definition) -> dict:
+    """
+    Post a new visualization to the Tableau Next API.
+    """
+
+    # Bug fix/workaround: this is not available in v64.0; we need to also specify ?minorVersion=-1.
+    connect_api_post_visualization_url = f"{ connection_dict['connect_api_base_url'] }/tableau/visualizations?minorVersion=-1"
+
+    response = await connection_dict["client"].post(connect_api_post_visualization_url, json=visualization_definition)
+
+    if response.status_code != 201:
+        raise Exception(f"Error posting visualization: {response.status_code} - {response.text}")
+
+    return response.json()
+
+async def get_entities_through_soql(connection:dict, entity_type:str, modified_since:datetime.datetime=None, include_deleted:bool=False, fields:list=None) -> list:
+    """
+    Get entities of a certain type from Tableau Next via SOQL, following pagination. See next_api.get_entities_through_soql.
+    """
+
+    log_and_display_message(f"Getting entities of type { entity_type } from Tableau Next/Salesforce via SOQL through the REST API{ f' (modified since { modified_since.isoformat() })' if modified_since is not None else '' }.")
+
+    entities = []
+
+    query_for_entities = build_soql_query(entity_type, fields=fields, modified_since=modified_since)
+
+    query_endpoint = "queryAll" if include_deleted else "query"
+    request_url = f"{ connection['instance_url'] }/services/data/v64.0/{ query_endpoint }?q={ query_for_entities }"
+
+    fetched_all_records = False
+
+    while not fetched_all_records:
+        response = await connection['client'].get(url=request_url)
+        if response.is_success:
+            response_json = response.json()
+            entities += response_json.get("records", [])
+            if "nextRecordsUrl" in response_json:
+                request_url = f"{ connection['instance_url'] }{ response_json['nextRecordsUrl'] }"
+            else:
+                fetched_all_records = True
+        else:
+            raise Exception(f"The response from the API, while trying to fetch { entity_type }, was not ok.\n\t{ response.text }")
+
+    return entities
+
+async def get_entities_through_soql_composite(connection:dict, queries:dict, include_deleted:bool=False) -> dict:
+    """
+    Run several SOQL queries in a single round trip, through the Composite API. See next_api.get_entities_through_soql_composite.
+    """
+
+    if len(queries) > 25:
+        raise ValueError(f"The Composite API supports at most 25 subrequests, { len(queries) } queries were provided.")
+
+    log_and_display_message(f"Getting entities of types { ', '.join(queries) } from Tableau Next/Salesforce via SOQL through the Composite API.")
+
+    query_endpoint = "queryAll" if include_deleted else "query"
+    composite_request_body = {
+        "allOrNone": False,
+        "compositeRequest": [
+            {
+                "method": "GET",
+                "url": f"/services/data/v64.0/{ query_endpoint }?q={ query }",
+                "referenceId": name
+            } for name, query in queries.items()
+        ]
+    }
+
+    response = await connection['client'].post(url=f"{ connection['instance_url'] }/services/data/v64.0/composite", json=composite_request_body)
+    if not response.is_success:
+        raise Exception(f"The response from the Composite API, while trying to fetch { ', '.join(queries) }, was not ok.\n\t{ response.text }")
+
+    entities_per_query = {}
+    for subresponse in response.json().get("compositeResponse", []):
+        name = subresponse.get("referenceId")
+        if subresponse.get("httpStatusCode") != 200:
+            raise Exception(f"The response from the Composite API, while trying to fetch { name }, was not ok.\n\t{ subresponse.get('body') }")
+        response_json = subresponse.get("body", {})
+        entities = response_json.get("records", [])
+        while "nextRecordsUrl" in response_json:
+            next_response = await connection['client'].get(url=f"{ connection['instance_url'] }{ response_json['nextRecordsUrl'] }")
+            if not next_response.is_success:
+                raise Exception(f"The response from the API, while trying to fetch { name }, was not ok.\n\t{ next_response.text }")
+            response_json = next_response.json()
+            entities += response_json.get("records", [])
+        entities_per_query[name] = entities
+
+    missing_queries = [name for name in queries if name not in entities_per_query]
+    if len(missing_queries) > 0:
+        raise Exception(f"The Composite API did not return results for { ', '.join(missing_queries) }.")
+
+    return entities_per_query
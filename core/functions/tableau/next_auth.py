@@ -0,0 +1,132 @@
+# imports - Python/general
+import time, threading
+import cryptography.fernet
+
+# imports - Django
+from django.conf import settings
+from django.core.cache import cache
+from encrypted_model_fields.fields import encrypt_str, decrypt_str
+
+# imports - our app
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.http_transport as http_transport
+
+# Access tokens for Tableau Next (the Salesforce API), through the External Client App's client credentials flow. Rather than getting a new token for every connection, we keep it in Django's cache (in the database, see CACHES in settings), which is shared by all workers. A token is refreshed when it gets within TNQ_NEXT_TOKEN_REFRESH_MARGIN_SECONDS of expiring.
+#
+# The cache is a database table, so the access token is stored encrypted (with FIELD_ENCRYPTION_KEY, as the credentials in our models are): whoever can read the database should not get API access to the org from it.
+#
+# When the token needs refreshing and several workers notice at the same time, only one of them (the one that gets the lock) asks Salesforce for a new one; the others wait for it to appear in the cache.
+
+token_cache_key = "tnq:tableau_next:token"
+token_lock_cache_key = "tnq:tableau_next:token_lock"
+
+# How long the lock is held at most (e.g. if the worker holding it dies), and how long others wait for it before getting a token themselves.
+token_lock_timeout_seconds = 30
+token_lock_poll_seconds = 0.25
+
+# Threads within the same process don't even need to go through the cache lock.
+token_thread_lock = threading.Lock()
+
+def get_token(force_refresh:bool=False) -> dict:
+    """
+    Get a valid access token for Tableau Next, as a dict:
+
+    ```
+    {
+        "access_token": "...",
+        "instance_url": "https://....my.salesforce.com",
+        "expires_at": 1755000000.0 # Unix timestamp
+    }
+    ```
+
+    From the cache if possible; a new one if the cached one expires within TNQ_NEXT_TOKEN_REFRESH_MARGIN_SECONDS, or if `force_refresh` is set (e.g. because the API rejected the cached one). Returns {} if authentication fails.
+    """
+
+    token = get_cached_token()
+    if not force_refresh and is_usable(token):
+        return token
+    rejected_access_token = token.get("access_token") if force_refresh and token else None
+
+    with token_thread_lock:
+        lock_acquired = cache.add(token_lock_cache_key, True, timeout=token_lock_timeout_seconds)
+        waited_until = time.monotonic() + token_lock_timeout_seconds
+        while not lock_acquired:
+            # Someone else is getting a new token. Use theirs once it's there, unless it's the one we were told is no good.
+            time.sleep(token_lock_poll_seconds)
+            token = get_cached_token()
+            if is_usable(token) and token.get("access_token") != rejected_access_token:
+                return token
+            if time.monotonic() > waited_until:
+                # We go ahead without the lock, which is still the other worker's to release.
+                log_and_display_message("Timed out waiting for another worker to get a Tableau Next access token; getting one ourselves.", level="warning")
+                break
+            lock_acquired = cache.add(token_lock_cache_key, True, timeout=token_lock_timeout_seconds)
+
+        try:
+            # Another worker may have refreshed the token between our first check and getting the lock.
+            token = get_cached_token()
+            if is_usable(token) and token.get("access_token") != rejected_access_token:
+                return token
+            token = request_token()
+            if token:
+                cache.set(token_cache_key, { **token, "access_token": encrypt_str(token["access_token"]).decode("utf-8") }, timeout=max(1, int(token["expires_at"] - time.time())))
+            return token
+        finally:
+            if lock_acquired:
+                cache.delete(token_lock_cache_key)
+
+def get_cached_token() -> dict | None:
+    """
+    The token in the cache, with its access token decrypted. None if there is none, or it can't be decrypted (e.g. because FIELD_ENCRYPTION_KEY changed).
+    """
+    cached_token = cache.get(token_cache_key)
+    if not cached_token:
+        return None
+    try:
+        return { **cached_token, "access_token": decrypt_str(cached_token["access_token"]) }
+    except (cryptography.fernet.InvalidToken, KeyError, TypeError):
+        log_and_display_message("Could not decrypt the cached Tableau Next access token; getting a new one.", level="warning")
+        return None
+
+def is_usable(token:dict) -> bool:
+    """
+    Whether a (cached) token is there, and not about to expire.
+    """
+    return bool(token) and token.get("expires_at", 0) - settings.TNQ_NEXT_TOKEN_REFRESH_MARGIN_SECONDS > time.time()
+
+def invalidate_token():
+    """
+    Remove the cached token, e.g. after the API rejected it.
+    """
+    cache.delete(token_cache_key)
+
+def request_token() -> dict:
+    """
+    Get a new access token from Salesforce with the client credentials flow. Returns {} if that fails.
+    """
+
+    log_and_display_message(f"Getting a new Tableau Next access token for { settings.SF_ORG_DOMAIN } (client credentials flow)...")
+
+    response = http_transport.shared_session.post(
+        f"{ settings.SF_ORG_DOMAIN }services/oauth2/token",
+        data={
+            "grant_type": "client_credentials",
+            "client_id": settings.SF_EXT_CLIENT_APP_CONSUMER_KEY,
+            "client_secret": settings.SF_EXT_CLIENT_APP_CONSUMER_SECRET,
+        },
+    )
+
+    if response.status_code != 200:
+        log_and_display_message(f"Error: {response.status_code} - {response.text}", level="error")
+        return {}
+
+    response_data = response.json()
+    # Salesforce doesn't always include expires_in, in which case we go by the lifetime configured for the External Client App.
+    lifetime_seconds = int(response_data.get("expires_in", settings.TNQ_NEXT_TOKEN_LIFETIME_SECONDS))
+
+    return {
+        "access_token": response_data.get("access_token"),
+        "instance_url": response_data.get("instance_url"),
+        "expires_at": time.time() + lifetime_seconds
+    }
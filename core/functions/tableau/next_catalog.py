@@ -0,0 +1,206 @@
+# imports - Python/general
+import datetime, traceback
+
+# imports - Django
+from django.conf import settings
+
+# imports - our app
+# Models
+# N/A
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.catalog_store as catalog_store
+import core.functions.concurrency as concurrency
+import core.functions.tableau.next_api as tableau_next_api
+
+# The Tableau Next catalog: the Dashboards, Dashboard Widgets, Visualization Widget Definitions and Visualizations we need to find a Dashboard that answers a question. Rather than crawling all of these for every question, we keep a copy in the database (see core.functions.catalog_store) and only fetch what changed since the last sync.
+
+catalog_platform = "tableau_next"
+
+# The entity types we retrieve with SOQL, and which can be refreshed incrementally based on SystemModstamp.
+catalog_soql_entity_types = ["AnalyticsDashboard", "AnalyticsDashboardWidget", "AnalyticsVizWidgetDef"]
+
+# Visualizations come from the REST API (because that includes their fields), which does not let us ask for what changed. We do use SOQL to find out _whether_ anything changed, though.
+catalog_visualizations_entity_type = "AnalyticsVisualization"
+
+catalog_entity_types = catalog_soql_entity_types + [catalog_visualizations_entity_type]
+
+# The semantic models are not part of the Dashboard hierarchy, but we need them to rebuild Tableau Core vizzes on Tableau Next. There is no way to ask for what changed, so they are always refreshed fully.
+catalog_semantic_models_entity_type = "SemanticModel"
+
+# The only fields we ask for, per entity type: what we join on and pass on (see next_catalog_join and ask_your_data), and what we need to keep the catalog in sync. FIELDS(Standard) gives us a lot more than that. Every record comes with its "attributes" (including its type) regardless.
+catalog_soql_fields = {
+    "AnalyticsDashboard": ["Id", "MasterLabel", "DeveloperName", "SystemModstamp", "IsDeleted"],
+    "AnalyticsDashboardWidget": ["Id", "AnalyticsDashboardId", "Type", "SystemModstamp", "IsDeleted"],
+    "AnalyticsVizWidgetDef": ["Id", "AnalyticsDashboardWidgetId", "AnalyticsVisualizationId", "SystemModstamp", "IsDeleted"],
+    "AnalyticsVisualization": ["Id", "SystemModstamp", "IsDeleted"]
+}
+
+def get_catalog(connection_dict:dict, force_refresh:bool=False) -> dict:
+    """
+    Get the Tableau Next catalog, as a dict with one list of entities per entity type:
+
+    ```
+    {
+        "AnalyticsDashboard": [ ... ],
+        "AnalyticsDashboardWidget": [ ... ],
+        "AnalyticsVizWidgetDef": [ ... ],
+        "AnalyticsVisualization": [ ... ]
+    }
+    ```
+
+    The stored catalog is returned as long as it is not older than TNQ_CATALOG_MAX_AGE_SECONDS. If it is, it is refreshed (incrementally where possible) first. `force_refresh` skips the staleness check and does a full refresh.
+    """
+
+    if force_refresh or not catalog_store.is_fresh(catalog_platform, catalog_entity_types, max_age_seconds=settings.TNQ_CATALOG_MAX_AGE_SECONDS):
+        try:
+            refresh_catalog(connection_dict, force_full=force_refresh)
+        except Exception as e:
+            # A stale catalog is better than no catalog at all. If we never managed to sync, there is nothing to fall back to.
+            if not catalog_store.is_fresh(catalog_platform, catalog_entity_types, max_age_seconds=settings.TNQ_CATALOG_FULL_REFRESH_SECONDS):
+                raise
+            log_and_display_message(f"Failed to refresh the Tableau Next catalog, using the stored version instead:\n\t{e}\n\t{traceback.format_exc()}", level="warning")
+    else:
+        log_and_display_message(f"Using the stored Tableau Next catalog, synced less than { settings.TNQ_CATALOG_MAX_AGE_SECONDS } seconds ago.")
+
+    return load_catalog()
+
+def load_catalog() -> dict:
+    """
+    Read the stored Tableau Next catalog, without contacting Tableau Next at all.
+    """
+    return { entity_type: catalog_store.load_entries(catalog_platform, entity_type) for entity_type in catalog_entity_types }
+
+def refresh_catalog(connection_dict:dict, force_full:bool=False) -> dict:
+    """
+    Refresh all entity types of the Tableau Next catalog. Each entity type is refreshed incrementally if possible, and fully if it was never synced, if its last full sync is older than TNQ_CATALOG_FULL_REFRESH_SECONDS, or if `force_full` is set.
+
+    The API calls for the different entity types are independent, so they are made concurrently (at most TNQ_DISCOVERY_MAX_WORKERS at a time). With TNQ_NEXT_DISCOVERY_MODE "composite" (the default), the SOQL queries for all entity types are sent together in one Composite API request instead. Storing the results happens afterwards, one entity type at a time.
+
+    Returns the statistics per entity type. If any of the entity types failed to refresh, the others are still stored, after which the (first) error is raised.
+    """
+
+    log_and_display_message(f"Refreshing the Tableau Next catalog{ ' (forced full refresh)' if force_full else '' }.")
+
+    # Determine, per entity type, whether we can do an incremental refresh and from which point on.
+    modified_since_per_entity_type = {}
+    for entity_type in catalog_entity_types:
+        sync_state = catalog_store.get_sync_state(catalog_platform, entity_type)
+        if force_full or catalog_store.needs_full_sync(sync_state, full_sync_interval_seconds=settings.TNQ_CATALOG_FULL_REFRESH_SECONDS):
+            modified_since_per_entity_type[entity_type] = None
+        else:
+            modified_since_per_entity_type[entity_type] = sync_state.high_water_mark
+
+    if settings.TNQ_NEXT_DISCOVERY_MODE == "composite":
+        calls = { "composite": (fetch_soql_changes_composite, { "connection_dict": connection_dict, "modified_since_per_entity_type": { entity_type: modified_since_per_entity_type[entity_type] for entity_type in catalog_soql_entity_types } }) }
+    else:
+        calls = { entity_type: (fetch_soql_entity_type_changes, { "connection_dict": connection_dict, "entity_type": entity_type, "modified_since": modified_since_per_entity_type[entity_type] }) for entity_type in catalog_soql_entity_types }
+    calls[catalog_visualizations_entity_type] = (fetch_visualizations_changes, { "connection_dict": connection_dict, "modified_since": modified_since_per_entity_type[catalog_visualizations_entity_type] })
+    call_outcomes = concurrency.run_concurrently(calls, max_workers=settings.TNQ_DISCOVERY_MAX_WORKERS, description="Tableau Next catalog calls")
+
+    # The composite call returns the changes for several entity types at once.
+    changes_per_entity_type = {}
+    refresh_errors = []
+    for call_name, call_outcome in call_outcomes.items():
+        if call_outcome["error"] is not None:
+            refresh_errors.append(call_outcome["error"])
+        elif call_name == "composite":
+            changes_per_entity_type.update(call_outcome["result"])
+        else:
+            changes_per_entity_type[call_name] = call_outcome["result"]
+
+    refresh_statistics = {}
+    for entity_type, changes in changes_per_entity_type.items():
+        id_key = "id" if entity_type == catalog_visualizations_entity_type else "Id"
+        modified_key = "lastModifiedDate" if entity_type == catalog_visualizations_entity_type else "SystemModstamp"
+        if changes["full_sync"]:
+            refresh_statistics[entity_type] = catalog_store.store_entries(catalog_platform, entity_type, records=changes["records"], id_key=id_key, modified_key=modified_key, full_sync=True, deleted_records=changes["deleted_records"])
+        elif len(changes["records"]) == 0 and len(changes["deleted_records"]) == 0:
+            catalog_store.touch_sync_state(catalog_platform, entity_type)
+            refresh_statistics[entity_type] = { "stored": 0, "deleted": 0, "full_sync": False }
+        else:
+            refresh_statistics[entity_type] = catalog_store.store_entries(catalog_platform, entity_type, records=changes["records"], id_key=id_key, modified_key=modified_key, deleted_records=changes["deleted_records"])
+
+    if len(refresh_errors) > 0:
+        raise refresh_errors[0]
+
+    return refresh_statistics
+
+def fetch_soql_entity_type_changes(connection_dict:dict, entity_type:str, modified_since:datetime.datetime=None) -> dict:
+    """
+    Get what changed for one of the SOQL-based entity types. Without `modified_since`, everything is retrieved (full sync). With it, we only ask for entities with a more recent SystemModstamp, and include deleted entities so we can remove them.
+
+    Only talks to the API (no database access), so it can safely run in a separate thread. Returns a dict with "records", "deleted_records" and "full_sync".
+    """
+
+    if modified_since is None:
+        entities = tableau_next_api.get_entities_through_soql(connection=connection_dict, entity_type=entity_type, fields=catalog_soql_fields[entity_type])
+        return { "records": entities, "deleted_records": [], "full_sync": True }
+
+    changed_entities = tableau_next_api.get_entities_through_soql(connection=connection_dict, entity_type=entity_type, modified_since=modified_since, include_deleted=True, fields=catalog_soql_fields[entity_type])
+    return split_deleted_entities(changed_entities, full_sync=False)
+
+def fetch_soql_changes_composite(connection_dict:dict, modified_since_per_entity_type:dict) -> dict:
+    """
+    Same as fetch_soql_entity_type_changes, but for several entity types at once, in a single Composite API request. `modified_since_per_entity_type` has a datetime (incremental sync) or None (full sync) per entity type.
+
+    All queries use queryAll, as the Composite API request is shared; for a full sync, the deleted entities are only used for the high water mark. Returns a dict with the changes per entity type.
+    """
+
+    queries = { entity_type: tableau_next_api.build_soql_query(entity_type, fields=catalog_soql_fields[entity_type], modified_since=modified_since) for entity_type, modified_since in modified_since_per_entity_type.items() }
+    entities_per_entity_type = tableau_next_api.get_entities_through_soql_composite(connection=connection_dict, queries=queries, include_deleted=True)
+
+    return { entity_type: split_deleted_entities(entities_per_entity_type[entity_type], full_sync=modified_since_per_entity_type[entity_type] is None) for entity_type in queries }
+
+def split_deleted_entities(entities:list, full_sync:bool) -> dict:
+    """
+    Split SOQL results (from queryAll) into the entities to store and the ones that were deleted, in the format fetch_soql_entity_type_changes returns. A full sync removes anything not in its records anyway, but the deleted entities still count towards the high water mark.
+    """
+    return {
+        "records": [entity for entity in entities if not entity.get("IsDeleted", False)],
+        "deleted_records": [entity for entity in entities if entity.get("IsDeleted", False)],
+        "full_sync": full_sync
+    }
+
+def fetch_visualizations_changes(connection_dict:dict, modified_since:datetime.datetime=None) -> dict:
+    """
+    Get what changed for the Visualizations. The REST API only gives us the full collection, so we first check with SOQL whether any AnalyticsVisualization changed (or was deleted) since `modified_since`, and only re-get the collection if that is the case.
+
+    Same as fetch_soql_entity_type_changes: no database access, and returns a dict with "records", "deleted_records" and "full_sync".
+    """
+
+    if modified_since is not None:
+        changed_visualizations = tableau_next_api.get_entities_through_soql(connection=connection_dict, entity_type=catalog_visualizations_entity_type, modified_since=modified_since, include_deleted=True, fields=catalog_soql_fields[catalog_visualizations_entity_type])
+        if len(changed_visualizations) == 0:
+            return { "records": [], "deleted_records": [], "full_sync": False }
+        log_and_display_message(f"{ len(changed_visualizations) } Visualizations changed on Tableau Next since the last sync; getting the full collection again.")
+
+    all_visualizations_collection = tableau_next_api.get_visualization_collection(connection_dict)
+    return { "records": all_visualizations_collection, "deleted_records": [], "full_sync": True }
+
+def get_semantic_models(connection_dict:dict, force_refresh:bool=False) -> list:
+    """
+    Get all semantic models on Tableau Next (the "items" from tableau_next_api.get_all_semantic_models). Same as get_catalog: these come from our stored copy as long as it is not older than TNQ_CATALOG_MAX_AGE_SECONDS.
+    """
+
+    if force_refresh or not catalog_store.is_fresh(catalog_platform, [catalog_semantic_models_entity_type], max_age_seconds=settings.TNQ_CATALOG_MAX_AGE_SECONDS):
+        try:
+            refresh_semantic_models(connection_dict)
+        except Exception as e:
+            if not catalog_store.is_fresh(catalog_platform, [catalog_semantic_models_entity_type], max_age_seconds=settings.TNQ_CATALOG_FULL_REFRESH_SECONDS):
+                raise
+            log_and_display_message(f"Failed to refresh the Tableau Next semantic models, using the stored version instead:\n\t{e}\n\t{traceback.format_exc()}", level="warning")
+
+    return catalog_store.load_entries(catalog_platform, catalog_semantic_models_entity_type)
+
+def refresh_semantic_models(connection_dict:dict) -> dict:
+    """
+    Replace our stored copy of the semantic models with what is currently on Tableau Next.
+    """
+
+    all_semantic_models = tableau_next_api.get_all_semantic_models(connection_dict)
+    # get_all_semantic_models returns an empty dict when the request fails, which should not be mistaken for "there are no semantic models (anymore)".
+    if "items" not in all_semantic_models:
+        raise Exception("Could not get the semantic models from Tableau Next.")
+
+    return catalog_store.store_entries(catalog_platform, catalog_semantic_models_entity_type, records=all_semantic_models["items"], id_key="apiName", full_sync=True)
@@ -0,0 +1,39 @@
+# imports - Python/general
+# N/A
+
+# Reconciliation of the Tableau Next catalog: AnalyticsDashboard -> AnalyticsDashboardWidget -> AnalyticsVizWidgetDef -> AnalyticsVisualization. To compare it with the original nested scan on a synthetic catalog: python manage.py benchmark_catalog_join
+
+def group_by_key(records:list, key:str) -> dict:
+    """
+    Group a list of dicts by the value of one of their keys. Returns a dict with, for each value, the list of records having that value (in their original order).
+    """
+    grouped = {}
+    for record in records:
+        grouped.setdefault(record.get(key), []).append(record)
+    return grouped
+
+def build_dashboard_tree(dashboards:list, dashboard_widgets:list, viz_widget_defs:list, visualizations:list) -> list:
+    """
+    Add a "visualizations" list to each dashboard, containing all Visualizations (from the REST API, so including their fields) that are used in a visualization widget on that dashboard.
+
+    Rather than scanning the widgets, definitions and visualizations for every dashboard, we index them once by the key we join on (AnalyticsDashboardId, AnalyticsDashboardWidgetId, and the visualization's id), which makes this linear in the size of the catalog.
+
+    Visualizations used more than once on the same dashboard are only listed once. The dashboards are modified in place, and also returned for convenience.
+    """
+
+    widgets_by_dashboard_id = group_by_key([widget for widget in dashboard_widgets if widget.get("Type") == "visualization"], "AnalyticsDashboardId")
+    viz_widget_defs_by_widget_id = group_by_key(viz_widget_defs, "AnalyticsDashboardWidgetId")
+    visualizations_by_id = { viz.get("id"): viz for viz in visualizations } # Here id is lowercase because it comes from the REST API
+
+    for dashboard in dashboards:
+        dashboard_vizzes = []
+        dashboard_viz_ids = set()
+        for widget in widgets_by_dashboard_id.get(dashboard.get("Id"), []):
+            for defn in viz_widget_defs_by_widget_id.get(widget.get("Id"), []):
+                viz_id = defn.get("AnalyticsVisualizationId")
+                if viz_id in visualizations_by_id and viz_id not in dashboard_viz_ids:
+                    dashboard_viz_ids.add(viz_id)
+                    dashboard_vizzes.append(visualizations_by_id[viz_id])
+        dashboard["visualizations"] = dashboard_vizzes
+
+    return dashboards
@@ -1,20 +1,159 @@
 # imports - Python/general
-import requests
+import requests, time, threading, atexit
 
 # imports - Django
 from django.conf import settings
+from django.core.cache import cache
 
 # imports - our app
 # Models
 
 # Functions
 from tableau_next_question.functions import log_and_display_message
+import core.functions.http_transport as http_transport
 
 # REST API-related functionality
 
-def connect() -> dict:
+# Session pool #
+# ------------ #
+# Signing in with a PAT invalidates the previous session for that PAT, so workers signing in for every question would sign each other out (and create a new session on the server each time). Instead, the signed-in session (its X-Tableau-Auth token, site and user) is kept in Django's cache per server and site, and shared by all workers. Only one of them signs in at a time, when there is no session yet or when Tableau rejected it.
+
+session_cache_key_prefix = "tnq:tableau_rest:session"
+session_lock_timeout_seconds = 60
+session_lock_poll_seconds = 0.25
+session_thread_lock = threading.Lock()
+
+# Within a process, we also reuse the connection dict (and its requests.Session, with its open connections) per server and site. Threads take turns changing them (and their headers).
+pooled_connections = {}
+pooled_connections_lock = threading.Lock()
+
+def connect(force_sign_in:bool=False) -> dict:
+    """
+    Get a connection to the Tableau Server/Cloud REST API for the site in the settings, in the same format as sign_in() returns it. The session is reused if there is a signed-in one; only if there isn't (or `force_sign_in` is set), we sign in.
+
+    Requests made with the connection's session that Tableau rejects with a 401 (e.g. because the session expired) are retried once after signing in again.
+    """
+
+    session_cache_key = get_session_cache_key()
+
+    signed_in_session = cache.get(session_cache_key)
+    if signed_in_session is None or force_sign_in:
+        signed_in_session = get_signed_in_session(session_cache_key, rejected_token=signed_in_session.get("token") if signed_in_session else None)
+
+    with pooled_connections_lock:
+        connection = pooled_connections.get(session_cache_key)
+        if connection is None:
+            connection = build_pooled_connection(session_cache_key, signed_in_session)
+            pooled_connections[session_cache_key] = connection
+        elif connection["token"] != signed_in_session["token"]:
+            # Another worker signed in again in the meantime.
+            use_signed_in_session(connection, signed_in_session)
+
+    # Used to tell whether the session is idle, when shutting down. Kept apart from the session itself, so that the session keeps the expiry it got when signing in (TNQ_REST_SESSION_MAX_AGE_SECONDS), and we never put back a session another worker just replaced.
+    cache.set(f"{ session_cache_key }:last_used_at", time.time(), timeout=settings.TNQ_REST_SESSION_MAX_AGE_SECONDS)
+
+    return connection
+
+def get_session_cache_key() -> str:
+    """
+    The cache key of the signed-in session for the server and site in the settings.
+    """
+    return f"{ session_cache_key_prefix }:{ settings.TABLEAU_SERVER_URL }:{ settings.TABLEAU_SITE_CONTENT_URL }"
+
+def get_signed_in_session(session_cache_key:str, rejected_token:str=None) -> dict:
+    """
+    Get the signed-in session from the cache or, if there is none or it holds the token Tableau just rejected, sign in. Only one worker signs in at a time; the others wait for its session to appear in the cache.
+    """
+
+    with session_thread_lock:
+        lock_acquired = cache.add(f"{ session_cache_key }:lock", True, timeout=session_lock_timeout_seconds)
+        waited_until = time.monotonic() + session_lock_timeout_seconds
+        while not lock_acquired:
+            time.sleep(session_lock_poll_seconds)
+            signed_in_session = cache.get(session_cache_key)
+            if signed_in_session is not None and signed_in_session.get("token") != rejected_token:
+                return signed_in_session
+            if time.monotonic() > waited_until:
+                # We go ahead without the lock, which is still the other worker's to release.
+                log_and_display_message("Timed out waiting for another worker to sign in to the REST API; signing in ourselves.", level="warning")
+                break
+            lock_acquired = cache.add(f"{ session_cache_key }:lock", True, timeout=session_lock_timeout_seconds)
+
+        try:
+            # Another worker may have signed in between our first check and getting the lock.
+            signed_in_session = cache.get(session_cache_key)
+            if signed_in_session is not None and signed_in_session.get("token") != rejected_token:
+                return signed_in_session
+            connection = sign_in()
+            signed_in_session = { key: connection[key] for key in ["tableau_url", "tableau_api_url", "tableau_site", "tableau_site_id", "tableau_site_content_url", "tableau_user_id", "token"] }
+            # The session expires TNQ_REST_SESSION_MAX_AGE_SECONDS after signing in, however much it is used.
+            cache.set(session_cache_key, signed_in_session, timeout=settings.TNQ_REST_SESSION_MAX_AGE_SECONDS)
+            cache.set(f"{ session_cache_key }:last_used_at", time.time(), timeout=settings.TNQ_REST_SESSION_MAX_AGE_SECONDS)
+            return signed_in_session
+        finally:
+            if lock_acquired:
+                cache.delete(f"{ session_cache_key }:lock")
+
+def build_pooled_connection(session_cache_key:str, signed_in_session:dict) -> dict:
     """
-    Connect to the Tableau Server/Cloud REST API, normally using the PAT stored in the settings. Returns a dict containing a number of useful connection attributes including the session token, site_id, etc. Most importantly, the Session is also returned and should probably be used for most future requests.
+    Build a connection dict (as sign_in() returns it) around a signed-in session, with a session that signs in again when Tableau rejects the token.
+    """
+
+    session = http_transport.create_session()
+    connection = {
+        "session": session,
+        "headers": {
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+    }
+    use_signed_in_session(connection, signed_in_session)
+
+    def reauthenticate_on_401(response:requests.Response, *args, **kwargs) -> requests.Response:
+        if response.status_code != 401 or getattr(response.request, "reauthenticated", False):
+            return response
+        log_and_display_message("The REST API rejected our session; signing in again and retrying.", level="warning")
+        new_signed_in_session = get_signed_in_session(session_cache_key, rejected_token=response.request.headers.get("X-Tableau-Auth"))
+        with pooled_connections_lock:
+            use_signed_in_session(connection, new_signed_in_session)
+        retried_request = response.request.copy()
+        retried_request.headers["X-Tableau-Auth"] = new_signed_in_session["token"]
+        retried_request.reauthenticated = True
+        return session.send(retried_request, **kwargs)
+
+    session.hooks["response"].append(reauthenticate_on_401)
+
+    return connection
+
+def use_signed_in_session(connection:dict, signed_in_session:dict):
+    """
+    Point a (pooled) connection dict to a signed-in session: its token, site and user. Hold pooled_connections_lock while doing so.
+    """
+    connection.update(signed_in_session)
+    connection["headers"]["X-Tableau-Auth"] = signed_in_session["token"]
+    connection["session"].headers.update(connection["headers"])
+
+def sign_out_idle_sessions():
+    """
+    Sign out of the pooled sessions of this process that nobody (no worker) used for TNQ_REST_SESSION_IDLE_SECONDS. Sessions still in use by other workers are left alone. Runs when the process exits.
+    """
+    with pooled_connections_lock:
+        connections = list(pooled_connections.items())
+    for session_cache_key, connection in connections:
+        try:
+            signed_in_session = cache.get(session_cache_key)
+            if signed_in_session is not None and signed_in_session.get("token") == connection["token"] and time.time() - cache.get(f"{ session_cache_key }:last_used_at", 0) > settings.TNQ_REST_SESSION_IDLE_SECONDS:
+                disconnect(connection)
+        except Exception as e:
+            log_and_display_message(f"Didn't manage to sign out of idle REST API session:\n\t{e}")
+
+atexit.register(sign_out_idle_sessions)
+
+def sign_in() -> dict:
+    """
+    Sign in to the Tableau Server/Cloud REST API, normally using the PAT stored in the settings. Returns a dict containing a number of useful connection attributes including the session token, site_id, etc. Most importantly, the Session is also returned and should probably be used for most future requests.
+
+    Every sign-in with a PAT invalidates the previous session for that PAT, so use connect() instead, which reuses the signed-in session.
     """
 
     tableau_server_url = settings.TABLEAU_SERVER_URL
@@ -25,7 +164,7 @@ def connect() -> dict:
 
     log_and_display_message(f"Authenticating to REST API for Tableau Server: { tableau_server_url } (\"{ tableau_site_content_url }\").")
 
-    session = requests.Session()
+    session = http_transport.create_session()
 
     connection = {}
     tableau_api_url = f"{ tableau_server_url }/api/{ tableau_api_version }" # Start with this version; we'll get a more accurate "measurement" later on.
@@ -77,8 +216,9 @@ def connect() -> dict:
     return connection
 
 def disconnect(rest_api_connection:dict):
-    """Invalidate a session that was spawned from a REST API token."""
+    """Invalidate a session that was spawned from a REST API token. If it is the pooled session, it is removed from the pool too."""
     log_and_display_message(f"Signing out of REST API session on \"{ rest_api_connection['tableau_api_url'] }\".")
+    forget_signed_in_session(rest_api_connection["token"])
     try:
         request_url = f"{ rest_api_connection['tableau_api_url'] }/auth/signout"
         response = rest_api_connection["session"].get(url=request_url)
@@ -87,26 +227,23 @@ def disconnect(rest_api_connection:dict):
         log_and_display_message(f"Didn't manage to disconnect our REST API session:\n\t{e}")
         return {}
 
-def fetch_paginated(entity_type:str, rest_api_connection:dict, page_size:int=200, for_entity_luid:str="", filter_expression:str="") -> list:
+def forget_signed_in_session(token:str):
     """
-    Function for generic fetching of Tableau entities in an environment. The entity type is expected to be plural ("projects", "workbooks", "flows", "datasources", "users", ...). We will specifically ask Tableau to return _all_ fields where supported (https://help.tableau.com/current/api/rest_api/en-us/REST/rest_api_concepts_fields.htm).
-
-    This is the pagination method to be used with most of the "traditional" entity types on Tableau: workbooks, projects, etc. In fact, at this point the only entity types using a different pagination method are Pulse-related. See the fetch_paginated_with_token() function below.
-
-    for_entity_luid applies to functions where a specific entity type has to be retrieved on a per-entity-basis. This is currently applicable to favorites, which is to be retrieved on a per-user basis. Also for group memberships which is... per group.
-
-    A filter_expression can be provided, following the standard syntax for the Tableau REST API. See: https://help.tableau.com/current/api/rest_api/en-us/REST/rest_api_concepts_filtering_and_sorting.htm
-    For example, to get data sources from only one specific project name, you could use: filter_expression="projectName:eq:My+Project+Name"
+    Remove a session we are signing out of from the pool and the cache, so nobody uses it anymore.
+    """
+    with pooled_connections_lock:
+        forgotten_session_cache_keys = [session_cache_key for session_cache_key, connection in pooled_connections.items() if connection["token"] == token]
+        for session_cache_key in forgotten_session_cache_keys:
+            pooled_connections.pop(session_cache_key, None)
+    for session_cache_key in forgotten_session_cache_keys:
+        signed_in_session = cache.get(session_cache_key)
+        if signed_in_session is not None and signed_in_session.get("token") == token:
+            cache.delete(session_cache_key)
+
+def get_items_url(entity_type:str, rest_api_connection:dict, for_entity_luid:str="") -> str:
+    """
+    The URL to fetch entities of a type from, as used by fetch_paginated (see there for entity_type and for_entity_luid).
     """
-    
-    log_and_display_message(f"Getting all entities of type { entity_type } with pagination through REST API session on \"{ rest_api_connection['tableau_api_url'] }\".")
-
-    # Pagination
-    # We used to define page_size here, but it is now a function argument with a default of 200.
-    page_number = 1
-    total_returned = 0
-    done = False
-
     if entity_type in ["schedules"]: # Schedules are Server-level (not Site) and has a different URI
         items_url = f"{rest_api_connection['tableau_api_url']}/{entity_type}"
     elif entity_type in ["site"]: # site = Site Settings are special too - just fetch the "top-level" resource. Not that we'd use these right away...
@@ -131,22 +268,52 @@ def fetch_paginated(entity_type:str, rest_api_connection:dict, page_size:int=200
         items_url = f"{rest_api_connection['tableau_api_url']}/sites/{rest_api_connection['tableau_site_id']}/recommendations?type=view"
     else:
         items_url = f"{rest_api_connection['tableau_api_url']}/sites/{rest_api_connection['tableau_site_id']}/{entity_type}"
+    return items_url
+
+def get_page_url(entity_type:str, items_url:str, page_size:int, page_number:int, filter_expression:str="") -> str:
+    """
+    The URL for one page of entities of a type, as used by fetch_paginated.
+    """
+    # Different URL _structures_?
+    if entity_type in ["datasources", "workbooks"]: # Datasources do not support the fields=_all_ specification, apparently. Also, we were having some trouble with workbooks, so here's to hoping we didn't need that.
+        request_url = items_url + f"?pageSize={page_size}&pageNumber={page_number}"
+    elif entity_type in ["extractRefreshes", "flowRuns"]: # extractRefresh tasks do not seem to support or need (?) pagination.
+        request_url = items_url + f"?fields=_all_"
+    else:
+        request_url = items_url + f"?pageSize={page_size}&pageNumber={page_number}&fields=_all_"
+    # And finally, do we need to append anything?
+    if entity_type == "views":
+        request_url += "&includeUsageStatistics=true"
+    # And finally finally, do we have a filter expression?
+    if len(filter_expression) > 0:
+        request_url += f"&filter={ filter_expression }"
+    return request_url
+
+def fetch_paginated(entity_type:str, rest_api_connection:dict, page_size:int=200, for_entity_luid:str="", filter_expression:str="") -> list:
+    """
+    Function for generic fetching of Tableau entities in an environment. The entity type is expected to be plural ("projects", "workbooks", "flows", "datasources", "users", ...). We will specifically ask Tableau to return _all_ fields where supported (https://help.tableau.com/current/api/rest_api/en-us/REST/rest_api_concepts_fields.htm).
+
+    This is the pagination method to be used with most of the "traditional" entity types on Tableau: workbooks, projects, etc. In fact, at this point the only entity types using a different pagination method are Pulse-related. See the fetch_paginated_with_token() function below.
+
+    for_entity_luid applies to functions where a specific entity type has to be retrieved on a per-entity-basis. This is currently applicable to favorites, which is to be retrieved on a per-user basis. Also for group memberships which is... per group.
+
+    A filter_expression can be provided, following the standard syntax for the Tableau REST API. See: https://help.tableau.com/current/api/rest_api/en-us/REST/rest_api_concepts_filtering_and_sorting.htm
+    For example, to get data sources from only one specific project name, you could use: filter_expression="projectName:eq:My+Project+Name"
+    """
+    
+    log_and_display_message(f"Getting all entities of type { entity_type } with pagination through REST API session on \"{ rest_api_connection['tableau_api_url'] }\".")
+
+    # Pagination
+    # We used to define page_size here, but it is now a function argument with a default of 200.
+    page_number = 1
+    total_returned = 0
+    done = False
+
+    items_url = get_items_url(entity_type, rest_api_connection, for_entity_luid=for_entity_luid)
     all_items = []
 
     while not done:
-        # Different URL _structures_?
-        if entity_type in ["datasources", "workbooks"]: # Datasources do not support the fields=_all_ specification, apparently. Also, we were having some trouble with workbooks, so here's to hoping we didn't need that.
-            request_url = items_url + f"?pageSize={page_size}&pageNumber={page_number}"
-        elif entity_type in ["extractRefreshes", "flowRuns"]: # extractRefresh tasks do not seem to support or need (?) pagination.
-            request_url = items_url + f"?fields=_all_"
-        else:
-            request_url = items_url + f"?pageSize={page_size}&pageNumber={page_number}&fields=_all_"
-        # And finally, do we need to append anything?
-        if entity_type == "views":
-            request_url += "&includeUsageStatistics=true"
-        # And finally finally, do we have a filter expression?
-        if len(filter_expression) > 0:
-            request_url += f"&filter={ filter_expression }"
+        request_url = get_page_url(entity_type, items_url, page_size=page_size, page_number=page_number, filter_expression=filter_expression)
         
         response = rest_api_connection["session"].get(url=request_url) # No try/catch here, the errors are caught outside.
         response_json = response.json()
@@ -230,7 +397,7 @@ def fetch_entity(entity_luid:str, entity_type:str, rest_api_connection:dict, for
     
     return all_items
 
-def download_view_image(rest_api_connection:dict, view_luid:str, no_cache:bool=False, filters: list[tuple[str, str]]=[]) -> bytes:
+def download_view_image(rest_api_connection:dict, view_luid:str, no_cache:bool=False, filters: list[tuple[str, str]]=[], viz_width:int=None, viz_height:int=None, resolution:str=None) -> bytes:
     """
     Download the image of a view in PNG format.
     
@@ -239,6 +406,8 @@ def download_view_image(rest_api_connection:dict, view_luid:str, no_cache:bool=F
         view_luid (`str`): the LUID of the view to be downloaded.
         no_cache (`bool`): when set to True, we'll try to avoid Tableau's cache by requesting an image with maxAge of 1 minute.
         filters (`list` of `tuple`s): A list of tuples with the filter (field) name and value. This is used to apply filters to the image. No need to pass the vf_ prefix to the field name. See the Tableau documentation for more information on how these filters are applied: https://help.tableau.com/current/api/rest_api/en-us/REST/rest_api_concepts_filtering_and_sorting.htm#Filter-query-views
+        viz_width, viz_height (`int`): the size (in pixels) to render the view at. Only views (dashboards) with an automatic or range size are rendered at this size; fixed-size ones keep theirs.
+        resolution (`str`): "high" to render at a higher pixel density.
     
     Returns:
         The downloaded image (PNG) in bytes format. Well, actually the response, but response.content is the image.
@@ -248,20 +417,35 @@ def download_view_image(rest_api_connection:dict, view_luid:str, no_cache:bool=F
     
     """
     
-    request_url = f"{ rest_api_connection['tableau_api_url'] }/sites/{ rest_api_connection['tableau_site_id'] }/views/{ view_luid }/image"
-
-    if no_cache:
-        request_url += "?maxAge=1"
-
-    if len(filters) > 0:
-        starting_character = "&" if no_cache else "?"
-        filter_string = "&".join([f"vf_{ filter[0] }={ filter[1] }" for filter in filters])
-        request_url += f"{ starting_character }{ filter_string }"
+    request_url = get_view_image_url(rest_api_connection, view_luid, no_cache=no_cache, filters=filters, viz_width=viz_width, viz_height=viz_height, resolution=resolution)
 
     log_and_display_message(f"Downloading image from \"{ request_url }\".")
     response = rest_api_connection["session"].get(url=request_url)
     return response
 
+def get_view_image_url(rest_api_connection:dict, view_luid:str, no_cache:bool=False, filters: list[tuple[str, str]]=[], viz_width:int=None, viz_height:int=None, resolution:str=None) -> str:
+    """
+    The URL to download the image of a view with; see download_view_image for the arguments.
+    """
+
+    request_url = f"{ rest_api_connection['tableau_api_url'] }/sites/{ rest_api_connection['tableau_site_id'] }/views/{ view_luid }/image"
+
+    query_parameters = []
+    if no_cache:
+        query_parameters.append("maxAge=1")
+    if viz_width:
+        query_parameters.append(f"vizWidth={ viz_width }")
+    if viz_height:
+        query_parameters.append(f"vizHeight={ viz_height }")
+    if resolution:
+        query_parameters.append(f"resolution={ resolution }")
+    query_parameters += [f"vf_{ filter[0] }={ filter[1] }" for filter in filters]
+
+    if len(query_parameters) > 0:
+        request_url += f"?{ '&'.join(query_parameters) }"
+
+    return request_url
+
 
 def download_file(rest_api_connection:dict, asset_type:str, luid:str, format:str) -> requests.Response: # Or should we return Entity?
     """
@@ -0,0 +1,193 @@
+# imports - Python/general
+import httpx
+
+# imports - Django
+from asgiref.sync import sync_to_async
+
+# imports - our app
+# Models
+# N/A
+# Functions
+from tableau_next_question.functions import log_and_display_message
+import core.functions.http_transport as http_transport
+import core.functions.tableau.rest_api as rest_api
+
+# Async counterparts of the functions in core.functions.tableau.rest_api, with the same signatures. The connection dict has the same attributes (token, site, user, ...) but holds an httpx.AsyncClient ("client") rather than a requests.Session ("session"). from_connection turns a connection from rest_api.connect into one of these, e.g. to run Metadata API queries concurrently (see core.functions.tableau.metadata_api_async).
+#
+# The signed-in session is the one pooled by rest_api.connect, so sync and async code share it rather than signing each other out. Going through the pool means going through Django's cache, i.e. the database, hence sync_to_async.
+
+connection_attributes = ["tableau_url", "tableau_api_url", "tableau_site", "tableau_site_id", "tableau_site_content_url", "tableau_user_id", "token"]
+
+async def connect(force_sign_in:bool=False) -> dict:
+    """
+    Get a connection to the Tableau Server/Cloud REST API for the site in the settings, reusing the pooled signed-in session (see rest_api.connect). Requests that Tableau rejects with a 401 are retried once after signing in again.
+
+    Close the connection's client with close() when done; use disconnect() only to sign out of the session altogether.
+    """
+
+    pooled_connection = await sync_to_async(rest_api.connect)(force_sign_in=force_sign_in)
+
+    connection = { key: pooled_connection[key] for key in connection_attributes }
+    connection["headers"] = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "X-Tableau-Auth": pooled_connection["token"]
+    }
+
+    async def sign_in_again(rejected_token:str) -> str:
+        log_and_display_message("The REST API rejected our session; signing in again and retrying.", level="warning")
+        signed_in_session = await sync_to_async(rest_api.get_signed_in_session)(rest_api.get_session_cache_key(), rejected_token=rejected_token)
+        connection.update({ key: signed_in_session[key] for key in connection_attributes })
+        connection["headers"]["X-Tableau-Auth"] = signed_in_session["token"]
+        connection["client"].headers.update(connection["headers"])
+        return signed_in_session["token"]
+
+    connection["client"] = http_transport.create_async_client(headers=connection["headers"], auth=http_transport.ReauthenticatingAuth("X-Tableau-Auth", sign_in_again))
+
+    return connection
+
+def from_connection(rest_api_connection:dict) -> dict:
+    """
+    Get an async connection for the signed-in session of a (sync) connection from rest_api.connect. Requests that Tableau rejects with a 401 are retried once after signing in again.
+
+    Call this from within the event loop the connection will be used in, and close the connection's client with close() when done.
+    """
+
+    connection = { key: rest_api_connection[key] for key in connection_attributes }
+    connection["headers"] = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "X-Tableau-Auth": rest_api_connection["token"]
+    }
+
+    async def sign_in_again(rejected_token:str) -> str:
+        log_and_display_message("The REST API rejected our session; signing in again and retrying.", level="warning")
+        signed_in_session = await sync_to_async(rest_api.get_signed_in_session)(rest_api.get_session_cache_key(), rejected_token=rejected_token)
+        connection.update({ key: signed_in_session[key] for key in connection_attributes })
+        connection["headers"]["X-Tableau-Auth"] = signed_in_session["token"]
+        connection["client"].headers.update(connection["headers"])
+        return signed_in_session["token"]
+
+    connection["client"] = http_transport.create_async_client(headers=connection["headers"], auth=http_transport.ReauthenticatingAuth("X-Tableau-Auth", sign_in_again))
+
+    return connection
+
+async def close(rest_api_connection:dict):
+    """
+    Close the connection's client, and the connections it keeps open. The signed-in session stays in the pool.
+    """
+    if "client" in rest_api_connection:
+        await rest_api_connection["client"].aclose()
+
+async def disconnect(rest_api_connection:dict):
+    """Invalidate a session that was spawned from a REST API token, remove it from the pool, and close the connection's client."""
+    log_and_display_message(f"Signing out of REST API session on \"{ rest_api_connection['tableau_api_url'] }\".")
+    await sync_to_async(rest_api.forget_signed_in_session)(rest_api_connection["token"])
+    try:
+        request_url = f"{ rest_api_connection['tableau_api_url'] }/auth/signout"
+        response = await rest_api_connection["client"].get(url=request_url)
+        return response.json()
+    except Exception as e:
+        log_and_display_message(f"Didn't manage to disconnect our REST API session:\n\t{e}")
+        return {}
+    finally:
+        await close(rest_api_connection)
+
+async def fetch_paginated(entity_type:str, rest_api_connection:dict, page_size:int=200, for_entity_luid:str="", filter_expression:str="") -> list:
+    """
+    Generic fetching of Tableau entities of a type (plural, e.g. "workbooks"), with pagination. See rest_api.fetch_paginated.
+    """
+
+    log_and_display_message(f"Getting all entities of type { entity_type } with pagination through REST API session on \"{ rest_api_connection['tableau_api_url'] }\".")
+
+    page_number = 1
+    total_returned = 0
+    done = False
+
+    items_url = rest_api.get_items_url(entity_type, rest_api_connection, for_entity_luid=for_entity_luid)
+    all_items = []
+
+    while not done:
+        request_url = rest_api.get_page_url(entity_type, items_url, page_size=page_size, page_number=page_number, filter_expression=filter_expression)
+
+        response = await rest_api_connection["client"].get(url=request_url) # No try/catch here, the errors are caught outside.
+        response_json = response.json()
+
+        if entity_type in ["site"]:
+            return [response_json[entity_type]] # List with one item to adhere to the structure of other assets
+        # extractRefreshes is _really_ a subtype of tasks, though the response _is_ tasks
+        elif entity_type in ["extractRefreshes", "flowRuns"] and len(response_json["tasks"]) > 0:
+            all_items += response_json["tasks"]["task"]
+        elif entity_type in ["group_memberships"]:
+            all_items += response_json.get("users", {}).get("user", [])
+        else:
+            if entity_type not in ["extractRefreshes", "flowRuns"] and int(response_json.get("pagination", {}).get("totalAvailable", 1)) > 0: # Assume we got _something_ back if there is no real pagination.
+                all_items += response_json.get(entity_type, {}).get(entity_type[:-1], [])
+            else:
+                return []
+        # Pagination logic
+        total_available = int(response_json.get("pagination", {}).get("totalAvailable", 1))
+        page_number += 1
+        total_returned += page_size
+        if total_returned >= total_available:
+            done = True
+
+    return all_items
+
+async def fetch_entity(entity_luid:str, entity_type:str, rest_api_connection:dict, for_user_luid:str="") -> list:
+    """
+    Generic fetching of one Tableau entity of a type (plural, e.g. "workbooks"). See rest_api.fetch_entity.
+    """
+
+    log_and_display_message(f"Getting single entities of type { entity_type } with ID \"{ entity_luid }\" through REST API session on \"{ rest_api_connection['tableau_api_url'] }\".")
+
+    items_url = rest_api.get_items_url(entity_type, rest_api_connection, for_entity_luid=for_user_luid)
+
+    # We still return a list for compatibility with other "levels"
+    all_items = []
+
+    # The entity ID, if not site or schedules.
+    if entity_type not in ["schedules", "site"]:
+        request_url = f"{ items_url }/{ entity_luid }?fields=_all_"
+    else:
+        request_url = f"{ items_url }"
+
+    if entity_type == "views":
+        request_url += "&includeUsageStatistics=true"
+
+    response = await rest_api_connection["client"].get(url=request_url) # No try/catch here, the errors are caught outside.
+    response_json = response.json()
+
+    if entity_type in ["site"]:
+        return [response_json[entity_type]]
+    elif entity_type in ["extractRefreshes", "flowRuns"] and len(response_json["tasks"]) > 0:
+        all_items += response_json["tasks"]["task"]
+    else:
+        if entity_type not in ["extractRefreshes", "flowRuns"] and int(response_json.get("pagination", {}).get("totalAvailable", 1)) > 0:
+            all_items = [response_json.get(entity_type[:-1], [])]
+        else:
+            return []
+
+    return all_items
+
+async def download_view_image(rest_api_connection:dict, view_luid:str, no_cache:bool=False, filters: list[tuple[str, str]]=[], viz_width:int=None, viz_height:int=None, resolution:str=None) -> httpx.Response:
+    """
+    Download the image of a view in PNG format. Returns the response; response.content is the image. See rest_api.download_view_image.
+    """
+
+    request_url = rest_api.get_view_image_url(rest_api_connection, view_luid, no_cache=no_cache, filters=filters, viz_width=viz_width, viz_height=viz_height, resolution=resolution)
+
+    log_and_display_message(f"Downloading image from \"{ request_url }\".")
+    response = await rest_api_connection["client"].get(url=request_url)
+    return response
+
+async def download_file(rest_api_connection:dict, asset_type:str, luid:str, format:str) -> httpx.Response:
+    """
+    Download the file "behind" a data source, workbook, or flow. See rest_api.download_file.
+    """
+
+    includeExtract_value = "True" if format == "yes_extract" else "False"
+    request_url = f"{ rest_api_connection['tableau_api_url'] }/sites/{rest_api_connection['tableau_site_id']}/{ asset_type }/{ luid }/content?includeExtract={ includeExtract_value }"
+    log_and_display_message(f"Downloading { asset_type } file from \"{ request_url }\".")
+    response = await rest_api_connection["client"].get(url=request_url)
+    return response
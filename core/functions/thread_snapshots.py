@@ -0,0 +1,51 @@
+# imports - Python/general
+import datetime
+
+# imports - Django
+from django.conf import settings
+from django.utils import timezone
+
+# imports - our app
+# Models
+from core.models import ThreadSnapshot
+# Functions
+from tableau_next_question.functions import log_and_display_message
+
+# Snapshots of what we used to answer a question in a Slack thread, e.g. the selected Tableau Core dashboard with its sheets, fields, upstream data sources and workbook. Follow-up actions in the same thread (such as the "rebuild on Tableau Next" button) read these rather than asking the APIs again.
+#
+# The snapshot format is versioned: when what we store changes, bump thread_snapshot_version, and snapshots in an older format are ignored (as if they had expired) rather than misread.
+
+thread_snapshot_version = 1
+
+def save_snapshot(slack_channel:str, thread_ts:str, data:dict) -> ThreadSnapshot:
+    """
+    Store (or replace) the snapshot for a thread, valid for TNQ_THREAD_SNAPSHOT_TTL_SECONDS. Expired snapshots of other threads are cleaned up along the way.
+    """
+    now = timezone.now()
+    ThreadSnapshot.objects.filter(expires_at__lt=now).delete()
+    thread_snapshot, thread_snapshot_created = ThreadSnapshot.objects.update_or_create(
+        slack_channel=slack_channel,
+        thread_ts=thread_ts,
+        defaults={
+            "version": thread_snapshot_version,
+            "data": data,
+            "created_at": now,
+            "expires_at": now + datetime.timedelta(seconds=settings.TNQ_THREAD_SNAPSHOT_TTL_SECONDS)
+        }
+    )
+    return thread_snapshot
+
+def load_snapshot(slack_channel:str, thread_ts:str) -> dict:
+    """
+    Get the snapshot data for a thread, or None if there is none, if it expired, or if it is in an older format.
+    """
+    thread_snapshot = ThreadSnapshot.objects.filter(slack_channel=slack_channel, thread_ts=thread_ts).first()
+    if thread_snapshot is None:
+        return None
+    if thread_snapshot.expires_at < timezone.now():
+        log_and_display_message(f"The snapshot for thread { thread_ts } in { slack_channel } expired at { thread_snapshot.expires_at }.")
+        return None
+    if thread_snapshot.version != thread_snapshot_version:
+        log_and_display_message(f"The snapshot for thread { thread_ts } in { slack_channel } has format version { thread_snapshot.version }, we need { thread_snapshot_version }.")
+        return None
+    return thread_snapshot.data
@@ -0,0 +1,144 @@
+# imports - Python/general
+import io, math, struct
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is optional: without it, images are sent as they are (the detail level is still chosen, and the tokens estimated).
+    Image = None
+
+# imports - Django
+from django.conf import settings
+
+# imports - our app
+# Functions
+from tableau_next_question.functions import log_and_display_message
+
+# The image of the selected dashboard is by far the largest part of what we send to OpenAI, in bytes as well as tokens. How OpenAI counts an image's tokens (https://platform.openai.com/docs/guides/images-vision#calculating-costs):
+#
+# - With "low" detail, the model sees the image at (at most) 512x512 pixels, for a fixed number of tokens.
+# - With "high" detail, the image is scaled to fit within 2048x2048, then (if larger) so that its shortest side is 768 pixels, and cut into tiles of 512x512. Every tile costs the same number of tokens.
+#
+# So rather than sending whatever Tableau renders, we:
+# - scale the image to the size OpenAI would scale it to anyway, which saves uploading pixels that are thrown away,
+# - shrink it a little further (at most TNQ_VISION_MAX_TILE_SNAP_SHRINK) when that saves a row or column of tiles, e.g. 1152x768 (3x2 tiles) becomes 1024x682 (2x2 tiles),
+# - use "low" detail for simple dashboards (at most TNQ_VISION_LOW_DETAIL_MAX_VISUALIZATIONS visualizations), unless TNQ_VISION_DETAIL says otherwise.
+#
+# The token counts are those of the GPT-4o family; other models weigh tiles differently, but scale the same way.
+
+tile_size = 512
+max_side = 2048
+shortest_side = 768
+base_tokens = 85
+tokens_per_tile = 170
+
+def get_png_size(image_bytes:bytes) -> tuple[int, int] | None:
+    """
+    The width and height of a PNG image, from its header. None if it is not a PNG.
+    """
+    if len(image_bytes) < 24 or image_bytes[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    return struct.unpack(">II", image_bytes[16:24])
+
+def get_scaled_size(width:int, height:int, detail:str) -> tuple[int, int]:
+    """
+    The size OpenAI scales an image to before looking at it.
+    """
+    if detail == "low":
+        scale = min(1, tile_size / max(width, height))
+    else:
+        scale = min(1, max_side / max(width, height))
+        if min(width, height) * scale > shortest_side:
+            scale = shortest_side / min(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def estimate_tokens(width:int, height:int, detail:str) -> int:
+    """
+    The tokens OpenAI counts for an image of this size.
+    """
+    if detail == "low":
+        return base_tokens
+    scaled_width, scaled_height = get_scaled_size(width, height, detail)
+    return base_tokens + tokens_per_tile * math.ceil(scaled_width / tile_size) * math.ceil(scaled_height / tile_size)
+
+def get_target_size(width:int, height:int, detail:str) -> tuple[int, int]:
+    """
+    The size we send an image at: the size OpenAI would scale it to, shrunk a little further if that saves tiles.
+    """
+    scaled_width, scaled_height = get_scaled_size(width, height, detail)
+    if detail == "low":
+        return scaled_width, scaled_height
+
+    # Shrinking either side to the tile boundary just below it; the one saving the most tiles wins (the least shrinking, if equal).
+    best_size = (scaled_width, scaled_height)
+    best_tiles = math.ceil(scaled_width / tile_size) * math.ceil(scaled_height / tile_size)
+    for side in [scaled_width, scaled_height]:
+        if side <= tile_size or side % tile_size == 0:
+            continue
+        scale = (side // tile_size) * tile_size / side
+        if scale < 1 - settings.TNQ_VISION_MAX_TILE_SNAP_SHRINK:
+            continue
+        size = (max(1, math.floor(scaled_width * scale)), max(1, math.floor(scaled_height * scale)))
+        tiles = math.ceil(size[0] / tile_size) * math.ceil(size[1] / tile_size)
+        if tiles < best_tiles or (tiles == best_tiles and size[0] * size[1] > best_size[0] * best_size[1]):
+            best_size, best_tiles = size, tiles
+    return best_size
+
+def choose_detail(visualization_count:int=None) -> str:
+    """
+    The detail level for a dashboard: TNQ_VISION_DETAIL, or with "auto", "low" for dashboards with at most TNQ_VISION_LOW_DETAIL_MAX_VISUALIZATIONS visualizations (when we know how many), "high" otherwise.
+    """
+    if settings.TNQ_VISION_DETAIL in ["low", "high"]:
+        return settings.TNQ_VISION_DETAIL
+    if visualization_count is not None and 0 < visualization_count <= settings.TNQ_VISION_LOW_DETAIL_MAX_VISUALIZATIONS:
+        return "low"
+    return "high"
+
+def prepare_image(image_bytes:bytes, visualization_count:int=None) -> dict:
+    """
+    Prepare a (PNG) dashboard image for OpenAI: choose the detail level, and scale and re-encode the image to match. Returns a dict with:
+
+    - `image_bytes`: the image to send: the original if it needs no scaling and re-encoding doesn't make it smaller (or without Pillow).
+    - `detail`: "low" or "high", for the image_url content.
+    - `original_bytes`, `bytes`: the size of the original and prepared image.
+    - `original_tokens`, `tokens`: the (estimated) tokens for the original image at "high" detail, and for the prepared image. None if we don't know the image's size.
+    """
+
+    detail = choose_detail(visualization_count)
+    prepared_image = { "image_bytes": image_bytes, "detail": detail, "original_bytes": len(image_bytes), "bytes": len(image_bytes), "original_tokens": None, "tokens": None }
+
+    original_size = get_png_size(image_bytes)
+    if original_size is None:
+        log_and_display_message(f"The image is not a PNG; sending it as it is, with { detail } detail.", level="warning")
+        return prepared_image
+    prepared_image["original_tokens"] = estimate_tokens(*original_size, detail="high")
+    prepared_image["tokens"] = estimate_tokens(*original_size, detail=detail)
+
+    target_size = get_target_size(*original_size, detail=detail)
+    if Image is None:
+        log_and_display_message(f"Pillow is not installed, so the image is sent at its original size ({ original_size[0] }x{ original_size[1] }), with { detail } detail.")
+        return prepared_image
+
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if target_size != original_size:
+                image = image.resize(target_size, Image.Resampling.LANCZOS)
+            image_buffer = io.BytesIO()
+            image.save(image_buffer, format="PNG", optimize=True)
+            if len(image_buffer.getvalue()) > len(image_bytes):
+                # Scaling smooths edges into many new colors, which PNG compresses poorly. Dashboards have few colors to begin with, so a palette of 256 loses little.
+                palette_image_buffer = io.BytesIO()
+                image.convert("RGB").quantize(colors=256).save(palette_image_buffer, format="PNG", optimize=True)
+                if len(palette_image_buffer.getvalue()) < len(image_buffer.getvalue()):
+                    image_buffer = palette_image_buffer
+    except Exception as e:
+        log_and_display_message(f"Could not resize the image, sending it as it is:\n\t{e}", level="warning")
+        return prepared_image
+
+    if target_size != original_size or len(image_buffer.getvalue()) < len(image_bytes):
+        prepared_image["image_bytes"] = image_buffer.getvalue()
+        prepared_image["bytes"] = len(prepared_image["image_bytes"])
+        prepared_image["tokens"] = estimate_tokens(*target_size, detail=detail)
+
+    log_and_display_message(f"Prepared the image for OpenAI: { original_size[0] }x{ original_size[1] } to { target_size[0] }x{ target_size[1] } pixels with { detail } detail; { prepared_image['original_bytes'] // 1024 } KB to { prepared_image['bytes'] // 1024 } KB ({ prepared_image['original_bytes'] - prepared_image['bytes'] } bytes saved), about { prepared_image['original_tokens'] } to { prepared_image['tokens'] } tokens ({ prepared_image['original_tokens'] - prepared_image['tokens'] } saved).")
+
+    return prepared_image
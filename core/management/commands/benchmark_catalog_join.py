@@ -0,0 +1,91 @@
+import copy, random, time
+
+from django.core.management.base import BaseCommand
+
+import core.functions.tableau.next_catalog_join as tableau_next_catalog_join
+
+# Benchmark of the reconciliation of the Tableau Next catalog (core.functions.tableau.next_catalog_join) against the original nested scan, on a synthetic catalog.
+
+def build_dashboard_tree_nested_scan(dashboards:list, dashboard_widgets:list, viz_widget_defs:list, visualizations:list) -> list:
+    """
+    The original reconciliation (nested list scans), only kept as a baseline for this benchmark (and the tests). Apart from being O(D·W·V), it also only keeps the visualizations of the _last_ definition per dashboard.
+    """
+    for dashboard in dashboards:
+        dashboard_widgets_for_dashboard = [widget for widget in dashboard_widgets if widget.get("AnalyticsDashboardId") == dashboard.get("Id") and widget.get("Type") == "visualization"]
+        for widget in dashboard_widgets_for_dashboard:
+            defns = [defn for defn in viz_widget_defs if defn.get("AnalyticsDashboardWidgetId") == widget.get("Id")]
+            for defn in defns:
+                dashboard["visualizations"] = [viz for viz in visualizations if viz.get("id") == defn.get("AnalyticsVisualizationId")]
+    return dashboards
+
+def generate_synthetic_catalog(n_dashboards:int, widgets_per_dashboard:int=4, seed:int=42) -> dict:
+    """
+    Generate a synthetic Tableau Next catalog with the same shape as the one we get from SOQL/the REST API. One in four widgets is not a visualization (e.g. a text widget).
+    """
+    randomizer = random.Random(seed)
+    dashboards, dashboard_widgets, viz_widget_defs, visualizations = [], [], [], []
+    for d in range(n_dashboards):
+        dashboards.append({ "Id": f"0FK{ d:012d}", "MasterLabel": f"Dashboard { d }", "DeveloperName": f"Dashboard_{ d }" })
+        for w in range(widgets_per_dashboard):
+            widget_id = f"0FW{ d:08d}{ w:04d}"
+            widget_type = "visualization" if w % 4 != 3 else "text"
+            dashboard_widgets.append({ "Id": widget_id, "AnalyticsDashboardId": f"0FK{ d:012d}", "Type": widget_type })
+            if widget_type == "visualization":
+                viz_id = f"1AV{ d:08d}{ w:04d}"
+                viz_widget_defs.append({ "Id": f"0FD{ d:08d}{ w:04d}", "AnalyticsDashboardWidgetId": widget_id, "AnalyticsVisualizationId": viz_id })
+                visualizations.append({ "id": viz_id, "label": f"Viz { d }.{ w }", "fields": { f"F{ f }": { "fieldName": f"field_{ randomizer.randint(0, 500) }" } for f in range(1, 4) } })
+    # The APIs do not return these grouped per dashboard, so neither do we.
+    randomizer.shuffle(dashboard_widgets)
+    randomizer.shuffle(viz_widget_defs)
+    randomizer.shuffle(visualizations)
+    return {
+        "AnalyticsDashboard": dashboards,
+        "AnalyticsDashboardWidget": dashboard_widgets,
+        "AnalyticsVizWidgetDef": viz_widget_defs,
+        "AnalyticsVisualization": visualizations
+    }
+
+def benchmark_build_dashboard_tree(n_dashboards:int=10000, nested_scan_sample:int=100) -> dict:
+    """
+    Compare the indexed join with the original nested scan on a synthetic catalog of n_dashboards dashboards.
+
+    The nested scan takes minutes at 10k dashboards, so it is only run for the first `nested_scan_sample` dashboards (against the _full_ widget/definition/visualization lists), and extrapolated linearly: each dashboard costs the same full scans. Pass nested_scan_sample=n_dashboards to time it completely.
+    """
+    catalog = generate_synthetic_catalog(n_dashboards)
+
+    dashboards = copy.deepcopy(catalog["AnalyticsDashboard"])
+    start = time.perf_counter()
+    tableau_next_catalog_join.build_dashboard_tree(dashboards, catalog["AnalyticsDashboardWidget"], catalog["AnalyticsVizWidgetDef"], catalog["AnalyticsVisualization"])
+    indexed_seconds = time.perf_counter() - start
+
+    nested_scan_sample = min(nested_scan_sample, n_dashboards)
+    dashboards_sample = copy.deepcopy(catalog["AnalyticsDashboard"][:nested_scan_sample])
+    start = time.perf_counter()
+    build_dashboard_tree_nested_scan(dashboards_sample, catalog["AnalyticsDashboardWidget"], catalog["AnalyticsVizWidgetDef"], catalog["AnalyticsVisualization"])
+    nested_scan_seconds = (time.perf_counter() - start) * n_dashboards / nested_scan_sample
+
+    return {
+        "dashboards": n_dashboards,
+        "dashboard_widgets": len(catalog["AnalyticsDashboardWidget"]),
+        "viz_widget_defs": len(catalog["AnalyticsVizWidgetDef"]),
+        "visualizations": len(catalog["AnalyticsVisualization"]),
+        "visualizations_joined": sum(len(dashboard["visualizations"]) for dashboard in dashboards),
+        "indexed_seconds": indexed_seconds,
+        "nested_scan_seconds": nested_scan_seconds,
+        "nested_scan_extrapolated": nested_scan_sample < n_dashboards,
+        "speedup": nested_scan_seconds / indexed_seconds if indexed_seconds > 0 else None
+    }
+
+class Command(BaseCommand):
+    help = "Compare the indexed join of the Tableau Next catalog with the original nested scan, on a synthetic catalog."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dashboards", type=int, default=10000, help="The number of dashboards in the synthetic catalog.")
+        parser.add_argument("--nested-scan-sample", type=int, default=100, help="The number of dashboards to time the nested scan for (it is extrapolated to all of them).")
+
+    def handle(self, *args, **options):
+        benchmark_results = benchmark_build_dashboard_tree(n_dashboards=options["dashboards"], nested_scan_sample=options["nested_scan_sample"])
+        self.stdout.write(f"Synthetic catalog: { benchmark_results['dashboards'] } dashboards, { benchmark_results['dashboard_widgets'] } widgets, { benchmark_results['viz_widget_defs'] } definitions, { benchmark_results['visualizations'] } visualizations.")
+        self.stdout.write(f"Indexed join: { benchmark_results['indexed_seconds']:.3f}s ({ benchmark_results['visualizations_joined'] } visualizations joined to their dashboards).")
+        self.stdout.write(f"Nested scan: { benchmark_results['nested_scan_seconds']:.3f}s{ ' (extrapolated from a sample)' if benchmark_results['nested_scan_extrapolated'] else '' }.")
+        self.stdout.write(f"Speedup: { benchmark_results['speedup']:.0f}x")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+import core.tasks as tasks
+
+class Command(BaseCommand):
+    help = "Create or update the scheduled tasks of this app in Django-Q2 (currently: pre-warming the catalogs)."
+
+    def handle(self, *args, **options):
+        prewarm_schedule = tasks.register_prewarm_schedule()
+        if prewarm_schedule is None:
+            self.stdout.write(f"Removed the \"{ tasks.prewarm_schedule_name }\" schedule (TNQ_PREWARM_INTERVAL_MINUTES is 0).")
+        else:
+            self.stdout.write(f"Scheduled \"{ prewarm_schedule.name }\" every { prewarm_schedule.minutes } minutes.")
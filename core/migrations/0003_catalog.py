@@ -0,0 +1,44 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:39
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_openaisettings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform', models.TextField()),
+                ('entity_type', models.TextField()),
+                ('entity_id', models.TextField()),
+                ('data', models.JSONField(default=dict)),
+                ('modified_at', models.DateTimeField(blank=True, null=True)),
+                ('synced_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['platform', 'entity_type'], name='core_catalo_platfor_513475_idx')],
+                'constraints': [models.UniqueConstraint(fields=('platform', 'entity_type', 'entity_id'), name='unique_catalog_entry')],
+            },
+        ),
+        migrations.CreateModel(
+            name='CatalogSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform', models.TextField()),
+                ('entity_type', models.TextField()),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('last_full_sync_at', models.DateTimeField(blank=True, null=True)),
+                ('high_water_mark', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('platform', 'entity_type'), name='unique_catalog_sync_state')],
+            },
+        ),
+    ]
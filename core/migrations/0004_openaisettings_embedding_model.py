@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_catalog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openaisettings',
+            name='embedding_model',
+            field=models.TextField(default='text-embedding-3-small'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:49
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_openaisettings_embedding_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slack_channel', models.TextField()),
+                ('thread_ts', models.TextField()),
+                ('version', models.IntegerField()),
+                ('data', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('slack_channel', 'thread_ts'), name='unique_thread_snapshot')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_threadsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question', models.TextField()),
+                ('embedder', models.TextField()),
+                ('embedding', models.BinaryField()),
+                ('platform', models.TextField()),
+                ('entity_id', models.TextField()),
+                ('content_hash', models.TextField()),
+                ('hits', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['embedder', 'expires_at'], name='core_questi_embedde_e14a6f_idx')],
+            },
+        ),
+    ]
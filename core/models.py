@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from encrypted_model_fields.fields import EncryptedCharField
 from django.contrib.auth import get_user_model
 
@@ -21,6 +22,83 @@ class OpenAISettings(models.Model):
     api_key = EncryptedCharField(null=True, blank=True)
     preferred_model = models.TextField(default="gpt-4o-mini", null=False, blank=False)
     max_completion_tokens = models.IntegerField(default=500, null=False, blank=False)
+    embedding_model = models.TextField(default="text-embedding-3-small", null=False, blank=False)
 
     def __repr__(self):
         return f"<OpenAISettings { self.id }>"
+
+# Catalog-related: locally persisted copies of the metadata we crawl on Tableau Next/Core, so that answering a question does not require crawling everything again.
+
+class CatalogEntry(models.Model):
+    platform = models.TextField() # "tableau_next" or "tableau_core"
+    entity_type = models.TextField() # e.g. "AnalyticsDashboard", "AnalyticsVisualization"
+    entity_id = models.TextField()
+    data = models.JSONField(default=dict)
+    modified_at = models.DateTimeField(null=True, blank=True) # As reported by the platform (SystemModstamp, updatedAt, ...)
+    synced_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["platform", "entity_type", "entity_id"], name="unique_catalog_entry"),
+        ]
+        indexes = [
+            models.Index(fields=["platform", "entity_type"]),
+        ]
+
+    def __repr__(self):
+        return f"<CatalogEntry { self.platform } { self.entity_type } { self.entity_id }>"
+
+class CatalogSyncState(models.Model):
+    platform = models.TextField()
+    entity_type = models.TextField()
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    last_full_sync_at = models.DateTimeField(null=True, blank=True)
+    high_water_mark = models.DateTimeField(null=True, blank=True) # Most recent modification date seen, used as the starting point of the next incremental refresh
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["platform", "entity_type"], name="unique_catalog_sync_state"),
+        ]
+
+    def __repr__(self):
+        return f"<CatalogSyncState { self.platform } { self.entity_type }>"
+
+# Thread-related: what we used to answer a question in a Slack thread, so follow-up actions in that thread (e.g. rebuilding the viz on Tableau Next) don't need to look it all up again.
+
+class ThreadSnapshot(models.Model):
+    slack_channel = models.TextField()
+    thread_ts = models.TextField()
+    version = models.IntegerField() # Format version of data, see core.functions.thread_snapshots
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["slack_channel", "thread_ts"], name="unique_thread_snapshot"),
+        ]
+
+    def __repr__(self):
+        return f"<ThreadSnapshot { self.slack_channel } { self.thread_ts }>"
+
+# Question-related: the visualizations we selected for earlier questions, so that a paraphrase of one of those can skip finding and selecting visualizations.
+
+class QuestionCacheEntry(models.Model):
+    question = models.TextField()
+    embedder = models.TextField() # Name of the embedder, see core.functions.catalog_embeddings; vectors of different embedders can't be compared
+    embedding = models.BinaryField() # The question's (unit length) embedding, as float32 bytes
+    platform = models.TextField() # "tableau_next" or "tableau_core"
+    entity_id = models.TextField() # The id of the selected candidate
+    content_hash = models.TextField() # Hash of the selected candidate's text when it was selected, see core.functions.question_cache
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    last_used_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["embedder", "expires_at"]),
+        ]
+
+    def __repr__(self):
+        return f"<QuestionCacheEntry { self.platform } { self.entity_id }>"
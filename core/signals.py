@@ -0,0 +1,19 @@
+# imports - Django
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+# imports - our app
+# Models
+from core.models import SlackCredential, OpenAISettings
+# Functions
+import core.functions.cached_settings as cached_settings
+
+# Connected in CoreConfig.ready (see apps.py).
+
+@receiver([post_save, post_delete], sender=SlackCredential)
+@receiver([post_save, post_delete], sender=OpenAISettings)
+def invalidate_cached_settings(sender, **kwargs):
+    """
+    Settings changed; don't keep using the cached copy (see core.functions.cached_settings).
+    """
+    cached_settings.invalidate(sender)
@@ -2,6 +2,9 @@
 import sys, datetime, logging
 from django_q.tasks import schedule, Schedule, async_task, AsyncTask
 
+# Django imports
+from django.conf import settings
+
 # App imports
 # Models
 from core.models import SlackCredential
@@ -27,6 +30,30 @@ def rebuild_core_viz_in_next(core_viz_luid:str, kwargs:dict) -> AsyncTask:
     """
     return async_task("core.functions.ask_your_data.rebuild_core_viz_in_next", core_viz_luid=core_viz_luid, kwargs=kwargs)
 
+# Scheduled tasks
+
+prewarm_schedule_name = "Pre-warm catalogs"
+
+def register_prewarm_schedule() -> Schedule:
+    """
+    Create (or update) the schedule that pre-warms our catalogs every TNQ_PREWARM_INTERVAL_MINUTES (see core.functions.ask_your_data.prewarm_catalogs), so that the first question after some idle time doesn't have to wait for everything to be fetched. Setting the interval to 0 removes the schedule.
+
+    Called by "python manage.py register_schedules"; running that again after changing the interval is all it takes.
+    """
+    if settings.TNQ_PREWARM_INTERVAL_MINUTES <= 0:
+        Schedule.objects.filter(name=prewarm_schedule_name).delete()
+        return None
+    prewarm_schedule, created = Schedule.objects.update_or_create(
+        name=prewarm_schedule_name,
+        defaults={
+            "func": "core.functions.ask_your_data.prewarm_catalogs",
+            "schedule_type": Schedule.MINUTES,
+            "minutes": settings.TNQ_PREWARM_INTERVAL_MINUTES,
+            "repeats": -1
+        }
+    )
+    return prewarm_schedule
+
 def test_task():
     with open("test_task.txt", "a") as f:
         f.write(f"Here we are at { datetime.datetime.now(datetime.timezone.utc) }\n")
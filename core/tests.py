@@ -1,3 +1,1468 @@
-from django.test import TestCase
+import datetime, email.utils, inspect, json, struct, tempfile, threading, time
+import concurrent.futures
+import httpx, urllib3
+import numpy as np
+import slack_sdk.errors, slack_sdk.web
+from pydantic import BaseModel
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django_q.models import Schedule
+
+# Models
+from core.models import CatalogEntry, CatalogSyncState, OpenAISettings, QuestionCacheEntry, SlackCredential, ThreadSnapshot
+# Functions
+import core.tasks as tasks
+import core.functions.ask_your_data as ask_your_data
+import core.functions.cached_settings as cached_settings
+import core.functions.catalog_embeddings as catalog_embeddings
+import core.functions.catalog_encoding as catalog_encoding
+import core.functions.catalog_search as catalog_search
+import core.functions.catalog_store as catalog_store
+import core.functions.slack as slack
+import core.functions.slack_dispatch as slack_dispatch
+import core.functions.slack_status as slack_status
+import core.functions.slack_streaming as slack_streaming
+import core.functions.concurrency as concurrency
+import core.functions.helpers_other as helpers_other
+import core.functions.http_transport as http_transport
+import core.functions.openai as openai
+import core.functions.question_cache as question_cache
+import core.functions.thread_snapshots as thread_snapshots
+import core.functions.vision_images as vision_images
+import core.functions.tableau.core_catalog as tableau_core_catalog
+import core.functions.tableau.metadata_api as tableau_metadata_api
+import core.functions.tableau.metadata_api_async as tableau_metadata_api_async
+import core.functions.tableau.next_api as tableau_next_api
+import core.functions.tableau.next_api_async as tableau_next_api_async
+import core.functions.tableau.next_auth as tableau_next_auth
+import core.functions.tableau.next_catalog as tableau_next_catalog
+import core.functions.tableau.next_catalog_join as tableau_next_catalog_join
+import core.functions.tableau.rest_api as tableau_rest_api
+import core.functions.tableau.rest_api_async as tableau_rest_api_async
+import core.views_slack as views_slack
+from core.management.commands.benchmark_catalog_join import build_dashboard_tree_nested_scan, generate_synthetic_catalog
 
 # Create your tests here.
+
+class CatalogStoreTests(TestCase):
+    """
+    Persisting the catalogs: full and incremental syncs, deletions, and the sync state they leave behind.
+    """
+
+    platform = "tableau_next"
+    entity_type = "AnalyticsDashboard"
+
+    def store(self, records:list, **kwargs) -> dict:
+        return catalog_store.store_entries(self.platform, self.entity_type, records, id_key="Id", modified_key="SystemModstamp", **kwargs)
+
+    def stored_ids(self) -> list:
+        return sorted(entry["Id"] for entry in catalog_store.load_entries(self.platform, self.entity_type))
+
+    def test_full_sync_replaces_everything(self):
+        self.store([{ "Id": "a", "SystemModstamp": "2025-08-01T10:00:00.000+0000" }, { "Id": "b", "SystemModstamp": "2025-08-02T10:00:00.000+0000" }], full_sync=True)
+        statistics = self.store([{ "Id": "b", "SystemModstamp": "2025-08-03T10:00:00.000+0000" }, { "Id": "c", "SystemModstamp": "2025-08-01T10:00:00.000+0000" }], full_sync=True)
+
+        self.assertEqual(self.stored_ids(), ["b", "c"])
+        self.assertEqual(statistics, { "stored": 2, "deleted": 1, "full_sync": True })
+        sync_state = catalog_store.get_sync_state(self.platform, self.entity_type)
+        self.assertIsNotNone(sync_state.last_full_sync_at)
+        self.assertEqual(sync_state.high_water_mark, datetime.datetime(2025, 8, 3, 10, tzinfo=datetime.timezone.utc))
+
+    def test_incremental_sync_updates_and_keeps_the_rest(self):
+        self.store([{ "Id": "a", "SystemModstamp": "2025-08-01T10:00:00.000+0000", "MasterLabel": "Old" }, { "Id": "b", "SystemModstamp": "2025-08-02T10:00:00.000+0000" }], full_sync=True)
+        full_sync_at = catalog_store.get_sync_state(self.platform, self.entity_type).last_full_sync_at
+        statistics = self.store([{ "Id": "a", "SystemModstamp": "2025-08-05T10:00:00.000+0000", "MasterLabel": "New" }, { "Id": "c", "SystemModstamp": "2025-08-04T10:00:00.000+0000" }])
+
+        self.assertEqual(self.stored_ids(), ["a", "b", "c"])
+        self.assertEqual(statistics, { "stored": 2, "deleted": 0, "full_sync": False })
+        self.assertEqual(CatalogEntry.objects.get(platform=self.platform, entity_type=self.entity_type, entity_id="a").data["MasterLabel"], "New")
+        sync_state = catalog_store.get_sync_state(self.platform, self.entity_type)
+        self.assertEqual(sync_state.last_full_sync_at, full_sync_at)
+        self.assertEqual(sync_state.high_water_mark, datetime.datetime(2025, 8, 5, 10, tzinfo=datetime.timezone.utc))
+
+    def test_incremental_sync_keeps_the_high_water_mark_without_newer_records(self):
+        self.store([{ "Id": "a", "SystemModstamp": "2025-08-05T10:00:00.000+0000" }], full_sync=True)
+        self.store([{ "Id": "b", "SystemModstamp": "2025-08-01T10:00:00.000+0000" }])
+
+        self.assertEqual(catalog_store.get_sync_state(self.platform, self.entity_type).high_water_mark, datetime.datetime(2025, 8, 5, 10, tzinfo=datetime.timezone.utc))
+
+    def test_incremental_sync_removes_deleted_ids(self):
+        self.store([{ "Id": "a" }, { "Id": "b" }, { "Id": "c" }], full_sync=True)
+        statistics = self.store([], deleted_ids=["a", "c", "unknown"])
+
+        self.assertEqual(self.stored_ids(), ["b"])
+        self.assertEqual(statistics["deleted"], 2)
+
+    def test_deleted_records_advance_the_high_water_mark(self):
+        self.store([{ "Id": "a", "SystemModstamp": "2025-08-01T10:00:00.000+0000" }, { "Id": "b", "SystemModstamp": "2025-08-01T10:00:00.000+0000" }], full_sync=True)
+        statistics = self.store([], deleted_records=[{ "Id": "a", "SystemModstamp": "2025-08-06T10:00:00.000+0000", "IsDeleted": True }])
+
+        self.assertEqual(self.stored_ids(), ["b"])
+        self.assertEqual(statistics["deleted"], 1)
+        self.assertEqual(catalog_store.get_sync_state(self.platform, self.entity_type).high_water_mark, datetime.datetime(2025, 8, 6, 10, tzinfo=datetime.timezone.utc))
+
+    def test_deleted_records_of_a_full_sync_advance_the_high_water_mark(self):
+        self.store([{ "Id": "a", "SystemModstamp": "2025-08-01T10:00:00.000+0000" }], full_sync=True, deleted_records=[{ "Id": "b", "SystemModstamp": "2025-08-06T10:00:00.000+0000", "IsDeleted": True }])
+
+        self.assertEqual(self.stored_ids(), ["a"])
+        self.assertEqual(catalog_store.get_sync_state(self.platform, self.entity_type).high_water_mark, datetime.datetime(2025, 8, 6, 10, tzinfo=datetime.timezone.utc))
+
+    def test_deletions_stay_within_the_platform_and_entity_type(self):
+        catalog_store.store_entries("tableau_core", self.entity_type, [{ "Id": "a" }], id_key="Id", full_sync=True)
+        self.store([{ "Id": "a" }], full_sync=True)
+        self.store([], full_sync=True)
+
+        self.assertEqual(self.stored_ids(), [])
+        self.assertEqual(len(catalog_store.load_entries("tableau_core", self.entity_type)), 1)
+
+    def test_needs_full_sync(self):
+        sync_state = catalog_store.get_sync_state(self.platform, self.entity_type)
+        self.assertTrue(catalog_store.needs_full_sync(sync_state, full_sync_interval_seconds=3600))
+
+        self.store([{ "Id": "a" }], full_sync=True)
+        sync_state = catalog_store.get_sync_state(self.platform, self.entity_type)
+        self.assertFalse(catalog_store.needs_full_sync(sync_state, full_sync_interval_seconds=3600))
+
+        CatalogSyncState.objects.filter(id=sync_state.id).update(last_full_sync_at=timezone.now() - datetime.timedelta(hours=2))
+        sync_state.refresh_from_db()
+        self.assertTrue(catalog_store.needs_full_sync(sync_state, full_sync_interval_seconds=3600))
+
+    def test_is_fresh(self):
+        self.assertFalse(catalog_store.is_fresh(self.platform, [self.entity_type], max_age_seconds=300))
+        self.store([{ "Id": "a" }], full_sync=True)
+        self.assertTrue(catalog_store.is_fresh(self.platform, [self.entity_type], max_age_seconds=300))
+
+        CatalogSyncState.objects.filter(platform=self.platform, entity_type=self.entity_type).update(last_synced_at=timezone.now() - datetime.timedelta(minutes=10))
+        self.assertFalse(catalog_store.is_fresh(self.platform, [self.entity_type], max_age_seconds=300))
+        catalog_store.touch_sync_state(self.platform, self.entity_type)
+        self.assertTrue(catalog_store.is_fresh(self.platform, [self.entity_type], max_age_seconds=300))
+
+    def test_timed_out_calls_do_not_write(self):
+        timed_out_event = threading.Event()
+        timed_out_event.set()
+        call_outcome = concurrency.run_timed(catalog_store.store_entries, { "platform": self.platform, "entity_type": self.entity_type, "records": [{ "Id": "A" }], "id_key": "Id", "full_sync": True }, timed_out_event)
+
+        self.assertIsInstance(call_outcome["error"], TimeoutError)
+        self.assertEqual(self.stored_ids(), [])
+        self.assertIsNone(concurrency.current_call.timed_out_event)
+
+class NextCatalogJoinTests(TestCase):
+    """
+    Joining the Tableau Next catalog: dashboards -> widgets -> definitions -> visualizations.
+    """
+
+    def test_joins_all_visualizations_of_a_dashboard(self):
+        dashboards = [{ "Id": "D1" }, { "Id": "D2" }]
+        dashboard_widgets = [
+            { "Id": "W1", "AnalyticsDashboardId": "D1", "Type": "visualization" },
+            { "Id": "W2", "AnalyticsDashboardId": "D1", "Type": "visualization" },
+            { "Id": "W3", "AnalyticsDashboardId": "D1", "Type": "text" },
+            { "Id": "W4", "AnalyticsDashboardId": "D1", "Type": "visualization" }, # The same visualization as W1
+            { "Id": "W5", "AnalyticsDashboardId": "D2", "Type": "visualization" },
+        ]
+        viz_widget_defs = [
+            { "AnalyticsDashboardWidgetId": "W1", "AnalyticsVisualizationId": "V1" },
+            { "AnalyticsDashboardWidgetId": "W2", "AnalyticsVisualizationId": "V2" },
+            { "AnalyticsDashboardWidgetId": "W3", "AnalyticsVisualizationId": "V3" },
+            { "AnalyticsDashboardWidgetId": "W4", "AnalyticsVisualizationId": "V1" },
+            { "AnalyticsDashboardWidgetId": "W5", "AnalyticsVisualizationId": "V9" }, # Not in the REST API's visualizations
+            { "AnalyticsDashboardWidgetId": "W9", "AnalyticsVisualizationId": "V2" }, # Widget not in the catalog
+        ]
+        visualizations = [{ "id": "V1" }, { "id": "V2" }, { "id": "V3" }]
+
+        tableau_next_catalog_join.build_dashboard_tree(dashboards, dashboard_widgets, viz_widget_defs, visualizations)
+
+        self.assertEqual([viz["id"] for viz in dashboards[0]["visualizations"]], ["V1", "V2"])
+        self.assertEqual(dashboards[1]["visualizations"], [])
+
+    def test_matches_the_nested_scan_per_widget(self):
+        # The nested scan keeps the visualizations of the last definition only, so we run it for one widget at a time: together, those should be what the join finds for the dashboard.
+        catalog = generate_synthetic_catalog(n_dashboards=25)
+        dashboards = tableau_next_catalog_join.build_dashboard_tree([dict(dashboard) for dashboard in catalog["AnalyticsDashboard"]], catalog["AnalyticsDashboardWidget"], catalog["AnalyticsVizWidgetDef"], catalog["AnalyticsVisualization"])
+
+        for dashboard in dashboards:
+            expected_viz_ids = set()
+            for widget in [widget for widget in catalog["AnalyticsDashboardWidget"] if widget["AnalyticsDashboardId"] == dashboard["Id"]]:
+                nested_scan_dashboard = build_dashboard_tree_nested_scan([{ "Id": dashboard["Id"], "visualizations": [] }], [widget], catalog["AnalyticsVizWidgetDef"], catalog["AnalyticsVisualization"])[0]
+                expected_viz_ids.update(viz["id"] for viz in nested_scan_dashboard["visualizations"])
+            self.assertEqual(len(dashboard["visualizations"]), 3)
+            self.assertEqual({ viz["id"] for viz in dashboard["visualizations"] }, expected_viz_ids)
+
+class ConcurrencyTests(TestCase):
+    """
+    Running independent calls concurrently: overlapping, errors per call, and timeouts.
+    """
+
+    def test_calls_overlap_and_keep_their_order(self):
+        def wait_and_return(value:str, seconds:float) -> str:
+            time.sleep(seconds)
+            return value
+
+        start = time.perf_counter()
+        call_outcomes = concurrency.run_concurrently({ name: (wait_and_return, { "value": name, "seconds": 0.2 }) for name in ["a", "b", "c", "d"] }, max_workers=4)
+
+        self.assertLess(time.perf_counter() - start, 0.6)
+        self.assertEqual(list(call_outcomes), ["a", "b", "c", "d"])
+        self.assertEqual([call_outcome["result"] for call_outcome in call_outcomes.values()], ["a", "b", "c", "d"])
+
+    def test_errors_stay_with_their_call(self):
+        def fail():
+            raise ValueError("Nope")
+
+        def succeed(value:int) -> int:
+            return value
+
+        call_outcomes = concurrency.run_concurrently({ "failing": (fail, {}), "working": (succeed, { "value": 2 }) })
+
+        self.assertIsInstance(call_outcomes["failing"]["error"], ValueError)
+        self.assertIsNone(call_outcomes["working"]["error"])
+        self.assertEqual(call_outcomes["working"]["result"], 2)
+
+    def test_timed_out_calls_are_reported_and_told_to_stop(self):
+        release_event = threading.Event()
+        checked_outcomes = []
+
+        def wait_then_check():
+            release_event.wait(timeout=5)
+            try:
+                concurrency.check_not_timed_out()
+                checked_outcomes.append("continued")
+            except TimeoutError:
+                checked_outcomes.append("stopped")
+
+        def return_right_away():
+            return None
+
+        call_outcomes = concurrency.run_concurrently({ "slow": (wait_then_check, {}), "fast": (return_right_away, {}) }, timeout=0.2)
+        self.assertTrue(call_outcomes["slow"]["timed_out"])
+        self.assertIsInstance(call_outcomes["slow"]["error"], TimeoutError)
+        self.assertFalse(call_outcomes["fast"]["timed_out"])
+
+        release_event.set()
+        for attempt in range(50):
+            if len(checked_outcomes) > 0:
+                break
+            time.sleep(0.05)
+        self.assertEqual(checked_outcomes, ["stopped"])
+
+@override_settings(TNQ_NEXT_DISCOVERY_MODE="per_entity_type")
+class NextCatalogRefreshTests(TestCase):
+    """
+    Refreshing the Tableau Next catalog with one (concurrent) request per entity type.
+    """
+
+    def get_entities_through_soql(self, connection:dict, entity_type:str, **kwargs) -> list:
+        if entity_type in self.failing_entity_types:
+            raise Exception(f"{ entity_type } failed")
+        return [{ "Id": f"{ entity_type }-1", "SystemModstamp": "2025-08-01T10:00:00.000+0000" }]
+
+    def refresh(self) -> dict:
+        with mock.patch.object(tableau_next_api, "get_entities_through_soql", side_effect=self.get_entities_through_soql), mock.patch.object(tableau_next_api, "get_visualization_collection", return_value=[{ "id": "V1", "lastModifiedDate": "2025-08-01T10:00:00.000Z" }]):
+            return tableau_next_catalog.refresh_catalog({})
+
+    def test_all_entity_types_are_stored(self):
+        self.failing_entity_types = []
+        refresh_statistics = self.refresh()
+
+        self.assertEqual(set(refresh_statistics), set(tableau_next_catalog.catalog_entity_types))
+        catalog = tableau_next_catalog.load_catalog()
+        self.assertEqual(catalog["AnalyticsDashboard"][0]["Id"], "AnalyticsDashboard-1")
+        self.assertEqual(catalog["AnalyticsVisualization"][0]["id"], "V1")
+
+    def test_a_failing_entity_type_does_not_keep_the_others_from_being_stored(self):
+        self.failing_entity_types = ["AnalyticsDashboardWidget"]
+        with self.assertRaisesMessage(Exception, "AnalyticsDashboardWidget failed"):
+            self.refresh()
+
+        catalog = tableau_next_catalog.load_catalog()
+        self.assertEqual(len(catalog["AnalyticsDashboard"]), 1)
+        self.assertEqual(len(catalog["AnalyticsDashboardWidget"]), 0)
+        self.assertEqual(len(catalog["AnalyticsVizWidgetDef"]), 1)
+
+class MetadataApiTests(TestCase):
+    """
+    Building and running the (paginated) Metadata API queries.
+    """
+
+    def test_filtered_queries_paginate(self):
+        query_components = tableau_metadata_api.parse_query_to_components(tableau_core_catalog.get_query("workbooksDashboardsSheetsAndFields"))
+
+        first_page = tableau_metadata_api.build_paginated_query_payload(query_components, mda_filter={ "luidWithin": ["a", "b"] }, page_size=50)["query"]
+        self.assertIn('workbooksConnection (filter: { luidWithin: ["a", "b"] }, first: 50, orderBy: { field: ID, direction: ASC })', first_page)
+
+        next_page = tableau_metadata_api.build_paginated_query_payload(query_components, mda_filter={ "luidWithin": ["a", "b"] }, page_size=50, end_cursor="cursor")["query"]
+        self.assertIn('first: 50, after: "cursor"', next_page)
+
+    def test_changed_workbooks_are_fetched_concurrently_per_batch(self):
+        # Two pages per batch of luids, to check that the batches paginate too.
+        requested_queries = []
+
+        def respond(request:httpx.Request) -> httpx.Response:
+            query = json.loads(request.content)["query"]
+            requested_queries.append(query)
+            luids = json.loads(query[query.index("luidWithin: ") + len("luidWithin: "):query.index("] }") + 1])
+            if "after:" not in query:
+                return httpx.Response(200, json={ "data": { "workbooksConnection": { "nodes": [{ "luid": luids[0] }], "pageInfo": { "hasNextPage": len(luids) > 1, "endCursor": "page-2" } } } })
+            return httpx.Response(200, json={ "data": { "workbooksConnection": { "nodes": [{ "luid": luid } for luid in luids[1:]], "pageInfo": { "hasNextPage": False, "endCursor": None } } } })
+
+        rest_api_connection = { "tableau_url": "https://tableau.example.com", "tableau_api_url": "https://tableau.example.com/api/3.26", "tableau_site": "site", "tableau_site_id": "site-id", "tableau_site_content_url": "site", "tableau_user_id": "user-id", "token": "token-1" }
+        with mock.patch.object(tableau_core_catalog.tableau_rest_api_async.http_transport, "create_async_client", lambda headers=None, auth=None: httpx.AsyncClient(transport=httpx.MockTransport(respond), headers=headers)):
+            workbooks = async_to_sync(tableau_core_catalog.fetch_workbooks)(rest_api_connection, [["a", "b"], ["c"], ["d", "e", "f"]])
+
+        self.assertEqual(sorted(workbook["luid"] for workbook in workbooks), ["a", "b", "c", "d", "e", "f"])
+        self.assertEqual(len(requested_queries), 5)
+
+class CatalogSearchTests(TestCase):
+    """
+    Lexical (BM25) search through the candidates, and fusing it with other rankings.
+    """
+
+    candidates = [
+        { "source": "tableau_next", "id": "1", "label": "Sales Overview", "visualizations": ["Revenue by Region"], "fields": ["region", "revenue"] },
+        { "source": "tableau_next", "id": "2", "label": "Running Log", "visualizations": ["Distance per Week"], "fields": ["distance_km", "totalDuration"] },
+        { "source": "tableau_core", "id": "3", "label": "Team Runs", "visualizations": ["Runs by Athlete"], "fields": ["athlete", "distance_km"] },
+    ]
+
+    def test_tokenize(self):
+        self.assertEqual(catalog_search.tokenize("How many runs did the team log? distance_km totalDuration"), ["many", "run", "team", "log", "distance", "km", "total", "duration"])
+        self.assertEqual(catalog_search.tokenize("Show me the dashboard"), [])
+        self.assertEqual(catalog_search.tokenize(None), [])
+
+    def test_rank_candidates(self):
+        ranking = catalog_search.rank_candidates("total distance of the runs", self.candidates)
+        self.assertEqual([candidate["id"] for candidate in ranking], ["3", "2", "1"])
+
+        # Only 3 has the term "run" ("Running" is not reduced to it); the others follow in their original order.
+        self.assertEqual([candidate["id"] for candidate in catalog_search.rank_candidates("runs", self.candidates)], ["3", "1", "2"])
+
+    def test_rank_matching_only(self):
+        ranking = catalog_search.rank_candidates("revenue", self.candidates, matching_only=True)
+        self.assertEqual([candidate["id"] for candidate in ranking], ["1"])
+        self.assertEqual(catalog_search.rank_candidates("nothing matches this", self.candidates, matching_only=True), [])
+
+    def test_fuse_rankings(self):
+        lexical_ranking = [self.candidates[2], self.candidates[1]]
+        semantic_ranking = [self.candidates[1], self.candidates[0]]
+        fused = catalog_search.fuse_rankings(self.candidates, [lexical_ranking, semantic_ranking], top_n=3)
+        self.assertEqual([candidate["id"] for candidate in fused], ["2", "3", "1"])
+        self.assertEqual(len(catalog_search.fuse_rankings(self.candidates, [], top_n=2)), 2)
+
+class CountingEmbedder(catalog_embeddings.HashingEmbedder):
+    """
+    HashingEmbedder that remembers which texts it embedded.
+    """
+
+    def __init__(self):
+        super().__init__(dimensions=64)
+        self.embedded_texts = []
+
+    def embed(self, texts:list) -> np.ndarray:
+        self.embedded_texts += texts
+        return super().embed(texts)
+
+class CatalogEmbeddingsTests(TestCase):
+    """
+    The on-disk index of the candidates' embeddings, and searching it.
+    """
+
+    next_candidates = [
+        { "source": "tableau_next", "id": "1", "label": "Sales Overview", "visualizations": ["Revenue by Region"], "fields": ["region", "revenue"] },
+        { "source": "tableau_next", "id": "2", "label": "Running Log", "visualizations": ["Distance per Week"], "fields": ["distance_km"] },
+    ]
+    core_candidates = [
+        { "source": "tableau_core", "id": "3", "label": "Support Tickets", "visualizations": ["Open Tickets"], "fields": ["ticket_status"] },
+    ]
+
+    def setUp(self):
+        self.index_directory = tempfile.TemporaryDirectory()
+        self.index_dir = self.index_directory.name
+        self.embedder = CountingEmbedder()
+
+    def tearDown(self):
+        self.index_directory.cleanup()
+
+    def test_update_index_only_embeds_new_or_changed_candidates(self):
+        index = catalog_embeddings.update_index(self.next_candidates, embedder=self.embedder, index_dir=self.index_dir)
+        self.assertEqual(index["keys"], ["tableau_next:1", "tableau_next:2"])
+        self.assertEqual(len(self.embedder.embedded_texts), 2)
+
+        changed_candidates = [self.next_candidates[0], { **self.next_candidates[1], "fields": ["distance_km", "pace"] }]
+        catalog_embeddings.update_index(changed_candidates, embedder=self.embedder, index_dir=self.index_dir)
+        self.assertEqual(len(self.embedder.embedded_texts), 3)
+        self.assertIn("pace", self.embedder.embedded_texts[-1])
+
+    def test_update_index_prunes_candidates_that_are_gone(self):
+        catalog_embeddings.update_index(self.next_candidates + self.core_candidates, embedder=self.embedder, index_dir=self.index_dir)
+        catalog_embeddings.update_index(self.core_candidates, embedder=self.embedder, index_dir=self.index_dir)
+        self.assertEqual(catalog_embeddings.load_index(self.index_dir)["keys"], ["tableau_core:3"])
+
+    def test_update_index_without_pruning_keeps_the_other_candidates(self):
+        catalog_embeddings.update_index(self.next_candidates, embedder=self.embedder, index_dir=self.index_dir)
+        catalog_embeddings.update_index(self.core_candidates, embedder=self.embedder, index_dir=self.index_dir, prune=False)
+        self.assertEqual(sorted(catalog_embeddings.load_index(self.index_dir)["keys"]), ["tableau_core:3", "tableau_next:1", "tableau_next:2"])
+
+        # Nothing new, so nothing is embedded (or written) again.
+        catalog_embeddings.update_index(self.next_candidates + self.core_candidates, embedder=self.embedder, index_dir=self.index_dir, prune=False)
+        self.assertEqual(len(self.embedder.embedded_texts), 3)
+
+    def test_search(self):
+        index = catalog_embeddings.update_index(self.next_candidates + self.core_candidates, embedder=self.embedder, index_dir=self.index_dir)
+        results = catalog_embeddings.search(index, self.embedder.embed(["open tickets by status"])[0], top_k=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0][0], 2)
+        self.assertGreaterEqual(results[0][1], results[1][1])
+        self.assertEqual(catalog_embeddings.search(index, self.embedder.embed(["anything"])[0], top_k=0), [])
+
+    def test_semantic_search_does_not_drop_other_candidates(self):
+        with override_settings(TNQ_CATALOG_INDEX_DIR=self.index_dir):
+            catalog_embeddings.update_index(self.next_candidates + self.core_candidates, embedder=self.embedder)
+            embedded_texts_count = len(self.embedder.embedded_texts)
+
+            # A question for which we only have the Tableau Next candidates.
+            results = catalog_embeddings.semantic_search("revenue per region", self.next_candidates, top_k=1, embedder=self.embedder)
+            self.assertEqual([candidate["id"] for candidate in results], ["1"])
+
+        self.assertEqual(len(catalog_embeddings.load_index(self.index_dir)["keys"]), 3)
+        # Only the question was embedded.
+        self.assertEqual(self.embedder.embedded_texts[embedded_texts_count:], ["revenue per region"])
+
+class CatalogEncodingTests(TestCase):
+    """
+    Encoding the candidates as a compact table within a token budget.
+    """
+
+    candidates = [
+        { "source": "tableau_next", "id": f"{ number }", "label": f"Dashboard { number }", "visualizations": ["Distance per Week", "Distance per Week", "Pace"], "fields": ["distance_km", "pace", "distance_km"] } for number in range(1, 11)
+    ]
+
+    def test_encode_candidate(self):
+        candidate = { "id": "0FK1", "label": "Running | stats;\n2025", "visualizations": ["Distance", "Distance", None, " "], "fields": ["distance_km", "pace"] }
+        self.assertEqual(catalog_encoding.encode_candidate(candidate), "0FK1|Running stats 2025|Distance|distance_km;pace")
+
+    def test_everything_fits(self):
+        encoded = catalog_encoding.encode_candidates(self.candidates, token_budget=10000)
+
+        self.assertEqual(encoded["text"].splitlines()[0], catalog_encoding.header)
+        self.assertEqual(encoded["text"].splitlines()[1], "1|Dashboard 1|Distance per Week;Pace|distance_km;pace")
+        self.assertEqual(len(encoded["candidates"]), 10)
+        self.assertEqual(encoded["truncated"], 0)
+        self.assertGreaterEqual(encoded["tokens"], catalog_encoding.estimate_tokens(encoded["text"])) # Rounded up per line
+
+    def test_the_budget_keeps_the_best_ranked_candidates(self):
+        line_tokens = catalog_encoding.estimate_tokens("\n" + catalog_encoding.encode_candidate(self.candidates[0]))
+        token_budget = catalog_encoding.estimate_tokens(catalog_encoding.header) + 3 * line_tokens
+        encoded = catalog_encoding.encode_candidates(self.candidates, token_budget=token_budget)
+
+        self.assertEqual([candidate["id"] for candidate in encoded["candidates"]], ["1", "2", "3"])
+        self.assertEqual([line.split("|")[0] for line in encoded["text"].splitlines()[1:]], ["1", "2", "3"])
+        self.assertEqual(encoded["truncated"], 7)
+        self.assertLessEqual(encoded["tokens"], token_budget)
+
+    def test_tokens_saved_only_counts_the_candidates_sent(self):
+        line_tokens = catalog_encoding.estimate_tokens("\n" + catalog_encoding.encode_candidate(self.candidates[0]))
+        encoded = catalog_encoding.encode_candidates(self.candidates, token_budget=catalog_encoding.estimate_tokens(catalog_encoding.header) + 3 * line_tokens)
+
+        self.assertEqual(encoded["tokens_saved"], catalog_encoding.estimate_tokens(json.dumps(self.candidates[:3], indent=4)) - encoded["tokens"])
+        self.assertGreater(encoded["tokens_saved"], 0)
+
+class StubbedResponse:
+    """
+    Just enough of a requests.Response for the API functions: ok, status_code, text and json().
+    """
+
+    def __init__(self, json_data:dict, status_code:int=200):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = json.dumps(json_data)
+
+    def json(self) -> dict:
+        return self.json_data
+
+class NextApiSoqlTests(TestCase):
+    """
+    Building SOQL queries, and running them through the Composite API with a stubbed session.
+    """
+
+    instance_url = "https://example.my.salesforce.com"
+
+    def connection(self, post_response:StubbedResponse, get_responses:dict={}) -> dict:
+        session = mock.Mock()
+        session.post.return_value = post_response
+        session.get.side_effect = lambda url: get_responses[url]
+        return { "session": session, "instance_url": self.instance_url }
+
+    def test_build_soql_query(self):
+        self.assertEqual(tableau_next_api.build_soql_query("AnalyticsDashboard"), "SELECT+FIELDS(Standard)+FROM+AnalyticsDashboard")
+        self.assertEqual(tableau_next_api.build_soql_query("AnalyticsDashboard", fields=["Id", "MasterLabel"]), "SELECT+Id,MasterLabel+FROM+AnalyticsDashboard")
+
+        # In UTC, and not quoted.
+        modified_since = datetime.datetime(2025, 8, 13, 16, 12, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+        self.assertEqual(tableau_next_api.build_soql_query("AnalyticsDashboard", fields=["Id"], modified_since=modified_since), "SELECT+Id+FROM+AnalyticsDashboard+WHERE+SystemModstamp+>+2025-08-13T14:12:30Z")
+
+    def test_include_deleted_uses_query_all(self):
+        connection = self.connection(StubbedResponse({ "compositeResponse": [] }), get_responses={ f"{ self.instance_url }/services/data/v64.0/queryAll?q=SELECT+Id+FROM+AnalyticsDashboard": StubbedResponse({ "records": [{ "Id": "a" }] }) })
+        self.assertEqual(tableau_next_api.get_entities_through_soql(connection, "AnalyticsDashboard", include_deleted=True, fields=["Id"]), [{ "Id": "a" }])
+
+    def test_composite_splits_the_subresponses_and_follows_next_records(self):
+        post_response = StubbedResponse({ "compositeResponse": [
+            { "referenceId": "AnalyticsDashboardWidget", "httpStatusCode": 200, "body": { "records": [{ "Id": "W1" }], "nextRecordsUrl": "/services/data/v64.0/query/01g-2000" } },
+            { "referenceId": "AnalyticsDashboard", "httpStatusCode": 200, "body": { "records": [{ "Id": "D1" }, { "Id": "D2" }] } },
+        ] })
+        connection = self.connection(post_response, get_responses={ f"{ self.instance_url }/services/data/v64.0/query/01g-2000": StubbedResponse({ "records": [{ "Id": "W2" }] }) })
+        queries = { "AnalyticsDashboard": "SELECT+Id+FROM+AnalyticsDashboard", "AnalyticsDashboardWidget": "SELECT+Id+FROM+AnalyticsDashboardWidget" }
+
+        entities_per_query = tableau_next_api.get_entities_through_soql_composite(connection, queries, include_deleted=True)
+
+        self.assertEqual(entities_per_query, { "AnalyticsDashboardWidget": [{ "Id": "W1" }, { "Id": "W2" }], "AnalyticsDashboard": [{ "Id": "D1" }, { "Id": "D2" }] })
+        composite_request_body = connection["session"].post.call_args.kwargs["json"]
+        self.assertEqual(composite_request_body["compositeRequest"][0], { "method": "GET", "url": "/services/data/v64.0/queryAll?q=SELECT+Id+FROM+AnalyticsDashboard", "referenceId": "AnalyticsDashboard" })
+        self.assertFalse(composite_request_body["allOrNone"])
+
+    def test_composite_raises_for_a_failed_subresponse(self):
+        post_response = StubbedResponse({ "compositeResponse": [
+            { "referenceId": "AnalyticsDashboard", "httpStatusCode": 200, "body": { "records": [] } },
+            { "referenceId": "AnalyticsDashboardWidget", "httpStatusCode": 400, "body": [{ "errorCode": "INVALID_FIELD" }] },
+        ] })
+        with self.assertRaisesMessage(Exception, "while trying to fetch AnalyticsDashboardWidget"):
+            tableau_next_api.get_entities_through_soql_composite(self.connection(post_response), { "AnalyticsDashboard": "q1", "AnalyticsDashboardWidget": "q2" })
+
+    def test_composite_raises_for_a_missing_subresponse(self):
+        post_response = StubbedResponse({ "compositeResponse": [{ "referenceId": "AnalyticsDashboard", "httpStatusCode": 200, "body": { "records": [] } }] })
+        with self.assertRaisesMessage(Exception, "did not return results for AnalyticsDashboardWidget"):
+            tableau_next_api.get_entities_through_soql_composite(self.connection(post_response), { "AnalyticsDashboard": "q1", "AnalyticsDashboardWidget": "q2" })
+
+    def test_composite_takes_at_most_25_queries(self):
+        with self.assertRaises(ValueError):
+            tableau_next_api.get_entities_through_soql_composite(self.connection(StubbedResponse({})), { f"query{ number }": "q" for number in range(26) })
+
+class PrewarmScheduleTests(TestCase):
+    """
+    Registering the django_q schedule that pre-warms the catalogs.
+    """
+
+    def prewarm_schedules(self):
+        return Schedule.objects.filter(name=tasks.prewarm_schedule_name)
+
+    def test_registering_creates_one_schedule(self):
+        with override_settings(TNQ_PREWARM_INTERVAL_MINUTES=10):
+            prewarm_schedule = tasks.register_prewarm_schedule()
+            tasks.register_prewarm_schedule()
+
+        self.assertEqual(self.prewarm_schedules().count(), 1)
+        self.assertEqual(prewarm_schedule.func, "core.functions.ask_your_data.prewarm_catalogs")
+        self.assertEqual(prewarm_schedule.schedule_type, Schedule.MINUTES)
+        self.assertEqual(prewarm_schedule.minutes, 10)
+        self.assertEqual(prewarm_schedule.repeats, -1)
+
+    def test_registering_again_updates_the_interval(self):
+        with override_settings(TNQ_PREWARM_INTERVAL_MINUTES=10):
+            prewarm_schedule = tasks.register_prewarm_schedule()
+        with override_settings(TNQ_PREWARM_INTERVAL_MINUTES=30):
+            updated_prewarm_schedule = tasks.register_prewarm_schedule()
+
+        self.assertEqual(updated_prewarm_schedule.id, prewarm_schedule.id)
+        self.assertEqual(self.prewarm_schedules().get().minutes, 30)
+
+    def test_an_interval_of_0_removes_the_schedule(self):
+        with override_settings(TNQ_PREWARM_INTERVAL_MINUTES=10):
+            tasks.register_prewarm_schedule()
+        with override_settings(TNQ_PREWARM_INTERVAL_MINUTES=0):
+            self.assertIsNone(tasks.register_prewarm_schedule())
+            self.assertIsNone(tasks.register_prewarm_schedule())
+
+        self.assertFalse(self.prewarm_schedules().exists())
+
+class ThreadSnapshotTests(TestCase):
+    """
+    Storing and reading the snapshot of what answered a question in a Slack thread.
+    """
+
+    def test_save_and_load(self):
+        thread_snapshots.save_snapshot("C1", "1.1", { "view_luid": "a" })
+        self.assertEqual(thread_snapshots.load_snapshot("C1", "1.1"), { "view_luid": "a" })
+        self.assertIsNone(thread_snapshots.load_snapshot("C1", "2.2"))
+        self.assertIsNone(thread_snapshots.load_snapshot("C2", "1.1"))
+
+    def test_saving_again_overwrites(self):
+        thread_snapshots.save_snapshot("C1", "1.1", { "view_luid": "a" })
+        thread_snapshots.save_snapshot("C1", "1.1", { "view_luid": "b" })
+
+        self.assertEqual(thread_snapshots.load_snapshot("C1", "1.1"), { "view_luid": "b" })
+        self.assertEqual(ThreadSnapshot.objects.filter(slack_channel="C1", thread_ts="1.1").count(), 1)
+
+    def test_expired_snapshots_are_ignored_and_cleaned_up(self):
+        thread_snapshots.save_snapshot("C1", "1.1", { "view_luid": "a" })
+        ThreadSnapshot.objects.filter(thread_ts="1.1").update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertIsNone(thread_snapshots.load_snapshot("C1", "1.1"))
+
+        thread_snapshots.save_snapshot("C1", "2.2", { "view_luid": "b" })
+        self.assertFalse(ThreadSnapshot.objects.filter(thread_ts="1.1").exists())
+
+    @override_settings(TNQ_THREAD_SNAPSHOT_TTL_SECONDS=60)
+    def test_snapshots_expire_after_the_ttl(self):
+        thread_snapshot = thread_snapshots.save_snapshot("C1", "1.1", { "view_luid": "a" })
+        self.assertEqual(thread_snapshot.expires_at - thread_snapshot.created_at, datetime.timedelta(seconds=60))
+
+    def test_other_versions_are_ignored(self):
+        thread_snapshots.save_snapshot("C1", "1.1", { "view_luid": "a" })
+        ThreadSnapshot.objects.filter(thread_ts="1.1").update(version=thread_snapshots.thread_snapshot_version - 1)
+        self.assertIsNone(thread_snapshots.load_snapshot("C1", "1.1"))
+
+        # Saving again brings it up to date.
+        thread_snapshots.save_snapshot("C1", "1.1", { "view_luid": "b" })
+        self.assertEqual(thread_snapshots.load_snapshot("C1", "1.1"), { "view_luid": "b" })
+
+@override_settings(TNQ_HTTP_MAX_RETRIES=2, TNQ_HTTP_BACKOFF_FACTOR=1)
+class HttpTransportTests(TestCase):
+    """
+    The retry policies of the shared HTTP transport: Retry-After, the retry cap, and no read retries for POST requests.
+    """
+
+    def urlopen_with_retries(self, method:str, responses:list) -> tuple:
+        # A urllib3 pool whose requests get the given responses (or raise the given errors) in turn, without any network.
+        pool = urllib3.HTTPConnectionPool("tableau.example.com")
+        with mock.patch.object(pool, "_make_request", side_effect=responses) as make_request, mock.patch("urllib3.util.retry.time.sleep") as sleep:
+            try:
+                response = pool.urlopen(method, "/api/3.25/sites", retries=http_transport.build_retry(), preload_content=False)
+            except urllib3.exceptions.MaxRetryError as e:
+                response = e
+        return response, make_request.call_count, [call.args[0] for call in sleep.call_args_list]
+
+    def sync_response(self, status:int, headers:dict={}) -> urllib3.HTTPResponse:
+        return urllib3.HTTPResponse(body=b"{}", status=status, headers=headers, preload_content=False)
+
+    def test_sync_retries_honor_retry_after(self):
+        response, request_count, waits = self.urlopen_with_retries("POST", [self.sync_response(429, { "Retry-After": "3" }), self.sync_response(200)])
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(request_count, 2)
+        self.assertEqual(waits, [3.0])
+
+    def test_sync_retries_are_capped(self):
+        response, request_count, waits = self.urlopen_with_retries("GET", [self.sync_response(503) for attempt in range(5)])
+
+        # The last response is returned rather than raised, so the callers' own error handling applies.
+        self.assertEqual(response.status, 503)
+        self.assertEqual(request_count, 3)
+
+    def test_sync_post_is_not_retried_after_a_read_error(self):
+        read_error = urllib3.exceptions.ReadTimeoutError(None, "/api/3.25/sites", "Read timed out.")
+        response, request_count, waits = self.urlopen_with_retries("POST", [read_error, self.sync_response(200)])
+
+        self.assertIsInstance(response, urllib3.exceptions.MaxRetryError)
+        self.assertEqual(request_count, 1)
+
+    def test_get_retry_after_seconds(self):
+        request = httpx.Request("GET", "https://tableau.example.com/")
+        self.assertEqual(http_transport.get_retry_after_seconds(httpx.Response(429, headers={ "Retry-After": "7" }, request=request), attempt=0), 7.0)
+        self.assertEqual(http_transport.get_retry_after_seconds(httpx.Response(429, headers={ "Retry-After": "-5" }, request=request), attempt=0), 0.0)
+
+        retry_after_date = email.utils.format_datetime(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30), usegmt=True)
+        self.assertAlmostEqual(http_transport.get_retry_after_seconds(httpx.Response(503, headers={ "Retry-After": retry_after_date }, request=request), attempt=0), 30, delta=2)
+
+        # Without (a valid) Retry-After: exponential backoff.
+        self.assertEqual(http_transport.get_retry_after_seconds(httpx.Response(503, request=request), attempt=0), 0.0)
+        self.assertEqual(http_transport.get_retry_after_seconds(httpx.Response(503, request=request), attempt=2), 4.0)
+        self.assertEqual(http_transport.get_retry_after_seconds(httpx.Response(503, headers={ "Retry-After": "soon" }, request=request), attempt=1), 2.0)
+
+    def send_async(self, method:str, responses:list) -> tuple:
+        # A RetryingAsyncTransport whose requests go to an httpx.MockTransport, which gives the responses in turn.
+        requests_sent = []
+        def handler(request:httpx.Request) -> httpx.Response:
+            requests_sent.append(request)
+            return responses[len(requests_sent) - 1]
+        mock_transport = httpx.MockTransport(handler)
+
+        async def send():
+            async with httpx.AsyncClient(transport=http_transport.RetryingAsyncTransport()) as client:
+                return await client.request(method, "https://tableau.example.com/api/metadata/graphql", json={})
+
+        with mock.patch.object(httpx.AsyncHTTPTransport, "handle_async_request", side_effect=mock_transport.handle_async_request), mock.patch.object(http_transport.asyncio, "sleep", new=mock.AsyncMock()) as sleep:
+            response = async_to_sync(send)()
+        return response, len(requests_sent), [call.args[0] for call in sleep.call_args_list]
+
+    def test_async_retries_honor_retry_after(self):
+        response, request_count, waits = self.send_async("POST", [httpx.Response(429, headers={ "Retry-After": "3" }), httpx.Response(200, json={})])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request_count, 2)
+        self.assertEqual(waits, [3.0])
+
+    def test_async_retries_are_capped(self):
+        response, request_count, waits = self.send_async("GET", [httpx.Response(503) for attempt in range(5)])
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(request_count, 3)
+        self.assertEqual(waits, [0.0, 2.0])
+
+    def test_async_other_errors_are_not_retried(self):
+        response, request_count, waits = self.send_async("POST", [httpx.Response(500), httpx.Response(200)])
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(request_count, 1)
+
+class NextAuthTests(TestCase):
+    """
+    Sharing the Tableau Next access token between workers through the cache.
+    """
+
+    def setUp(self):
+        cache.delete(tableau_next_auth.token_cache_key)
+        cache.delete(tableau_next_auth.token_lock_cache_key)
+
+    def new_token(self, access_token:str="new-token") -> dict:
+        return { "access_token": access_token, "instance_url": "https://example.my.salesforce.com", "expires_at": time.time() + 3600 }
+
+    def test_token_is_cached_encrypted(self):
+        with mock.patch.object(tableau_next_auth, "request_token", return_value=self.new_token()) as request_token:
+            self.assertEqual(tableau_next_auth.get_token()["access_token"], "new-token")
+            self.assertEqual(tableau_next_auth.get_token()["access_token"], "new-token")
+        self.assertEqual(request_token.call_count, 1)
+        self.assertNotIn("new-token", str(cache.get(tableau_next_auth.token_cache_key)))
+
+    def test_waiting_for_the_lock_does_not_release_it(self):
+        cache.add(tableau_next_auth.token_lock_cache_key, True, timeout=60) # Held by another worker
+        with mock.patch.object(tableau_next_auth, "token_lock_timeout_seconds", 0.3), mock.patch.object(tableau_next_auth, "token_lock_poll_seconds", 0.05), mock.patch.object(tableau_next_auth, "request_token", return_value=self.new_token()):
+            self.assertEqual(tableau_next_auth.get_token()["access_token"], "new-token")
+        self.assertTrue(cache.get(tableau_next_auth.token_lock_cache_key))
+
+    def test_getting_the_lock_releases_it(self):
+        with mock.patch.object(tableau_next_auth, "request_token", return_value=self.new_token()):
+            tableau_next_auth.get_token(force_refresh=True)
+        self.assertIsNone(cache.get(tableau_next_auth.token_lock_cache_key))
+
+class RestApiSessionTests(TestCase):
+    """
+    Sharing the signed-in REST API session between workers through the cache.
+    """
+
+    def setUp(self):
+        self.session_cache_key = tableau_rest_api.get_session_cache_key()
+        for key in [self.session_cache_key, f"{ self.session_cache_key }:lock", f"{ self.session_cache_key }:last_used_at"]:
+            cache.delete(key)
+        tableau_rest_api.pooled_connections.clear()
+
+    def tearDown(self):
+        tableau_rest_api.pooled_connections.clear()
+
+    def signed_in_connection(self, token:str="token-1") -> dict:
+        return { "tableau_url": "https://tableau.example.com", "tableau_api_url": "https://tableau.example.com/api/3.26", "tableau_site": "site", "tableau_site_id": "site-id", "tableau_site_content_url": "site", "tableau_user_id": "user-id", "token": token }
+
+    def test_using_the_session_keeps_its_expiry(self):
+        with mock.patch.object(tableau_rest_api, "sign_in", return_value=self.signed_in_connection()) as sign_in:
+            tableau_rest_api.connect()
+            with mock.patch.object(tableau_rest_api.cache, "set", wraps=cache.set) as cache_set:
+                connection = tableau_rest_api.connect()
+        self.assertEqual(sign_in.call_count, 1)
+        self.assertEqual(connection["headers"]["X-Tableau-Auth"], "token-1")
+        self.assertNotIn(self.session_cache_key, [call.args[0] for call in cache_set.call_args_list])
+        self.assertIsNotNone(cache.get(f"{ self.session_cache_key }:last_used_at"))
+
+    def test_waiting_for_the_lock_does_not_release_it(self):
+        cache.add(f"{ self.session_cache_key }:lock", True, timeout=60) # Held by another worker
+        with mock.patch.object(tableau_rest_api, "session_lock_timeout_seconds", 0.3), mock.patch.object(tableau_rest_api, "session_lock_poll_seconds", 0.05), mock.patch.object(tableau_rest_api, "sign_in", return_value=self.signed_in_connection()):
+            self.assertEqual(tableau_rest_api.get_signed_in_session(self.session_cache_key)["token"], "token-1")
+        self.assertTrue(cache.get(f"{ self.session_cache_key }:lock"))
+
+    def test_signing_in_again_updates_the_pooled_connection(self):
+        with mock.patch.object(tableau_rest_api, "sign_in", side_effect=[self.signed_in_connection("token-1"), self.signed_in_connection("token-2")]):
+            connection = tableau_rest_api.connect()
+            self.assertIs(tableau_rest_api.connect(force_sign_in=True), connection)
+        self.assertEqual(connection["token"], "token-2")
+        self.assertEqual(connection["session"].headers["X-Tableau-Auth"], "token-2")
+
+class AsyncApiTests(TestCase):
+    """
+    The async variants of the Tableau Next and REST API modules, against an httpx.MockTransport.
+    """
+
+    instance_url = "https://example.my.salesforce.com"
+    rest_api_connection_attributes = { "tableau_url": "https://tableau.example.com", "tableau_api_url": "https://tableau.example.com/api/3.26", "tableau_site": "site", "tableau_site_id": "site-id", "tableau_site_content_url": "site", "tableau_user_id": "user-id", "token": "token-1" }
+
+    def mock_client(self, respond):
+        return lambda headers=None, auth=None: httpx.AsyncClient(transport=httpx.MockTransport(respond), headers=headers, auth=auth)
+
+    def test_same_signatures_as_the_sync_functions(self):
+        for sync_module, async_module in [(tableau_next_api, tableau_next_api_async), (tableau_rest_api, tableau_rest_api_async), (tableau_metadata_api, tableau_metadata_api_async)]:
+            async_functions = { name: function for name, function in vars(async_module).items() if inspect.iscoroutinefunction(function) and name != "close" }
+            self.assertGreater(len(async_functions), 0)
+            for name, async_function in async_functions.items():
+                self.assertEqual(inspect.signature(async_function).parameters, inspect.signature(getattr(sync_module, name)).parameters, f"{ async_module.__name__ }.{ name }")
+
+    def test_next_connect_retries_once_with_a_new_token_after_a_401(self):
+        authorizations = []
+
+        def respond(request:httpx.Request) -> httpx.Response:
+            authorizations.append(request.headers["Authorization"])
+            if request.headers["Authorization"] == "Bearer revoked":
+                return httpx.Response(401, json=[{ "errorCode": "INVALID_SESSION_ID" }])
+            return httpx.Response(200, json={ "workspaces": [{ "name": "Sales" }] })
+
+        def get_token(force_refresh:bool=False) -> dict:
+            return { "access_token": "fresh" if force_refresh else "revoked", "instance_url": self.instance_url }
+
+        async def list_workspaces() -> list:
+            connection_dict = await tableau_next_api_async.connect()
+            try:
+                return await tableau_next_api_async.list_workspaces(connection_dict)
+            finally:
+                await tableau_next_api_async.close(connection_dict)
+
+        with mock.patch.object(tableau_next_api_async.tableau_next_auth, "get_token", side_effect=get_token), mock.patch.object(tableau_next_api_async.http_transport, "create_async_client", self.mock_client(respond)):
+            workspaces = async_to_sync(list_workspaces)()
+
+        self.assertEqual(workspaces, [{ "name": "Sales" }])
+        self.assertEqual(authorizations, ["Bearer revoked", "Bearer fresh"])
+
+    def test_next_composite_query(self):
+        def respond(request:httpx.Request) -> httpx.Response:
+            if request.method == "POST":
+                self.assertEqual([subrequest["url"] for subrequest in json.loads(request.content)["compositeRequest"]], ["/services/data/v64.0/queryAll?q=q1", "/services/data/v64.0/queryAll?q=q2"])
+                return httpx.Response(200, json={ "compositeResponse": [
+                    { "referenceId": "AnalyticsDashboard", "httpStatusCode": 200, "body": { "records": [{ "Id": "D1" }], "nextRecordsUrl": "/services/data/v64.0/query/01g-2000" } },
+                    { "referenceId": "AnalyticsDashboardWidget", "httpStatusCode": 200, "body": { "records": [{ "Id": "W1" }] } },
+                ] })
+            return httpx.Response(200, json={ "records": [{ "Id": "D2" }] })
+
+        async def query() -> dict:
+            async with httpx.AsyncClient(transport=httpx.MockTransport(respond)) as client:
+                return await tableau_next_api_async.get_entities_through_soql_composite({ "client": client, "instance_url": self.instance_url }, { "AnalyticsDashboard": "q1", "AnalyticsDashboardWidget": "q2" }, include_deleted=True)
+
+        self.assertEqual(async_to_sync(query)(), { "AnalyticsDashboard": [{ "Id": "D1" }, { "Id": "D2" }], "AnalyticsDashboardWidget": [{ "Id": "W1" }] })
+
+    def test_rest_fetch_paginated(self):
+        page_numbers = []
+
+        def respond(request:httpx.Request) -> httpx.Response:
+            page_number = int(request.url.params["pageNumber"])
+            page_numbers.append(page_number)
+            return httpx.Response(200, json={ "pagination": { "pageNumber": str(page_number), "pageSize": "2", "totalAvailable": "3" }, "workbooks": { "workbook": [{ "id": f"wb-{ page_number }" }] } })
+
+        async def fetch() -> list:
+            async with httpx.AsyncClient(transport=httpx.MockTransport(respond)) as client:
+                return await tableau_rest_api_async.fetch_paginated("workbooks", { **self.rest_api_connection_attributes, "client": client }, page_size=2)
+
+        self.assertEqual(async_to_sync(fetch)(), [{ "id": "wb-1" }, { "id": "wb-2" }])
+        self.assertEqual(page_numbers, [1, 2])
+
+    def test_rest_download_view_image(self):
+        requested_urls = []
+
+        def respond(request:httpx.Request) -> httpx.Response:
+            requested_urls.append(str(request.url))
+            return httpx.Response(200, content=b"PNG")
+
+        async def download() -> httpx.Response:
+            async with httpx.AsyncClient(transport=httpx.MockTransport(respond)) as client:
+                return await tableau_rest_api_async.download_view_image({ **self.rest_api_connection_attributes, "client": client }, "view-1", viz_width=1536, viz_height=1024)
+
+        self.assertEqual(async_to_sync(download)().content, b"PNG")
+        self.assertEqual(requested_urls, [tableau_rest_api.get_view_image_url(self.rest_api_connection_attributes, "view-1", viz_width=1536, viz_height=1024)])
+
+class SlackClientTests(TestCase):
+    """
+    Reusing the Slack WebClient per bot token, and remembering which channels the bot is a member of.
+    """
+
+    def setUp(self):
+        slack.channel_memberships.clear()
+
+    def slack_webclient(self, is_member:bool) -> mock.Mock:
+        slack_webclient = mock.Mock(token="xoxb-1")
+        slack_webclient.conversations_info.return_value = { "channel": { "is_member": is_member } }
+        return slack_webclient
+
+    def test_webclients_are_reused_per_token(self):
+        slack_credential = SlackCredential(slack_app="App", slack_workspace_bot_user_access_token="xoxb-1")
+        self.assertIs(slack.get_webclient(slack_credential), slack.get_webclient(SlackCredential(slack_app="App", slack_workspace_bot_user_access_token="xoxb-1")))
+        self.assertIsNot(slack.get_webclient(slack_credential), slack.get_webclient(SlackCredential(slack_app="App", slack_workspace_bot_user_access_token="xoxb-2")))
+
+    def test_channels_are_checked_and_joined_once(self):
+        slack_webclient = self.slack_webclient(is_member=False)
+        slack.check_and_join_channel("C1", slack_webclient)
+        slack.check_and_join_channel("C1", slack_webclient)
+
+        slack_webclient.conversations_info.assert_called_once_with(channel="C1")
+        slack_webclient.conversations_join.assert_called_once_with(channel="C1")
+
+    def test_direct_messages_are_not_checked(self):
+        slack_webclient = self.slack_webclient(is_member=False)
+        slack.check_and_join_channel("D1", slack_webclient)
+
+        slack_webclient.conversations_info.assert_not_called()
+
+    @override_settings(TNQ_SLACK_CHANNEL_MEMBERSHIP_TTL_SECONDS=0)
+    def test_memberships_are_checked_again_after_the_ttl(self):
+        slack_webclient = self.slack_webclient(is_member=True)
+        slack.check_and_join_channel("C1", slack_webclient)
+        slack.check_and_join_channel("C1", slack_webclient)
+
+        self.assertEqual(slack_webclient.conversations_info.call_count, 2)
+        slack_webclient.conversations_join.assert_not_called()
+
+    def test_not_in_channel_joins_again_and_retries_once(self):
+        slack_webclient = self.slack_webclient(is_member=True)
+        slack.check_and_join_channel("C1", slack_webclient)
+        slack_webclient.conversations_info.return_value = { "channel": { "is_member": False } }
+        slack_api_call = mock.Mock(side_effect=[slack_sdk.errors.SlackApiError("not_in_channel", { "ok": False, "error": "not_in_channel" }), { "ok": True }])
+
+        self.assertEqual(slack.call_in_channel("C1", slack_webclient, slack_api_call), { "ok": True })
+        self.assertEqual(slack_api_call.call_count, 2)
+        slack_webclient.conversations_join.assert_called_once_with(channel="C1")
+
+    def test_other_errors_are_raised(self):
+        slack_webclient = self.slack_webclient(is_member=True)
+        slack_api_call = mock.Mock(side_effect=slack_sdk.errors.SlackApiError("channel_not_found", { "ok": False, "error": "channel_not_found" }))
+
+        with self.assertRaises(slack_sdk.errors.SlackApiError):
+            slack.call_in_channel("C1", slack_webclient, slack_api_call)
+        self.assertEqual(slack_api_call.call_count, 1)
+
+class CachedSettingsTests(TestCase):
+    """
+    The per-process copy of SlackCredential and OpenAISettings, and dropping it when they are saved or deleted.
+    """
+
+    def setUp(self):
+        cached_settings.cached_instances.clear()
+
+    def test_reads_once(self):
+        SlackCredential.objects.create(slack_app="App", slack_workspace_bot_user_access_token="xoxb-1")
+        cached_settings.get_first(SlackCredential)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_settings.get_first(SlackCredential).slack_workspace_bot_user_access_token, "xoxb-1")
+
+    def test_saving_slack_credentials_invalidates_the_copy(self):
+        slack_credential = SlackCredential.objects.create(slack_app="App", slack_workspace_bot_user_access_token="xoxb-1")
+        self.assertEqual(cached_settings.get_first(SlackCredential).slack_workspace_bot_user_access_token, "xoxb-1")
+
+        slack_credential.slack_workspace_bot_user_access_token = "xoxb-2"
+        slack_credential.save()
+        self.assertEqual(cached_settings.get_first(SlackCredential).slack_workspace_bot_user_access_token, "xoxb-2")
+
+        slack_credential.delete()
+        self.assertIsNone(cached_settings.get_first(SlackCredential))
+
+    def test_saving_openai_settings_invalidates_the_copy(self):
+        openai_settings = OpenAISettings.objects.create(api_key="sk-1", preferred_model="gpt-4o-mini")
+        self.assertEqual(cached_settings.get_first(OpenAISettings).preferred_model, "gpt-4o-mini")
+
+        openai_settings.preferred_model = "gpt-4o"
+        openai_settings.save()
+        self.assertEqual(cached_settings.get_first(OpenAISettings).preferred_model, "gpt-4o")
+
+    def test_changes_without_signals_are_read_after_the_ttl(self):
+        SlackCredential.objects.create(slack_app="App", slack_workspace_id="T1")
+        cached_settings.get_first(SlackCredential)
+        # As another process would: no signal in this one.
+        SlackCredential.objects.update(slack_workspace_id="T2")
+        self.assertEqual(cached_settings.get_first(SlackCredential).slack_workspace_id, "T1")
+
+        cached_settings.cached_instances[SlackCredential._meta.label] = (cached_settings.cached_instances[SlackCredential._meta.label][0], time.monotonic() - 1)
+        self.assertEqual(cached_settings.get_first(SlackCredential).slack_workspace_id, "T2")
+
+    def test_create(self):
+        self.assertIsNone(cached_settings.get_first(OpenAISettings))
+        self.assertIsNotNone(cached_settings.get_first(OpenAISettings, create=True))
+        self.assertEqual(OpenAISettings.objects.count(), 1)
+
+def wait_for(condition, timeout:float=5) -> bool:
+    """
+    Wait until a background thread made `condition` (a function without arguments) true, or the timeout passed.
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+@override_settings(TNQ_SLACK_STATUS_DEBOUNCE_SECONDS=0.2)
+class StatusReporterTests(TestCase):
+    """
+    The debounced status messages, with the Slack calls stubbed.
+    """
+
+    def setUp(self):
+        self.slack_calls = []
+        self.dispatch_patch = mock.patch.object(slack_status.slack, "dispatch", side_effect=self.dispatch)
+        self.dispatch_patch.start()
+        self.addCleanup(self.dispatch_patch.stop)
+
+    def dispatch(self, slack_credential, method_name:str, **kwargs) -> dict:
+        self.slack_calls.append((method_name, kwargs.get("ts"), kwargs.get("text")))
+        if method_name == "chat_postMessage":
+            return { "ok": True, "ts": f"ts-{ len(self.slack_calls) }" }
+        return { "ok": True }
+
+    def status_reporter(self) -> slack_status.StatusReporter:
+        return slack_status.StatusReporter(slack_channel="D1", slack_credential=SlackCredential(slack_workspace_bot_user_access_token="xoxb-1"), thread_ts="1.0", icon_emoji=":e:")
+
+    def test_changes_in_quick_succession_are_coalesced(self):
+        with self.status_reporter() as status_reporter:
+            status_reporter.update("Finding")
+            status_reporter.update("Reviewing")
+            status_reporter.update("Answering")
+            self.assertTrue(wait_for(lambda: len(self.slack_calls) > 0))
+
+        self.assertEqual(self.slack_calls, [("chat_postMessage", None, ":e: Answering"), ("chat_delete", "ts-1", None)])
+
+    def test_later_changes_update_the_message(self):
+        with self.status_reporter() as status_reporter:
+            status_reporter.update("Finding")
+            self.assertTrue(wait_for(lambda: len(self.slack_calls) == 1))
+            status_reporter.update("Answering")
+            self.assertTrue(wait_for(lambda: len(self.slack_calls) == 2))
+
+        self.assertEqual(self.slack_calls, [("chat_postMessage", None, ":e: Finding"), ("chat_update", "ts-1", ":e: Answering"), ("chat_delete", "ts-1", None)])
+
+    def test_a_status_after_clear_is_a_new_message(self):
+        with self.status_reporter() as status_reporter:
+            status_reporter.update("Finding")
+            self.assertTrue(wait_for(lambda: len(self.slack_calls) == 1))
+            status_reporter.clear()
+            status_reporter.update("Answering")
+            self.assertTrue(wait_for(lambda: len(self.slack_calls) == 3))
+
+        # The old message is removed before the new one is posted (below whatever was posted in between), never updated.
+        self.assertEqual(self.slack_calls, [("chat_postMessage", None, ":e: Finding"), ("chat_delete", "ts-1", None), ("chat_postMessage", None, ":e: Answering"), ("chat_delete", "ts-3", None)])
+
+    def test_close_removes_the_message_when_answering_fails(self):
+        with self.assertRaises(ValueError):
+            with self.status_reporter() as status_reporter:
+                status_reporter.update("Finding")
+                self.assertTrue(wait_for(lambda: len(self.slack_calls) == 1))
+                raise ValueError("Answering failed")
+
+        self.assertEqual(self.slack_calls[-1], ("chat_delete", "ts-1", None))
+        self.assertFalse(status_reporter.thread.is_alive())
+
+    def test_nothing_is_posted_when_closed_before_the_debounce(self):
+        with self.status_reporter() as status_reporter:
+            status_reporter.update("Finding")
+
+        self.assertEqual(self.slack_calls, [])
+
+class SlackDispatchTests(TestCase):
+    """
+    The outbound Slack queues: spacing per tier, retrying after a 429, and not waiting forever; with a stubbed WebClient.
+    """
+
+    def setUp(self):
+        # Fast tiers, so the tests don't take minutes. The queues (and their intervals) are per workspace, so every test gets its own.
+        tier_patch = mock.patch.dict(slack_dispatch.tier_requests_per_minute, { "tier3": 600, "special": 600 })
+        tier_patch.start()
+        self.addCleanup(tier_patch.stop)
+        self.workspace_id = f"T-{ self._testMethodName }"
+
+    def rate_limited_error(self, retry_after_seconds:str) -> slack_sdk.errors.SlackApiError:
+        response = slack_sdk.web.SlackResponse(client=None, http_verb="POST", api_url="https://slack.com/api/chat.update", req_args={}, data={ "ok": False, "error": "ratelimited" }, headers={ "Retry-After": retry_after_seconds }, status_code=429)
+        return slack_sdk.errors.SlackApiError("ratelimited", response)
+
+    def test_calls_of_a_tier_are_spaced(self):
+        sent_at = []
+        slack_webclient = mock.Mock()
+        def chat_update(**kwargs) -> dict:
+            sent_at.append(time.monotonic())
+            return { "ok": True, "ts": kwargs["ts"] }
+        slack_webclient.chat_update.side_effect = chat_update
+
+        futures = [slack_dispatch.send(slack_webclient, "chat_update", workspace_id=self.workspace_id, wait=False, channel="C1", ts=f"{ number }", text="Hi") for number in range(3)]
+
+        self.assertEqual([future.result(timeout=5)["ts"] for future in futures], ["0", "1", "2"])
+        self.assertTrue(all(later - earlier >= 0.09 for earlier, later in zip(sent_at, sent_at[1:])), sent_at)
+
+    def test_messages_are_spaced_per_channel(self):
+        sent_at = {}
+        slack_webclient = mock.Mock()
+        def chat_post_message(**kwargs) -> dict:
+            sent_at[kwargs["channel"]] = time.monotonic()
+            return { "ok": True }
+        slack_webclient.chat_postMessage.side_effect = chat_post_message
+
+        futures = [slack_dispatch.send(slack_webclient, "chat_postMessage", workspace_id=self.workspace_id, wait=False, channel=channel, text="Hi") for channel in ["C1", "C2"]]
+        for future in futures:
+            future.result(timeout=5)
+
+        self.assertLess(abs(sent_at["C1"] - sent_at["C2"]), 0.09)
+
+    def test_rate_limited_calls_are_retried_after_retry_after(self):
+        sent_at = []
+        slack_webclient = mock.Mock()
+        def chat_update(**kwargs) -> dict:
+            sent_at.append(time.monotonic())
+            if len(sent_at) == 1:
+                raise self.rate_limited_error("0.3")
+            return { "ok": True }
+        slack_webclient.chat_update.side_effect = chat_update
+
+        self.assertEqual(slack_dispatch.send(slack_webclient, "chat_update", workspace_id=self.workspace_id, channel="C1", ts="1.1", text="Hi"), { "ok": True })
+        self.assertEqual(len(sent_at), 2)
+        self.assertGreaterEqual(sent_at[1] - sent_at[0], 0.29)
+
+    @override_settings(TNQ_SLACK_MAX_RETRIES=1)
+    def test_rate_limited_calls_are_retried_at_most_max_retries(self):
+        slack_webclient = mock.Mock()
+        slack_webclient.chat_update.side_effect = self.rate_limited_error("0")
+
+        with self.assertRaises(slack_sdk.errors.SlackApiError):
+            slack_dispatch.send(slack_webclient, "chat_update", workspace_id=self.workspace_id, channel="C1", ts="1.1", text="Hi")
+        self.assertEqual(slack_webclient.chat_update.call_count, 2)
+
+    @override_settings(TNQ_SLACK_DISPATCH_TIMEOUT_SECONDS=0.2)
+    def test_waiting_for_a_stuck_queue_times_out(self):
+        release_event = threading.Event()
+        slack_webclient = mock.Mock()
+        def chat_update(**kwargs) -> dict:
+            release_event.wait(timeout=5)
+            return { "ok": True }
+        slack_webclient.chat_update.side_effect = chat_update
+
+        stuck_future = slack_dispatch.send(slack_webclient, "chat_update", workspace_id=self.workspace_id, wait=False, channel="C1", ts="1.1", text="Stuck")
+        with self.assertRaises(TimeoutError):
+            slack_dispatch.send(slack_webclient, "chat_update", workspace_id=self.workspace_id, channel="C1", ts="1.1", text="Queued")
+
+        # The call we stopped waiting for was taken off the queue, so it isn't sent once the queue moves again.
+        release_event.set()
+        stuck_future.result(timeout=5)
+        time.sleep(0.2)
+        self.assertEqual([call.kwargs["text"] for call in slack_webclient.chat_update.call_args_list], ["Stuck"])
+
+    def test_other_methods_are_refused(self):
+        with self.assertRaises(ValueError):
+            slack_dispatch.send(mock.Mock(), "conversations_info", channel="C1")
+
+class SlackEventDeduplicationTests(TestCase):
+    """
+    Recognizing repeated deliveries of the same Slack event.
+    """
+
+    def test_event_cache_key(self):
+        self.assertEqual(views_slack.event_cache_key({ "event_id": "Ev1", "event": { "channel": "D1", "ts": "1.2" } }), "tnq:slack_event:Ev1")
+        self.assertEqual(views_slack.event_cache_key({ "event": { "channel": "D1", "ts": "1.2" } }), "tnq:slack_event:D1:1.2")
+        self.assertIsNone(views_slack.event_cache_key({ "event": { "ts": "1.2" } }))
+        self.assertIsNone(views_slack.event_cache_key({}))
+
+    def test_claim_event(self):
+        request = mock.Mock(headers={})
+        self.assertTrue(views_slack.claim_event(request, { "event_id": "Ev2", "event": {} }))
+        self.assertFalse(views_slack.claim_event(request, { "event_id": "Ev2", "event": {} }))
+        views_slack.release_event({ "event_id": "Ev2", "event": {} })
+        self.assertTrue(views_slack.claim_event(request, { "event_id": "Ev2", "event": {} }))
+
+        # Without anything to recognize it by, an event is always processed.
+        self.assertTrue(views_slack.claim_event(request, { "event": {} }))
+        self.assertTrue(views_slack.claim_event(request, { "event": {} }))
+        views_slack.release_event({ "event": {} })
+
+class StreamingMessageTests(TestCase):
+    """
+    Writing a Slack message while the answer comes in.
+    """
+
+    def dispatch(self, slack_credential, method:str, wait:bool=True, **kwargs):
+        if wait:
+            return { "ok": True }
+        future = concurrent.futures.Future()
+        future.set_result({ "ok": True })
+        return future
+
+    @override_settings(TNQ_SLACK_STREAM_UPDATE_SECONDS=0)
+    def test_markdown_throughout(self):
+        with mock.patch.object(slack_streaming.slack, "post_message", return_value={ "ts": "1.1" }) as post_message, mock.patch.object(slack_streaming.slack, "dispatch", side_effect=self.dispatch) as dispatch:
+            streaming_message = slack_streaming.StreamingMessage(slack_channel="D1", slack_credential=None, thread_ts="1.0")
+            streaming_message.update("**Total**")
+            streaming_message.collect_pending_call(wait=True)
+            streaming_message.update("**Total** distance")
+            streaming_message.finish("**Total** distance: 42 km")
+
+        self.assertEqual(post_message.call_args.kwargs["text"], f"**Total**{ slack_streaming.writing_indicator }")
+        self.assertEqual([call.kwargs["markdown_text"] for call in dispatch.call_args_list], [f"**Total** distance{ slack_streaming.writing_indicator }", "**Total** distance: 42 km"])
+        self.assertTrue(all("text" not in call.kwargs for call in dispatch.call_args_list))
+
+class TTLLRUCacheTests(TestCase):
+    """
+    The in-process cache with a maximum size and age.
+    """
+
+    def test_get_and_set(self):
+        ttl_lru_cache = helpers_other.TTLLRUCache(max_entries=10, ttl_seconds=60)
+        self.assertIsNone(ttl_lru_cache.get("a"))
+        self.assertEqual(ttl_lru_cache.get("a", "default"), "default")
+        ttl_lru_cache.set("a", 1)
+        self.assertEqual(ttl_lru_cache.get("a"), 1)
+        ttl_lru_cache.delete("a")
+        self.assertIsNone(ttl_lru_cache.get("a"))
+        self.assertEqual(ttl_lru_cache.get_statistics(), { "entries": 0, "hits": 1, "misses": 3 })
+
+    def test_values_expire(self):
+        ttl_lru_cache = helpers_other.TTLLRUCache(max_entries=10, ttl_seconds=60)
+        with mock.patch.object(helpers_other.time, "monotonic", return_value=1000):
+            ttl_lru_cache.set("a", 1)
+        with mock.patch.object(helpers_other.time, "monotonic", return_value=1060):
+            self.assertEqual(ttl_lru_cache.get("a"), 1)
+        with mock.patch.object(helpers_other.time, "monotonic", return_value=1060.1):
+            self.assertIsNone(ttl_lru_cache.get("a"))
+        self.assertEqual(ttl_lru_cache.get_statistics()["entries"], 0)
+
+    def test_the_least_recently_used_value_makes_way(self):
+        ttl_lru_cache = helpers_other.TTLLRUCache(max_entries=2, ttl_seconds=60)
+        ttl_lru_cache.set("a", 1)
+        ttl_lru_cache.set("b", 2)
+        ttl_lru_cache.get("a")
+        ttl_lru_cache.set("c", 3)
+
+        self.assertEqual(ttl_lru_cache.get("a"), 1)
+        self.assertIsNone(ttl_lru_cache.get("b"))
+        self.assertEqual(ttl_lru_cache.get("c"), 3)
+
+    def test_nothing_is_kept_without_size_or_ttl(self):
+        for ttl_lru_cache in [helpers_other.TTLLRUCache(max_entries=0, ttl_seconds=60), helpers_other.TTLLRUCache(max_entries=10, ttl_seconds=0)]:
+            ttl_lru_cache.set("a", 1)
+            self.assertIsNone(ttl_lru_cache.get("a"))
+
+    def test_threads(self):
+        ttl_lru_cache = helpers_other.TTLLRUCache(max_entries=50, ttl_seconds=60)
+
+        def use_cache(thread_number:int):
+            for number in range(2000):
+                ttl_lru_cache.set((thread_number, number % 100), number)
+                ttl_lru_cache.get((thread_number, (number - 1) % 100))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(use_cache, range(8)))
+
+        statistics = ttl_lru_cache.get_statistics()
+        self.assertEqual(statistics["entries"], 50)
+        self.assertEqual(statistics["hits"] + statistics["misses"], 8 * 2000)
+
+class ChatCompletionCacheTests(TestCase):
+    """
+    Reusing the responses of openai_api_chat_completion for identical requests.
+    """
+
+    def setUp(self):
+        # A cache of its own, whatever TNQ_OPENAI_RESPONSE_CACHE_SECONDS is set to here.
+        cache_patch = mock.patch.object(openai, "chat_completion_cache", helpers_other.TTLLRUCache(max_entries=10, ttl_seconds=60))
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+    def test_cache_key(self):
+        cache_key = openai.get_chat_completion_cache_key("gpt-4o-mini", "System", "Question", "text", 500)
+        self.assertEqual(cache_key, openai.get_chat_completion_cache_key("gpt-4o-mini", "System", "Question", "text", 500))
+        self.assertEqual(len(cache_key), 64)
+        for other_request in [("gpt-4o", "System", "Question", "text", 500), ("gpt-4o-mini", "Other system", "Question", "text", 500), ("gpt-4o-mini", "System", "Other question", "text", 500), ("gpt-4o-mini", "System", "Question", "text", 100)]:
+            self.assertNotEqual(openai.get_chat_completion_cache_key(*other_request), cache_key, other_request)
+
+    def test_cache_key_of_structured_responses(self):
+        # Response formats are told apart by their name and JSON schema, not by the class itself: the callers define them per call.
+        def response_format(field_type:type):
+            class VizEvaluationResponse(BaseModel):
+                id: field_type
+            return VizEvaluationResponse
+
+        cache_key = openai.get_chat_completion_cache_key("gpt-4o-mini", "System", "Question", response_format(str), 500)
+        self.assertEqual(openai.get_chat_completion_cache_key("gpt-4o-mini", "System", "Question", response_format(str), 500), cache_key)
+        self.assertNotEqual(openai.get_chat_completion_cache_key("gpt-4o-mini", "System", "Question", response_format(int), 500), cache_key)
+        self.assertNotEqual(openai.get_chat_completion_cache_key("gpt-4o-mini", "System", "Question", "text", 500), cache_key)
+        # max_tokens isn't sent for structured responses, so it doesn't matter.
+        self.assertEqual(openai.get_chat_completion_cache_key("gpt-4o-mini", "System", "Question", response_format(str), 100), cache_key)
+
+    def test_identical_requests_are_answered_from_the_cache(self):
+        client = mock.Mock()
+        client.chat.completions.create.return_value = mock.Mock(choices=[mock.Mock(message=mock.Mock(content="Answer"))], usage=mock.Mock(prompt_tokens=10, completion_tokens=5, total_tokens=15))
+        with mock.patch.object(openai, "get_openai_api_settings", return_value=OpenAISettings(preferred_model="gpt-4o-mini", max_completion_tokens=500)), mock.patch.object(openai, "get_openai_client", return_value=client):
+            self.assertEqual(openai.openai_api_chat_completion("Question", "System"), "Answer")
+            self.assertEqual(openai.openai_api_chat_completion("Question", "System"), "Answer")
+            self.assertEqual(client.chat.completions.create.call_count, 1)
+
+            openai.openai_api_chat_completion("Question", "System", use_cache=False)
+            openai.openai_api_chat_completion("Other question", "System")
+            self.assertEqual(client.chat.completions.create.call_count, 3)
+
+class DashboardCommentCacheTests(TestCase):
+    """
+    Reusing the answers of comment_on_dashboard_file, in Django's cache, only while the dashboard image is unchanged.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.openai_client = mock.Mock()
+        self.openai_client.chat.completions.create.return_value = mock.Mock(choices=[mock.Mock(message=mock.Mock(content="Comment"))], usage=mock.Mock(prompt_tokens=800, completion_tokens=50, total_tokens=850))
+        for patch in [mock.patch.object(openai, "get_openai_api_settings", return_value=OpenAISettings(preferred_model="gpt-4o-mini", max_completion_tokens=500)), mock.patch.object(openai, "get_openai_client", return_value=self.openai_client)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def comment(self, file_bytes:bytes, custom_prompt:str="How are we doing?", image_detail:str="high") -> str:
+        return openai.comment_on_dashboard_file(file_bytes, "png", custom_prompt=custom_prompt, convert_to_slack_markdown=False, image_detail=image_detail)
+
+    def test_unchanged_image_is_answered_from_the_cache(self):
+        self.assertEqual(self.comment(b"dashboard image"), "Comment")
+        self.assertEqual(self.comment(b"dashboard image"), "Comment")
+        # Case and whitespace don't make it another question.
+        self.assertEqual(self.comment(b"dashboard image", custom_prompt="  how are  we doing? "), "Comment")
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 1)
+
+    def test_changed_image_misses_the_cache(self):
+        self.comment(b"dashboard image")
+        self.comment(b"dashboard image, rendered again with new data")
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 2)
+
+    def test_other_prompt_or_detail_misses_the_cache(self):
+        self.comment(b"dashboard image")
+        self.comment(b"dashboard image", custom_prompt="What stands out?")
+        self.comment(b"dashboard image", image_detail="low")
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 3)
+
+    def test_cache_key(self):
+        cache_key = openai.get_dashboard_comment_cache_key("a" * 64, "png", "How are we doing?", "gpt-4o-mini", 500, "high")
+        self.assertTrue(cache_key.startswith(openai.dashboard_comment_cache_key_prefix))
+        self.assertEqual(openai.get_dashboard_comment_cache_key("a" * 64, "png", "HOW ARE\nwe doing?", "gpt-4o-mini", 500, "high"), cache_key)
+        for other_request in [("b" * 64, "png", "How are we doing?", "gpt-4o-mini", 500, "high"), ("a" * 64, "pdf", "How are we doing?", "gpt-4o-mini", 500, "high"), ("a" * 64, "png", "How are we doing?", "gpt-4o", 500, "high"), ("a" * 64, "png", "How are we doing?", "gpt-4o-mini", 100, "high")]:
+            self.assertNotEqual(openai.get_dashboard_comment_cache_key(*other_request), cache_key, other_request)
+
+    def test_use_cache_false_asks_again(self):
+        self.comment(b"dashboard image")
+        openai.comment_on_dashboard_file(b"dashboard image", "png", custom_prompt="How are we doing?", convert_to_slack_markdown=False, use_cache=False)
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 2)
+
+    @override_settings(TNQ_VISION_CACHE_SECONDS=0)
+    def test_disabled(self):
+        self.comment(b"dashboard image")
+        self.comment(b"dashboard image")
+        self.assertEqual(self.openai_client.chat.completions.create.call_count, 2)
+
+class CachedSelectionTests(TestCase):
+    """
+    Reusing the selection for an earlier, similar question only while the selected dashboard is unchanged, in an up to date catalog.
+    """
+
+    def store_workbook(self, dashboard_name:str):
+        catalog_store.store_entries(tableau_core_catalog.catalog_platform, tableau_core_catalog.catalog_entity_type, [{ "luid": "W1", "name": "Workbook", "updatedAt": "2026-01-01T00:00:00Z", "dashboards": [{ "luid": "D1", "name": dashboard_name, "sheets": [] }] }], id_key="luid", modified_key="updatedAt", full_sync=True)
+
+    def save_selection(self) -> QuestionCacheEntry:
+        candidate = ask_your_data.build_tableau_core_candidates(tableau_core_catalog.load_dashboards())[0]
+        return question_cache.save_selection("How far did we run?", np.ones(4, dtype=np.float32) / 2, "hashing-4", candidate)
+
+    def test_stale_catalog_is_refreshed_before_reusing(self):
+        self.store_workbook("Running")
+        question_cache_entry = self.save_selection()
+        CatalogSyncState.objects.filter(platform=tableau_core_catalog.catalog_platform).update(last_synced_at=timezone.now() - datetime.timedelta(seconds=settings.TNQ_CATALOG_MAX_AGE_SECONDS + 60))
+
+        # The dashboard was renamed on Tableau since; only a refresh finds out.
+        with mock.patch.object(ask_your_data.tableau_rest_api, "connect", return_value={}), mock.patch.object(tableau_core_catalog, "refresh_catalog", side_effect=lambda *args, **kwargs: self.store_workbook("Running (old)")) as refresh_catalog:
+            self.assertIsNone(ask_your_data.load_cached_selection(question_cache_entry))
+        self.assertEqual(refresh_catalog.call_count, 1)
+        self.assertFalse(QuestionCacheEntry.objects.filter(id=question_cache_entry.id).exists())
+
+    def test_fresh_catalog_is_reused(self):
+        self.store_workbook("Running")
+        question_cache_entry = self.save_selection()
+
+        with mock.patch.object(ask_your_data.tableau_rest_api, "connect", return_value={ "token": "token-1" }), mock.patch.object(tableau_core_catalog, "refresh_catalog") as refresh_catalog:
+            cached_selection = ask_your_data.load_cached_selection(question_cache_entry)
+        self.assertEqual(refresh_catalog.call_count, 0)
+        self.assertEqual(cached_selection["selected_viz"]["id"], "D1")
+        self.assertEqual(cached_selection["connection_dict"], { "token": "token-1" })
+
+class VisionImagesTests(TestCase):
+    """
+    Sizing dashboard images, and choosing their detail level, by how OpenAI counts their tokens.
+    """
+
+    def png_header(self, width:int, height:int) -> bytes:
+        return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", width, height) + b"\x08\x06\x00\x00\x00"
+
+    def test_png_size(self):
+        self.assertEqual(vision_images.get_png_size(self.png_header(1536, 1024)), (1536, 1024))
+        self.assertIsNone(vision_images.get_png_size(b"%PDF-1.7 and then some more bytes"))
+        self.assertIsNone(vision_images.get_png_size(b"\x89PNG\r\n\x1a\n"))
+
+    def test_estimate_tokens(self):
+        # Within 2048x2048, then the shortest side to 768: 1536x768 is 3x2 tiles.
+        self.assertEqual(vision_images.estimate_tokens(4096, 2048, "high"), 85 + 170 * 6)
+        # Exact multiples of 512 don't start another tile.
+        self.assertEqual(vision_images.estimate_tokens(1024, 512, "high"), 85 + 170 * 2)
+        self.assertEqual(vision_images.estimate_tokens(1025, 512, "high"), 85 + 170 * 3)
+        self.assertEqual(vision_images.estimate_tokens(300, 200, "high"), 85 + 170)
+        self.assertEqual(vision_images.estimate_tokens(4096, 2048, "low"), 85)
+
+    def test_target_size_saves_tiles(self):
+        # 3x2 tiles at 1152x768; 2x2 at 1024x682.
+        self.assertEqual(vision_images.get_target_size(1152, 768, "high"), (1024, 682))
+        self.assertEqual(vision_images.estimate_tokens(1024, 682, "high"), 85 + 170 * 4)
+        # Scaled the way OpenAI would first.
+        self.assertEqual(vision_images.get_target_size(4096, 2048, "high"), (1536, 768))
+        self.assertEqual(vision_images.get_target_size(1000, 500, "low"), (512, 256))
+
+    def test_target_size_of_exact_multiples_and_small_images(self):
+        self.assertEqual(vision_images.get_target_size(1024, 512, "high"), (1024, 512))
+        self.assertEqual(vision_images.get_target_size(1536, 768, "high"), (1536, 768))
+        self.assertEqual(vision_images.get_target_size(500, 300, "high"), (500, 300))
+
+    def test_target_size_shrinks_at_most_the_limit(self):
+        # 1024 / 1200 is within 15% less...
+        self.assertEqual(vision_images.get_target_size(1200, 700, "high"), (1024, 597))
+        # ...1024 / 1210 is not, and 512 / 700 isn't either.
+        self.assertEqual(vision_images.get_target_size(1210, 700, "high"), (1210, 700))
+        # Exactly the limit is still allowed.
+        with override_settings(TNQ_VISION_MAX_TILE_SNAP_SHRINK=0.2):
+            self.assertEqual(vision_images.get_target_size(1280, 700, "high"), (1024, 560))
+        with override_settings(TNQ_VISION_MAX_TILE_SNAP_SHRINK=0.19):
+            self.assertEqual(vision_images.get_target_size(1280, 700, "high"), (1280, 700))
+        with override_settings(TNQ_VISION_MAX_TILE_SNAP_SHRINK=0):
+            self.assertEqual(vision_images.get_target_size(1152, 768, "high"), (1152, 768))
+
+    @override_settings(TNQ_VISION_DETAIL="auto", TNQ_VISION_LOW_DETAIL_MAX_VISUALIZATIONS=1)
+    def test_choose_detail(self):
+        self.assertEqual(vision_images.choose_detail(1), "low")
+        self.assertEqual(vision_images.choose_detail(2), "high")
+        # Unknown, or none at all (e.g. only text and images), isn't simple enough to say.
+        self.assertEqual(vision_images.choose_detail(None), "high")
+        self.assertEqual(vision_images.choose_detail(0), "high")
+        with override_settings(TNQ_VISION_LOW_DETAIL_MAX_VISUALIZATIONS=0):
+            self.assertEqual(vision_images.choose_detail(1), "high")
+        with override_settings(TNQ_VISION_DETAIL="low"):
+            self.assertEqual(vision_images.choose_detail(10), "low")
+        with override_settings(TNQ_VISION_DETAIL="high"):
+            self.assertEqual(vision_images.choose_detail(1), "high")
+
+    @override_settings(TNQ_VISION_DETAIL="high")
+    def test_prepare_image_without_pillow(self):
+        image_bytes = self.png_header(1152, 768)
+        with mock.patch.object(vision_images, "Image", None):
+            prepared_image = vision_images.prepare_image(image_bytes)
+        self.assertIs(prepared_image["image_bytes"], image_bytes)
+        self.assertEqual(prepared_image["detail"], "high")
+        self.assertEqual(prepared_image["original_tokens"], 85 + 170 * 6)
+        self.assertEqual(prepared_image["tokens"], 85 + 170 * 6)
+
+    def test_prepare_image_of_other_formats(self):
+        prepared_image = vision_images.prepare_image(b"%PDF-1.7 and then some more bytes", visualization_count=1)
+        self.assertEqual(prepared_image["bytes"], prepared_image["original_bytes"])
+        self.assertIsNone(prepared_image["tokens"])
+
+class ViewImageUrlTests(TestCase):
+    """
+    The query parameters of the REST API's view image URL.
+    """
+
+    rest_api_connection = { "tableau_api_url": "https://tableau.example.com/api/3.26", "tableau_site_id": "site-id" }
+
+    def test_without_parameters(self):
+        self.assertEqual(tableau_rest_api.get_view_image_url(self.rest_api_connection, "V1"), "https://tableau.example.com/api/3.26/sites/site-id/views/V1/image")
+
+    def test_zero_size_is_tableaus_default(self):
+        self.assertEqual(tableau_rest_api.get_view_image_url(self.rest_api_connection, "V1", viz_width=0, viz_height=0, resolution=""), "https://tableau.example.com/api/3.26/sites/site-id/views/V1/image")
+        self.assertEqual(tableau_rest_api.get_view_image_url(self.rest_api_connection, "V1", viz_width=1536, viz_height=0), "https://tableau.example.com/api/3.26/sites/site-id/views/V1/image?vizWidth=1536")
+
+    def test_all_parameters(self):
+        request_url = tableau_rest_api.get_view_image_url(self.rest_api_connection, "V1", no_cache=True, filters=[("Region", "West")], viz_width=1536, viz_height=1024, resolution="high")
+        self.assertEqual(request_url, "https://tableau.example.com/api/3.26/sites/site-id/views/V1/image?maxAge=1&vizWidth=1536&vizHeight=1024&resolution=high&vf_Region=West")
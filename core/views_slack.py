@@ -3,13 +3,14 @@ import os, json
 import traceback
 
 # imports - Django
+from django.core.cache import cache
 from django.http import JsonResponse, HttpRequest, HttpResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 
 # imports - our app
 # Models
-from core.models import SlackCredential
+# N/A
 # Functions
 from tableau_next_question.functions import log_and_display_message
 from django.conf import settings
@@ -25,6 +26,42 @@ import core.tasks as tasks
 # Event subscriptions: https://api.slack.com/events-api#event_subscriptions
 # Interactive components: https://api.slack.com/interactivity
 
+# Slack expects us to acknowledge an event within 3 seconds, or it delivers the event again (up to three times, with an X-Slack-Retry-Num header). So the endpoints only start a task and respond; anything that talks to Slack (including the "got your question" message) happens in the task. And since a retry may still arrive (e.g. when we were slow for other reasons), we remember which events we already started a task for, for TNQ_SLACK_EVENT_DEDUPLICATION_SECONDS, in the cache that all workers share.
+
+def event_cache_key(request_json:dict) -> str | None:
+    """
+    The cache key we remember an event by: its event_id, or (if there's none) its channel and timestamp. None if it has neither, in which case we can't tell repeated deliveries apart.
+    """
+    event_id = request_json.get("event_id")
+    if event_id:
+        return f"tnq:slack_event:{ event_id }"
+    channel = request_json.get("event", {}).get("channel")
+    ts = request_json.get("event", {}).get("ts")
+    if channel and ts:
+        return f"tnq:slack_event:{ channel }:{ ts }"
+    return None
+
+def claim_event(request:HttpRequest, request_json:dict) -> bool:
+    """
+    Claim an event for processing. Returns False if it was already claimed, i.e. this is a repeated delivery of an event we're already handling. Events we can't identify are always processed.
+    """
+    cache_key = event_cache_key(request_json)
+    if cache_key is None:
+        log_and_display_message("Slack event without an event_id, channel or ts; processing it without checking for repeated deliveries.", level="warning")
+        return True
+    if cache.add(cache_key, True, timeout=settings.TNQ_SLACK_EVENT_DEDUPLICATION_SECONDS):
+        return True
+    log_and_display_message(f"Ignoring repeated delivery of Slack event { request_json.get('event_id') } (retry { request.headers.get('X-Slack-Retry-Num', '?') }, reason: { request.headers.get('X-Slack-Retry-Reason', '?') }).")
+    return False
+
+def release_event(request_json:dict):
+    """
+    Forget that we claimed an event, e.g. because starting its task failed, so a repeated delivery gets another chance.
+    """
+    cache_key = event_cache_key(request_json)
+    if cache_key is not None:
+        cache.delete(cache_key)
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def event(request:HttpRequest):
@@ -59,11 +96,18 @@ def event(request:HttpRequest):
         # Start task and respond to the user if it's a direct message, not sent by a bot/ourapp itself.
         if request_json["event"].get("type") == "message" and request_json["event"].get("subtype") not in ["message_changed", "message_deleted"] and request_json["event"].get("channel_type") == "im" and "bot_id" not in request_json["event"]:
 
-            slack_credential, slack_credential_created = SlackCredential.objects.get_or_create()
+            if not claim_event(request, request_json):
+                return JsonResponse({ "message": "Event received" })
 
             thread_ts = request_json["event"].get("thread_ts", request_json["event"].get("ts", request_json["event"].get("message", {}).get("ts")))
             first_name = request_json["event"].get("user_profile", {}).get("first_name")
 
+            # The task posts this preliminary message first thing.
+            if first_name is not None:
+                acknowledgement = f"Thanks, got your question, { first_name }! I'll start thinking about it and get back to you in a moment."
+            else:
+                acknowledgement = f"Thanks, got your question! I'll start thinking about it and get back to you in a moment."
+
             # Start an async task to respond to the user with the actual answer.
             try:
                 kwargs_for_task = {
@@ -71,20 +115,16 @@ def event(request:HttpRequest):
                     "thread_ts": thread_ts,
                     "slack_user_id": request_json["event"]["user"],
                     "first_name": first_name,
+                    "acknowledgement": acknowledgement,
                 }
                 task_result = tasks.respond_to_data_question_task(source="slack", question=request_json["event"]["text"], kwargs=kwargs_for_task)
             except Exception as e:
+                release_event(request_json)
                 error_message = f"Failed to start async task:\n\t{e}\n\t{traceback.format_exc}"
                 log_and_display_message(error_message, level="error")
                 return JsonResponse({ "error": error_message }, status=500)
             else:
                 log_and_display_message(f"Started async task { task_result } to respond to user.")
-                # Respond with a preliminary message
-                if first_name is not None:
-                    message = f"Thanks, got your question, { first_name }! I'll start thinking about it and get back to you in a moment."
-                else:
-                    message = f"Thanks, got your question! I'll start thinking about it and get back to you in a moment."
-                slack.post_message(slack_channel=request_json["event"]["channel"], slack_credential=slack_credential, text=message, thread_ts=thread_ts)
 
         # Possibilities other than IM
         if request_json["event"].get("type") == "message" and request_json["event"].get("subtype") not in ["message_changed", "message_deleted"] and request_json["event"].get("channel_type") != "im" and "bot_id" not in request_json["event"]:
@@ -98,7 +138,8 @@ def event(request:HttpRequest):
                 log_and_display_message(f"Channel { request_json['event'].get('channel') } is supported.")
 
                 # For now, assume this is a data question and answer it like any other.
-                slack_credential, slack_credential_created = SlackCredential.objects.get_or_create()
+                if not claim_event(request, request_json):
+                    return JsonResponse({ "message": "Event received" })
 
                 thread_ts = request_json["event"].get("thread_ts", request_json["event"].get("ts", request_json["event"].get("message", {}).get("ts")))
                 first_name = request_json["event"].get("user_profile", {}).get("first_name")
@@ -108,17 +149,17 @@ def event(request:HttpRequest):
                         "thread_ts": thread_ts,
                         "slack_user_id": request_json["event"]["user"],
                         "first_name": first_name,
+                        # The task posts this preliminary message first thing.
+                        "acknowledgement": "That sounds like a data question! I'll start thinking about it, try and find an answer on Tableau. I'll get back to you in a moment.",
                     }
                     task_result = tasks.respond_to_data_question_task(source="slack", question=request_json["event"]["text"], kwargs=kwargs_for_task)
                 except Exception as e:
+                    release_event(request_json)
                     error_message = f"Failed to start async task:\n\t{e}\n\t{traceback.format_exc()}"
                     log_and_display_message(error_message, level="error")
                     return JsonResponse({ "error": error_message }, status=500)
                 else:
                     log_and_display_message(f"Started async task { task_result } to respond to user.")
-                    # Respond with a preliminary message
-                    message = f"That sounds like a data question! I'll start thinking about it, try and find an answer on Tableau. I'll get back to you in a moment."
-                    slack.post_message(slack_channel=request_json["event"]["channel"], slack_credential=slack_credential, text=message, thread_ts=thread_ts)
 
         response = JsonResponse({ "message": "Event received" })
         return response
@@ -91,6 +91,18 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# In the database rather than in memory, so it is shared between the web process and the Django-Q2 workers (e.g. tokens, see core.functions.tableau.next_auth). Requires "python manage.py createcachetable".
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'tnq_cache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -179,6 +191,13 @@ Q_CLUSTER = {
 SLACK_CLIENT_ID = os.getenv("SLACK_CLIENT_ID", "")
 SLACK_CLIENT_SECRET = os.getenv("SLACK_CLIENT_SECRET", "")
 SLACK_EVENTS_API_VERIFICATION_TOKEN = os.getenv("SLACK_EVENTS_API_VERIFICATION_TOKEN", "")
+TNQ_SLACK_EVENT_DEDUPLICATION_SECONDS = int(os.getenv("TNQ_SLACK_EVENT_DEDUPLICATION_SECONDS", 3600)) # How long we remember Slack events we handled, to ignore repeated deliveries (Slack retries for up to about 5 minutes)
+TNQ_SLACK_CHANNEL_MEMBERSHIP_TTL_SECONDS = int(os.getenv("TNQ_SLACK_CHANNEL_MEMBERSHIP_TTL_SECONDS", 3600)) # How long we assume the bot is still a member of a channel it was in, before checking again
+TNQ_SLACK_STATUS_DEBOUNCE_SECONDS = float(os.getenv("TNQ_SLACK_STATUS_DEBOUNCE_SECONDS", 0.5)) # Status changes within this time of each other are sent as one (see core.functions.slack_status)
+TNQ_SLACK_MAX_RETRIES = int(os.getenv("TNQ_SLACK_MAX_RETRIES", 3)) # How often we retry a Slack call that was rate limited (see core.functions.slack_dispatch)
+TNQ_SLACK_DISPATCH_TIMEOUT_SECONDS = float(os.getenv("TNQ_SLACK_DISPATCH_TIMEOUT_SECONDS", 120)) # How long we wait for a queued Slack call to be sent, including its time in the queue and its retries
+TNQ_SLACK_STATUS_CLOSE_TIMEOUT_SECONDS = float(os.getenv("TNQ_SLACK_STATUS_CLOSE_TIMEOUT_SECONDS", 15)) # How long we wait for the status message to be removed when we're done
+TNQ_SLACK_STREAM_UPDATE_SECONDS = float(os.getenv("TNQ_SLACK_STREAM_UPDATE_SECONDS", 1.5)) # How often we update a message while the answer is being written (see core.functions.slack_streaming)
 
 # Tableau Next API
 SF_EXT_CLIENT_APP_CONSUMER_KEY = os.getenv("SF_EXT_CLIENT_APP_CONSUMER_KEY", "")
@@ -197,4 +216,43 @@ TABLEAU_PAT_SECRET = os.getenv("TABLEAU_PAT_SECRET", "")
 TNQ_TEMP_WORKSPACE_NAME = os.getenv("TNQ_TEMP_WORKSPACE_NAME", "Timothy_s_Workspace")
 TNQ_TEMP_WORKSPACE_LABEL = os.getenv("TNQ_TEMP_WORKSPACE_LABEL", "(Tableau) Next Question! - Temporary Workspace")
 TNQ_DISABLE_TABLEAU_CORE = os.getenv("TNQ_DISABLE_TABLEAU_CORE", False)
-TNQ_DISABLE_TABLEAU_NEXT = os.getenv("TNQ_DISABLE_TABLEAU_NEXT", False)
\ No newline at end of file
+TNQ_DISABLE_TABLEAU_NEXT = os.getenv("TNQ_DISABLE_TABLEAU_NEXT", False)
+TNQ_SETTINGS_CACHE_SECONDS = int(os.getenv("TNQ_SETTINGS_CACHE_SECONDS", 300)) # How long a process keeps using its copy of the Slack credentials and OpenAI settings, if it isn't told they changed
+TNQ_OPENAI_RESPONSE_CACHE_SECONDS = int(os.getenv("TNQ_OPENAI_RESPONSE_CACHE_SECONDS", 3600)) # How long a process reuses the response to an identical OpenAI chat completion request. 0 to disable.
+TNQ_OPENAI_RESPONSE_CACHE_SIZE = int(os.getenv("TNQ_OPENAI_RESPONSE_CACHE_SIZE", 256)) # How many of those responses a process keeps; the least recently used make way
+TNQ_VISION_CACHE_SECONDS = int(os.getenv("TNQ_VISION_CACHE_SECONDS", 3600)) # How long we reuse the answer to the same question about the same (unchanged) dashboard image, counted from when we first got it (in Django's cache, shared by all processes). 0 to disable.
+TNQ_VISION_DETAIL = os.getenv("TNQ_VISION_DETAIL", "auto") # Detail level OpenAI looks at dashboard images with: "low", "high", or "auto" to choose per dashboard (see core.functions.vision_images)
+TNQ_VISION_LOW_DETAIL_MAX_VISUALIZATIONS = int(os.getenv("TNQ_VISION_LOW_DETAIL_MAX_VISUALIZATIONS", 1)) # With "auto", dashboards with at most this many visualizations get "low" detail. 0 to always use "high".
+TNQ_VISION_MAX_TILE_SNAP_SHRINK = float(os.getenv("TNQ_VISION_MAX_TILE_SNAP_SHRINK", 0.15)) # How much (as a fraction) we shrink an image beyond what OpenAI would, if that saves a row or column of 512x512 tiles
+TNQ_VIEW_IMAGE_WIDTH = int(os.getenv("TNQ_VIEW_IMAGE_WIDTH", 1536)) # Width (pixels) we ask Tableau to render view images at, for dashboards with an automatic or range size. 0 for Tableau's default.
+TNQ_VIEW_IMAGE_HEIGHT = int(os.getenv("TNQ_VIEW_IMAGE_HEIGHT", 1024)) # Height (pixels), likewise
+TNQ_VIEW_IMAGE_RESOLUTION = os.getenv("TNQ_VIEW_IMAGE_RESOLUTION", "") # "high" to have Tableau render view images at a higher pixel density; empty for the standard one
+# Catalog (stored copies of the Tableau Next/Core metadata we search through to answer questions)
+TNQ_CATALOG_MAX_AGE_SECONDS = int(os.getenv("TNQ_CATALOG_MAX_AGE_SECONDS", 300)) # Older than this, and we refresh (incrementally) before answering
+TNQ_CATALOG_FULL_REFRESH_SECONDS = int(os.getenv("TNQ_CATALOG_FULL_REFRESH_SECONDS", 86400)) # Older than this, and we start over with a full refresh
+TNQ_DISCOVERY_MAX_WORKERS = int(os.getenv("TNQ_DISCOVERY_MAX_WORKERS", 4)) # How many discovery API calls we make at the same time
+TNQ_DISCOVERY_TIMEOUT_SECONDS = int(os.getenv("TNQ_DISCOVERY_TIMEOUT_SECONDS", 120)) # After this, we continue with whichever platform(s) did find visualizations
+TNQ_SELECTION_MAX_CANDIDATES = int(os.getenv("TNQ_SELECTION_MAX_CANDIDATES", 30)) # How many of the best matching candidates we send to OpenAI to select from
+TNQ_SEMANTIC_MAX_CANDIDATES = int(os.getenv("TNQ_SEMANTIC_MAX_CANDIDATES", 10)) # How many semantically closest candidates (embeddings) we add to the ones matching the question's words
+TNQ_CATALOG_EMBEDDER = os.getenv("TNQ_CATALOG_EMBEDDER", "openai") # "openai", or "hashing" to work offline (no API calls, but also far less semantic)
+TNQ_CATALOG_INDEX_DIR = os.getenv("TNQ_CATALOG_INDEX_DIR", os.path.join(BASE_DIR, "catalog_index")) # Where we keep the embeddings of the catalog
+TNQ_SELECTION_TOKEN_BUDGET = int(os.getenv("TNQ_SELECTION_TOKEN_BUDGET", 6000)) # Maximum (estimated) prompt tokens for the candidates we send to OpenAI to select from
+TNQ_NEXT_DISCOVERY_MODE = os.getenv("TNQ_NEXT_DISCOVERY_MODE", "composite") # "composite" to get the Tableau Next catalog's SOQL entities in one Composite API request, "per_entity_type" for one (concurrent) request each
+TNQ_PREWARM_INTERVAL_MINUTES = int(os.getenv("TNQ_PREWARM_INTERVAL_MINUTES", 4)) # How often the scheduled task refreshes the catalogs (see "python manage.py register_schedules"); best kept below TNQ_CATALOG_MAX_AGE_SECONDS. 0 to disable.
+TNQ_THREAD_SNAPSHOT_TTL_SECONDS = int(os.getenv("TNQ_THREAD_SNAPSHOT_TTL_SECONDS", 3600)) # How long follow-up actions in a thread (e.g. rebuilding on Tableau Next) can rely on what we stored when answering
+TNQ_QUESTION_CACHE_SECONDS = int(os.getenv("TNQ_QUESTION_CACHE_SECONDS", 86400)) # How long we reuse the visualization selected for a question, for similar questions (see core.functions.question_cache). 0 to disable.
+TNQ_QUESTION_CACHE_SIMILARITY = float(os.getenv("TNQ_QUESTION_CACHE_SIMILARITY", 0.9)) # How similar (cosine, between the questions' embeddings) a question needs to be to an earlier one to reuse its selection
+TNQ_QUESTION_CACHE_SIZE = int(os.getenv("TNQ_QUESTION_CACHE_SIZE", 1000)) # How many selections we keep; the least recently used make way
+# Tableau Next authentication
+TNQ_NEXT_TOKEN_LIFETIME_SECONDS = int(os.getenv("TNQ_NEXT_TOKEN_LIFETIME_SECONDS", 1800)) # How long an access token is valid, if Salesforce doesn't tell us (match the External Client App's token settings)
+TNQ_NEXT_TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("TNQ_NEXT_TOKEN_REFRESH_MARGIN_SECONDS", 300)) # Get a new token this long before the current one expires
+# Tableau REST API sessions
+TNQ_REST_SESSION_MAX_AGE_SECONDS = int(os.getenv("TNQ_REST_SESSION_MAX_AGE_SECONDS", 3600)) # How long we reuse a signed-in REST API session before signing in again (Tableau also expires idle sessions on its end, in which case we sign in again right away)
+TNQ_REST_SESSION_IDLE_SECONDS = int(os.getenv("TNQ_REST_SESSION_IDLE_SECONDS", 600)) # When a process exits, it signs out of REST API sessions no worker used for this long
+# HTTP (see core.functions.http_transport)
+TNQ_HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("TNQ_HTTP_CONNECT_TIMEOUT_SECONDS", 10)) # Default timeout for connecting to an API
+TNQ_HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("TNQ_HTTP_READ_TIMEOUT_SECONDS", 120)) # Default timeout for waiting for an API's response
+TNQ_HTTP_MAX_RETRIES = int(os.getenv("TNQ_HTTP_MAX_RETRIES", 3)) # Retries on connection errors and 429/503 responses
+TNQ_HTTP_BACKOFF_FACTOR = float(os.getenv("TNQ_HTTP_BACKOFF_FACTOR", 1)) # Exponential backoff between retries: 0s, 2s, 4s, ... times this factor (unless the API sends Retry-After)
+TNQ_HTTP_POOL_CONNECTIONS = int(os.getenv("TNQ_HTTP_POOL_CONNECTIONS", 10)) # How many hosts a session keeps a connection pool for
+TNQ_HTTP_POOL_MAXSIZE = int(os.getenv("TNQ_HTTP_POOL_MAXSIZE", 10)) # How many connections a session keeps open per host; at least TNQ_DISCOVERY_MAX_WORKERS